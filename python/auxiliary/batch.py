@@ -0,0 +1,245 @@
+"""
+Runs batches of independent programs over a pool of processes, so that a batch uses every core.
+
+Programs come from a JSONL file (one {"id": ..., "program": ..., "typed": ...} object per line, where only "program" is
+required) or from a folder (one program per file, named after the file). Every worker process imports the interpreters
+once and then runs one program after the other, each in a fresh Context, so programs share nothing.
+
+Results come back as dictionaries with the value, the inferred type (for typed programs), the error if there was one,
+and how long every phase took. They are yielded in input order, or as soon as they are done. Only a fixed amount of
+programs is handed to the pool at once, so a batch of any size takes the same memory.
+
+With a cache folder, programs that were parsed and typed before (by any worker, in any batch) are read from there.
+
+A program that kills its worker (e.g. by overflowing the C stack, which the high recursion limit allows) gets an error
+result like any other failing program, and the batch goes on in a new pool.
+
+From the python/ folder:
+    PYTHONPATH=.:auxiliary python auxiliary/batch.py programs.jsonl --output results.jsonl
+"""
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+from typing import Dict, Iterable, Iterator, Optional
+import json
+import os
+import sys
+import time
+
+from cache import ASTCache
+from parser import stringToExpression
+from printer import type__repr__
+from inferred import *
+
+
+def read_jsonl(path: str) -> Iterator[dict]:
+    with open(path) as file:
+        for number, line in enumerate(file, start=1):
+            if line.strip():
+                job = json.loads(line)
+                job.setdefault("id", number)
+                yield job
+
+
+def read_folder(path: str) -> Iterator[dict]:
+    for name in sorted(os.listdir(path)):
+        full_path = os.path.join(path, name)
+        if os.path.isfile(full_path):
+            with open(full_path) as file:
+                yield {"id": name, "program": file.read()}
+
+
+def read_jobs(path: str) -> Iterator[dict]:
+    return read_folder(path) if os.path.isdir(path) else read_jsonl(path)
+
+
+WORKER_CACHE: Optional[ASTCache] = None
+
+
+def start_worker(recursion_limit: int, cache_folder: Optional[str]):
+    global WORKER_CACHE
+    sys.setrecursionlimit(recursion_limit)
+    if cache_folder is not None:
+        WORKER_CACHE = ASTCache(cache_folder)
+
+
+def to_json(val: ExpVal):
+    if isinstance(val, (IntVal, BoolVal)):
+        return val.value
+    else:
+        return repr(val)
+
+
+def empty_result(job: dict) -> dict:
+    return {"id": job.get("id"), "value": None, "type": None, "error": None,
+            "parse_ms": None, "type_ms": None, "eval_ms": None}
+
+
+def failed(job: dict, error: BaseException) -> dict:
+    result = empty_result(job)
+    result["error"] = f"{error.__class__.__name__}: {error}"
+    return result
+
+
+def run_job(job: dict) -> dict:
+    """
+    Parse, type (if the program is typed) and evaluate one program. Never raises: errors are part of the result.
+    """
+    result = empty_result(job)
+    context = Context(typed=job.get("typed"))
+    try:
+        if WORKER_CACHE is not None:
+            start = time.perf_counter()
+            exp, program_type = WORKER_CACHE.load(job["program"], context)
+            result["parse_ms"] = 1000*(time.perf_counter() - start)  # Includes typing, when it wasn't cached yet.
+            if program_type is not None:
+                result["type"] = type__repr__(program_type)
+        else:
+            start = time.perf_counter()
+            exp = stringToExpression(job["program"], context)
+            result["parse_ms"] = 1000*(time.perf_counter() - start)
+
+        if isinstance(exp, TypedExpression) and result["type"] is None:
+            start = time.perf_counter()
+            result["type"] = type__repr__(type_of_program(exp, context=context))
+            result["type_ms"] = 1000*(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        result["value"] = to_json(Program(exp, EmptyEnvironment(), context).value_of_program())
+        result["eval_ms"] = 1000*(time.perf_counter() - start)
+    except Exception as e:
+        result["error"] = f"{e.__class__.__name__}: {e}"
+    return result
+
+
+class Pool:
+    """
+    A pool of worker processes, and the jobs that are in it, by ticket.
+
+    When a worker dies, the pool is broken and every job still in it fails with a BrokenProcessPool. Those jobs are
+    handed to a new pool, except the one whose result is being asked for: that one runs again in a pool of its own, so
+    it only gets the error if it was the one that killed its worker.
+    """
+
+    def __init__(self, workers: int, recursion_limit: int, cache_folder: Optional[str]):
+        self.options = dict(max_workers=workers, initializer=start_worker, initargs=(recursion_limit, cache_folder))
+        self.executor = ProcessPoolExecutor(**self.options)
+        self.jobs: Dict[int, dict] = dict()
+        self.futures: Dict[int, Future] = dict()
+        self.tickets = 0
+
+    def submit(self, job: dict) -> int:
+        ticket = self.tickets
+        self.tickets += 1
+        self.jobs[ticket] = job
+        try:
+            self.futures[ticket] = self.executor.submit(run_job, job)
+        except BrokenProcessPool:
+            self.restart()  # Also submits this job again.
+        return ticket
+
+    def first_done(self) -> int:
+        """
+        Wait for any job to be done, and give its ticket.
+        """
+        tickets = {future: ticket for ticket, future in self.futures.items()}
+        done, _ = wait(tickets, return_when=FIRST_COMPLETED)
+        return tickets[next(iter(done))]
+
+    def result(self, ticket: int) -> dict:
+        """
+        Wait for the result of a job, and forget the job.
+        """
+        job = self.jobs.pop(ticket)
+        future = self.futures.pop(ticket)
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self.restart()
+            return self.run_alone(job)
+        except Exception as e:  # E.g. a result that can't be pickled.
+            return failed(job, e)
+
+    def run_alone(self, job: dict) -> dict:
+        with ProcessPoolExecutor(**dict(self.options, max_workers=1)) as executor:
+            try:
+                return executor.submit(run_job, job).result()
+            except BrokenProcessPool:
+                return failed(job, BrokenProcessPool("The worker running this program died, e.g. of a C stack overflow."))
+            except Exception as e:
+                return failed(job, e)
+
+    def restart(self):
+        """
+        Replace a broken pool by a new one, and submit the jobs that were lost with it again.
+        """
+        self.executor.shutdown(wait=True)  # Once shut down, every job that didn't finish has failed.
+        self.executor = ProcessPoolExecutor(**self.options)
+        for ticket, future in self.futures.items():
+            if future.cancelled() or isinstance(future.exception(), BrokenProcessPool):
+                self.futures[ticket] = self.executor.submit(run_job, self.jobs[ticket])
+        for ticket in self.jobs.keys() - self.futures.keys():  # Submitted to the broken pool, but never in it.
+            self.futures[ticket] = self.executor.submit(run_job, self.jobs[ticket])
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def run_batch(jobs: Iterable[dict], workers: Optional[int]=None, ordered: bool=True, queue_depth: Optional[int]=None,
+              recursion_limit: int=100_000, cache_folder: Optional[str]=None) -> Iterator[dict]:
+    """
+    Run all jobs over a pool of the given amount of processes (by default, one per core), and yield their results.
+    At most queue_depth jobs (by default, four per worker) are in the pool at any time.
+    """
+    workers = workers or os.cpu_count()
+    queue_depth = queue_depth or 4*workers
+    jobs = iter(jobs)
+
+    pool = Pool(workers, recursion_limit, cache_folder)
+    try:
+        def submit() -> Optional[int]:
+            job = next(jobs, None)
+            return pool.submit(job) if job is not None else None
+
+        if ordered:
+            pending = deque()
+            while len(pending) < queue_depth and (ticket := submit()) is not None:
+                pending.append(ticket)
+            while pending:
+                result = pool.result(pending.popleft())
+                if (ticket := submit()) is not None:
+                    pending.append(ticket)
+                yield result
+        else:
+            while len(pool.jobs) < queue_depth and submit() is not None:
+                pass
+            while pool.jobs:
+                result = pool.result(pool.first_done())
+                submit()
+                yield result
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    arguments = argparse.ArgumentParser(description="Run a batch of programs over a pool of processes.")
+    arguments.add_argument("input", help="JSONL file with one program per line, or a folder with one program per file")
+    arguments.add_argument("--output", help="JSONL file to write the results to (standard output by default)")
+    arguments.add_argument("--workers", type=int, help="amount of processes (one per core by default)")
+    arguments.add_argument("--unordered", action="store_true", help="give results as soon as they are done")
+    arguments.add_argument("--queue-depth", type=int, help="most programs in the pool at once (4 per worker by default)")
+    arguments.add_argument("--cache", help="folder to cache parsed and typed programs in")
+    args = arguments.parse_args()
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    start = time.perf_counter()
+    count = 0
+    for result in run_batch(read_jobs(args.input), args.workers, not args.unordered, args.queue_depth,
+                            cache_folder=args.cache):
+        output.write(json.dumps(result) + "\n")
+        count += 1
+    if args.output:
+        output.close()
+    print(f"Ran {count} programs in {time.perf_counter() - start:.1f} seconds.", file=sys.stderr)
@@ -0,0 +1,359 @@
+"""
+A bytecode compiler and stack-based virtual machine for LETREC.
+
+The tree-walking interpreter uses a Python call for every node it visits and wraps every integer it computes in a new
+IntVal. Here, a program is first translated to its nameless form (see nameless.py), which is then compiled to a flat
+array of instructions. The machine runs those in a single loop, with an operand stack of plain Python ints, bools and
+closures, and a stack of return addresses for calls. Only the final result is wrapped in an expressed value again.
+
+Because nothing recurses on the Python stack, recursion in LETREC is only bounded by memory. Calls in tail position
+don't even grow the call stack.
+
+IMPLICIT-REFS programs (which is what the parser produces) are accepted too, as long as they don't use `set`: without
+it, putting every variable in its own store cell makes no difference to the result.
+"""
+from array import array
+from typing import List, Tuple
+
+from nameless import *
+
+###############
+### Opcodes ###
+###############
+HALT          = 0   #                      Stop; the result is on top of the stack.
+CONST         = 1   # constant index       Push a constant.
+LOAD          = 2   # depth, offset        Push a variable from a frame further out.
+LOAD0         = 3   # offset               Push a variable from the current frame.
+LOAD1         = 4   # offset               Push a variable from the frame around the current frame.
+BIND          = 5   # offset               Pop a value into the current frame.
+DIFF          = 6   #                      Pop two integers, push their difference.
+ZERO          = 7   #                      Pop an integer, push whether it is zero.
+JUMP          = 8   # target
+JUMP_IF_FALSE = 9   # target               Pop a boolean, and jump if it is false.
+CLOSURE       = 10  # code index           Push a procedure closing over the current frame.
+RECURSIVE     = 11  # code index, offset   Bind a procedure closing over the current frame in the current frame.
+CALL          = 12  #                      Pop an argument and a procedure, and call it.
+TAIL_CALL     = 13  #                      Same, but reuse the caller's return address.
+RETURN        = 14  #                      Return to the caller, leaving the result on the stack.
+
+OPNAMES = ["HALT", "CONST", "LOAD", "LOAD0", "LOAD1", "BIND", "DIFF", "ZERO", "JUMP", "JUMP_IF_FALSE",
+           "CLOSURE", "RECURSIVE", "CALL", "TAIL_CALL", "RETURN"]
+OPERANDS = [0, 1, 2, 1, 1, 1, 0, 0, 1, 1, 1, 2, 0, 0, 0]
+
+
+#################################
+### Code objects and closures ###
+#################################
+class CodeObject:
+    """
+    Where the instructions of a procedure body start, and how big a frame they need (not counting the link to the
+    frame around it, which is in slot 0).
+    """
+
+    def __init__(self, var: str, entry: int, frame_size: int):
+        self.var = var
+        self.entry = entry
+        self.frame_size = frame_size
+
+
+class Closure(ExpVal):
+
+    def __init__(self, code: CodeObject, frame: list):
+        self.code = code
+        self.frame = frame
+    def __repr__(self):
+        return f"Closure({self.code.var})"
+
+
+class Bytecode:
+
+    def __init__(self, instructions: array, constants: list, codes: List[CodeObject], frame_size: int):
+        self.instructions = instructions
+        self.constants = constants
+        self.codes = codes
+        self.frame_size = frame_size  # Of the outermost frame.
+
+
+################
+### Compiler ###
+################
+class BytecodeCompiler:
+
+    def __init__(self):
+        self.instructions = array("i")
+        self.constants = []
+        self.constant_indices = dict()
+        self.codes: List[CodeObject] = []
+        self.pending: List[Tuple[CodeObject, Expression]] = []  # Bodies that still have to be emitted.
+
+    def emit(self, *words: int) -> int:
+        """
+        Append an instruction and return the position of its last word, for patching jumps.
+        """
+        self.instructions.extend(words)
+        return len(self.instructions) - 1
+
+    def patch(self, position: int):
+        """
+        Make the jump whose target is at the given position jump to the next instruction that will be emitted.
+        """
+        self.instructions[position] = len(self.instructions)
+
+    def constant(self, value: int) -> int:
+        index = self.constant_indices.get(value)
+        if index is None:
+            index = len(self.constants)
+            self.constants.append(value)
+            self.constant_indices[value] = index
+        return index
+
+    def code(self, var: str, frame_size: int, body: Expression) -> int:
+        code = CodeObject(var, -1, frame_size)
+        self.codes.append(code)
+        self.pending.append((code, body))
+        return len(self.codes) - 1
+
+    def compile_program(self, exp: Expression, frame_size: int) -> Bytecode:
+        self.compile(exp, tail=False)
+        self.emit(HALT)
+        while self.pending:
+            code, body = self.pending.pop()
+            code.entry = len(self.instructions)
+            self.compile(body, tail=True)
+
+        return Bytecode(self.instructions, self.constants, self.codes, frame_size)
+
+    def compile(self, exp: Expression, tail: bool):
+        """
+        Emit code that leaves the value of the expression on the stack. In tail position, the code returns it instead.
+        """
+        if isinstance(exp, NamelessCallExp):
+            self.compile(exp.operator, tail=False)
+            self.compile(exp.operand, tail=False)
+            self.emit(TAIL_CALL if tail else CALL)
+            return  # A tail call has already returned.
+
+        elif isinstance(exp, IfExp):
+            self.compile(exp.cond_exp, tail=False)
+            to_false = self.emit(JUMP_IF_FALSE, -1)
+            self.compile(exp.true_exp, tail)
+            if tail:
+                self.patch(to_false)
+                self.compile(exp.false_exp, tail)
+            else:
+                to_end = self.emit(JUMP, -1)
+                self.patch(to_false)
+                self.compile(exp.false_exp, tail)
+                self.patch(to_end)
+            return  # Both branches have already returned in tail position.
+
+        elif isinstance(exp, NamelessLetExp):
+            self.compile(exp.val_exp, tail=False)
+            self.emit(BIND, exp.offset)
+            self.compile(exp.body_exp, tail)
+            return
+
+        elif isinstance(exp, NamelessLetrecExp):
+            self.emit(RECURSIVE, self.code(exp.procvar, exp.frame_size, exp.procbody), exp.offset)
+            self.compile(exp.letbody, tail)
+            return
+
+        elif isinstance(exp, ConstExp):
+            self.emit(CONST, self.constant(exp.const))
+        elif isinstance(exp, NamelessVarExp):
+            if exp.depth == 0:
+                self.emit(LOAD0, exp.offset)
+            elif exp.depth == 1:
+                self.emit(LOAD1, exp.offset)
+            else:
+                self.emit(LOAD, exp.depth, exp.offset)
+        elif isinstance(exp, NamelessProcExp):
+            self.emit(CLOSURE, self.code(exp.var, exp.frame_size, exp.body_exp))
+        elif isinstance(exp, DiffExp):
+            self.compile(exp.exp1, tail=False)
+            self.compile(exp.exp2, tail=False)
+            self.emit(DIFF)
+        elif isinstance(exp, IsZeroExp):
+            self.compile(exp.exp, tail=False)
+            self.emit(ZERO)
+        else:
+            raise ValueError(f"The bytecode compiler only supports LETREC, not {exp.__class__.__name__}.")
+
+        if tail:
+            self.emit(RETURN)
+
+
+def compile_bytecode(exp: Expression, names: List[str]=()) -> Bytecode:
+    """
+    Compile a program whose initial environment binds the given names, innermost first.
+    """
+    nameless_exp, frame_size = translate(exp, names)
+    return BytecodeCompiler().compile_program(nameless_exp, frame_size)
+
+
+#######################
+### Virtual machine ###
+#######################
+def cast_error(value, expected: type) -> TypeError:
+    """
+    The same error that ExpVal.cast would raise in the interpreter.
+    """
+    names = {int: IntVal.__name__, bool: BoolVal.__name__, Closure: ProcVal.__name__}
+    return TypeError(f"Tried to cast {names.get(value.__class__, value.__class__.__name__)} to {names[expected]}!")
+
+
+def run(bytecode: Bytecode, values: list=()):
+    """
+    Run the program with the given raw values (ints, bools, closures) for the names it was compiled with.
+
+    Frames are lists. Slot 0 holds the frame around it, and variable slots start at 1.
+    """
+    code = bytecode.instructions
+    constants = bytecode.constants
+    codes = bytecode.codes
+
+    frame = [None] * (bytecode.frame_size + 1)
+    frame[1:len(values)+1] = values
+    stack = []
+    calls = []  # Pairs of return address and frame, flattened.
+    push = stack.append
+    pop  = stack.pop
+
+    pc = 0
+    while True:
+        op = code[pc]
+        if op == LOAD0:
+            push(frame[code[pc+1] + 1])
+            pc += 2
+        elif op == LOAD1:
+            push(frame[0][code[pc+1] + 1])
+            pc += 2
+        elif op == CONST:
+            push(constants[code[pc+1]])
+            pc += 2
+        elif op == DIFF:
+            right = pop()
+            left  = pop()
+            if left.__class__ is not int:
+                raise cast_error(left, int)
+            if right.__class__ is not int:
+                raise cast_error(right, int)
+            push(left - right)
+            pc += 1
+        elif op == ZERO:
+            value = pop()
+            if value.__class__ is not int:
+                raise cast_error(value, int)
+            push(value == 0)
+            pc += 1
+        elif op == JUMP_IF_FALSE:
+            value = pop()
+            if value.__class__ is not bool:
+                raise cast_error(value, bool)
+            pc = pc + 2 if value else code[pc+1]
+        elif op == CALL or op == TAIL_CALL:
+            arg  = pop()
+            proc = pop()
+            if proc.__class__ is not Closure:
+                raise cast_error(proc, Closure)
+            if op == CALL:
+                calls.append(pc + 1)
+                calls.append(frame)
+            callee = proc.code
+            frame = [proc.frame] + [None] * callee.frame_size
+            frame[1] = arg
+            pc = callee.entry
+        elif op == RETURN:
+            frame = calls.pop()
+            pc    = calls.pop()
+        elif op == BIND:
+            frame[code[pc+1] + 1] = pop()
+            pc += 2
+        elif op == JUMP:
+            pc = code[pc+1]
+        elif op == LOAD:
+            target = frame
+            for _ in range(code[pc+1]):
+                target = target[0]
+            push(target[code[pc+2] + 1])
+            pc += 3
+        elif op == CLOSURE:
+            push(Closure(codes[code[pc+1]], frame))
+            pc += 2
+        elif op == RECURSIVE:
+            frame[code[pc+2] + 1] = Closure(codes[code[pc+1]], frame)
+            pc += 3
+        elif op == HALT:
+            return pop()
+        else:
+            raise RuntimeError(f"Unknown opcode {op} at {pc}.")
+
+
+def to_raw(val: ExpVal):
+    if isinstance(val, Reference):  # Initial environment of an IMPLICIT-REFS program.
+        val = the_store().load(val)
+    if isinstance(val, (IntVal, BoolVal)):
+        return val.value
+    raise ValueError(f"Cannot pass {val.__class__.__name__} to the bytecode machine.")
+
+
+def to_expval(raw) -> ExpVal:
+    """
+    Only integers and booleans can be handed back: a procedure made by compiled code has no body expression, so it
+    can't become a ProcVal that the interpreters could call.
+    """
+    if raw.__class__ is bool:
+        return BoolVal.of(raw)
+    elif raw.__class__ is int:
+        return IntVal.of(raw)
+    else:
+        raise ValueError(f"Cannot return a {raw.__class__.__name__} as an expressed value: programs that evaluate to a procedure can only be run by the interpreters.")
+
+
+def value_of_bytecode(exp: Expression, initenv: Environment) -> ExpVal:
+    """
+    Evaluator that can be given to Program.value_of_program.
+    """
+    names, values = unpack_environment(initenv)
+    return to_expval(run(compile_bytecode(exp, names), [to_raw(v) for v in values]))
+
+
+####################
+### Disassembler ###
+####################
+def disassemble(bytecode: Bytecode) -> str:
+    entries = {code.entry: (i, code) for i, code in enumerate(bytecode.codes)}
+
+    lines = [f"<program> (frame of {bytecode.frame_size})"]
+    pc = 0
+    code = bytecode.instructions
+    while pc < len(code):
+        if pc in entries:
+            i, entry = entries[pc]
+            lines.append(f"<code {i}: proc ({entry.var})> (frame of {entry.frame_size})")
+
+        op = code[pc]
+        operands = list(code[pc+1:pc+1+OPERANDS[op]])
+        line = f"{pc:>6}  {OPNAMES[op]:<14}" + " ".join(map(str, operands))
+        if op == CONST:
+            line += f"\t; {bytecode.constants[operands[0]]}"
+        elif op in (CLOSURE, RECURSIVE):
+            line += f"\t; proc ({bytecode.codes[operands[0]].var})"
+        lines.append(line)
+        pc += 1 + OPERANDS[op]
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from parser import stringToExpression
+
+    exp = stringToExpression("""
+    letrec ? foo (x: ?) = if zero?(x)
+        then 1
+        else -(x, (foo -(x,1)))
+    in (foo 100000)
+    """)
+    bytecode = compile_bytecode(exp)
+    print(disassemble(bytecode))
+    print(value_of_bytecode(exp, EmptyEnvironment()))
@@ -0,0 +1,302 @@
+"""
+An on-disk cache of parsed programs and their types, so a program that is submitted again skips lexing, parsing and
+type inference.
+
+Entries are keyed by a hash of the source text (and whether it is typed), so a changed program never gets a stale tree.
+A tree is stored as a flat list of nodes in preorder, each with the index of its class and its fields other than its
+subexpressions, serialised with marshal. This is smaller than a pickle, and neither writing nor reading it recurses, so
+trees of any depth can be stored.
+
+The folder is bounded in size: when it grows beyond its limit, the entries that were used longest ago are deleted.
+Every use of an entry updates its modification time, which is what "longest ago" is measured by. Entries are written
+to a temporary file that is then renamed into place, so processes that share the folder never see half an entry, and
+one that reads an entry while another evicts it just gets a miss.
+"""
+from inferred import *
+from typing import Any, Callable, Dict, Tuple
+import explicit_refs
+import hashlib
+import implicit_refs
+import inferred
+import letrec
+import marshal
+import os
+import tempfile
+
+from parser import stringToExpression, COLON
+from trees import slot_names
+
+FORMAT = 1  # Changes whenever the layout of entries does, so old entries are never read.
+CHILD = ...  # Stands for a field that is a subexpression; it follows later in the preorder.
+ANNOTATIONS = {"int": INT_TYPE, "bool": BOOL_TYPE}
+# The only classes an entry may name. Entries come from a folder that other processes write to, so a name in one is
+# never imported or looked up anywhere else.
+EXPRESSIONS = {f"{cls.__module__}.{cls.__qualname__}": cls
+               for module in (letrec, explicit_refs, implicit_refs, inferred) for cls in vars(module).values()
+               if isinstance(cls, type) and issubclass(cls, Expression) and cls.__module__ == module.__name__}
+
+
+#####################
+### Serialisation ###
+#####################
+def encode_field(value) -> Any:
+    if isinstance(value, Expression):
+        return CHILD
+    elif isinstance(value, list):
+        return ("list", len(value))  # Its elements follow in the preorder.
+    elif isinstance(value, BaseType):
+        return ("type", value.name)
+    elif isinstance(value, UnknownType):
+        return ("type", "?")
+    else:
+        return value
+
+
+def encode_tree(exp: Expression) -> Tuple[List[str], List[tuple]]:
+    """
+    The names of the classes in the tree, and one record (class index, fields ...) per node, in preorder.
+    """
+    classes: Dict[type, int] = dict()
+    records = []
+    todo = [exp]
+    while todo:
+        node = todo.pop()
+        cls = node.__class__
+        if cls not in classes:
+            classes[cls] = len(classes)
+        values = [getattr(node, name) for name in slot_names(cls)]
+        records.append((classes[cls], *map(encode_field, values)))
+
+        children = []
+        for value in values:
+            if isinstance(value, Expression):
+                children.append(value)
+            elif isinstance(value, list):
+                children.extend(value)
+        todo.extend(reversed(children))
+    return [f"{cls.__module__}.{cls.__qualname__}" for cls in classes], records
+
+
+def decode_tree(class_names: List[str], records: List[tuple]) -> Expression:
+    """
+    The tree encode_tree encoded. Raises a ValueError if the records don't make exactly one whole tree.
+    """
+    if any(name not in EXPRESSIONS for name in class_names):
+        raise ValueError(f"Not an expression class: {next(name for name in class_names if name not in EXPRESSIONS)}")
+    classes = [EXPRESSIONS[name] for name in class_names]
+    slots = [slot_names(cls) for cls in classes]
+
+    root = None
+    waiting = []  # (node or list, its fields that are still waiting for subexpressions), innermost last.
+    for record in records:
+        if root is not None and not waiting:
+            raise ValueError("Records after the end of the tree")
+        if not 0 <= record[0] < len(classes) or len(record) != 1 + len(slots[record[0]]):
+            raise ValueError(f"Malformed record: {record}")
+        cls = classes[record[0]]
+        node = cls.__new__(cls)
+        pending = []
+        for name, value in zip(slots[record[0]], record[1:]):
+            if value is CHILD:
+                pending.append(name)
+            elif isinstance(value, tuple) and value[0] == "list":
+                setattr(node, name, [])
+                pending.extend([(name,)] * value[1])  # One placeholder per element of the list.
+            elif isinstance(value, tuple) and value[0] == "type":
+                setattr(node, name, ANNOTATIONS[value[1]] if value[1] in ANNOTATIONS else UnknownType())
+            else:
+                setattr(node, name, value)
+
+        if waiting:
+            parent, fields_left = waiting[-1]
+            field = fields_left.pop(0)
+            if isinstance(field, tuple):
+                getattr(parent, field[0]).append(node)
+            else:
+                setattr(parent, field, node)
+            if not fields_left:
+                waiting.pop()
+        else:
+            root = node
+        if pending:
+            waiting.append((node, pending))
+    if root is None or waiting:
+        raise ValueError("The tree ends early")
+    return root
+
+
+def encode_type(t: Optional[Type]) -> Any:
+    if t is None:
+        return None
+    elif isinstance(t, ProcType):
+        return (encode_type(t.t1), encode_type(t.t2))
+    elif isinstance(t, TypeVariable):
+        return t.num
+    else:
+        return t.name
+
+
+def decode_type(encoded: Any) -> Optional[Type]:
+    if encoded is None:
+        return None
+    elif isinstance(encoded, tuple):
+        return ProcType(decode_type(encoded[0]), decode_type(encoded[1]))
+    elif isinstance(encoded, int):
+        return TypeVariable(encoded)
+    else:
+        return ANNOTATIONS[encoded]
+
+
+#############
+### Cache ###
+#############
+class FolderCache:
+    """
+    Entries in a folder, one file each, named by their key. Subclasses decide what the entries are and how they are
+    keyed, and share how they are written, read and evicted.
+    """
+
+    SUFFIX = ""  # Of the files of entries. Every subclass has its own, so caches of different kinds can share a folder.
+
+    def __init__(self, folder: str, max_bytes: int=256 * 2**20):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.name.endswith(self.SUFFIX))
+
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, key + self.SUFFIX)
+
+    def read(self, key: str, decode: Callable[[bytes], Any]) -> Any:
+        """
+        The entry with the given key, decoded, or None if there is none or it can't be decoded. Other processes write to
+        the folder too, so anything at all may be in a file, and whatever goes wrong while decoding it is just a miss.
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                entry = decode(file.read())
+            os.utime(path)  # Used just now.
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def write(self, key: str, data: bytes):
+        handle, temporary = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        with os.fdopen(handle, "wb") as file:
+            file.write(data)
+        os.replace(temporary, self.path(key))
+
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the entries that were used longest ago, until the folder is below three quarters of its limit.
+        """
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(self.SUFFIX):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # Evicted by another process.
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= 3*self.max_bytes // 4:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+class ASTCache(FolderCache):
+
+    SUFFIX = ".ast"
+
+    def key(self, source: str, typed: bool) -> str:
+        return hashlib.sha256(f"{FORMAT}{'T' if typed else 'U'}{source}".encode()).hexdigest()
+
+    @staticmethod
+    def decode(data: bytes) -> Tuple[Expression, Optional[Type]]:
+        class_names, records, encoded_type = marshal.loads(data)
+        return decode_tree(class_names, records), decode_type(encoded_type)
+
+    def get(self, source: str, typed: bool) -> Optional[Tuple[Expression, Optional[Type]]]:
+        return self.read(self.key(source, typed), self.decode)
+
+    def put(self, source: str, typed: bool, exp: Expression, program_type: Optional[Type]=None):
+        self.write(self.key(source, typed), marshal.dumps((*encode_tree(exp), encode_type(program_type))))
+
+    def load(self, source: str, context: Context=None) -> Tuple[Expression, Optional[Type]]:
+        """
+        The parsed program and, if it is typed, its type. From the cache if possible, else parsed, typed and cached.
+        """
+        typed = getattr(context, "typed", None)
+        if typed is None:
+            typed = COLON in source
+
+        cached = self.get(source, typed)
+        if cached is not None:
+            return cached
+
+        fresh = Context(typed=typed)  # Not the caller's, so the cached type doesn't depend on what else it was used for.
+        exp = stringToExpression(source, fresh)
+        program_type = type_of_program(exp, context=fresh) if typed else None
+        self.put(source, typed, exp, program_type)
+        return exp, program_type
+
+
+if __name__ == "__main__":
+    from generator import generateProgram
+    import pickle
+    import sys
+    import time
+
+    sys.setrecursionlimit(100_000)
+    source = generateProgram(100_000, seed=1, typed=True)
+    with tempfile.TemporaryDirectory() as folder:
+        cache = ASTCache(folder)
+
+        start = time.perf_counter()
+        exp, program_type = cache.load(source)
+        print(f"Miss: {time.perf_counter() - start:.2f} seconds")
+        start = time.perf_counter()
+        cached_exp, cached_type = cache.load(source)
+        print(f"Hit:  {time.perf_counter() - start:.2f} seconds")
+
+        assert encode_tree(exp) == encode_tree(cached_exp) and encode_type(program_type) == encode_type(cached_type)
+        assert Program(exp, EmptyEnvironment()).value_of_program().value == Program(cached_exp, EmptyEnvironment()).value_of_program().value
+        print(f"Entry: {cache.size / 2**20:.2f} MiB, as a pickle: {len(pickle.dumps(exp)) / 2**20:.2f} MiB, source: {len(source) / 2**20:.2f} MiB")
+
+        # Entries that other processes may have left are misses, not errors or broken trees.
+        small = "let x = 1 in -(x, 2)"
+        cache.load(small)
+        class_names, records, encoded_type = marshal.loads(open(cache.path(cache.key(small, False)), "rb").read())
+        corrupt = {"Not an expression class": (["os.system"], records, encoded_type),
+                   "Missing class": (class_names, [(len(class_names), *records[0][1:])] + records[1:], encoded_type),
+                   "Cut short": (class_names, records[:1], encoded_type),
+                   "Not even marshal": None}
+        for problem, entry in corrupt.items():
+            cache.write(cache.key(small, False), b"\xff" if entry is None else marshal.dumps(entry))
+            misses = cache.misses
+            assert cache.get(small, False) is None and cache.misses == misses + 1, problem
+        print(f"Corrupt entries are misses: {', '.join(corrupt)}")
+
+        # The type of a cached program doesn't depend on what the caller's context was used for before.
+        generic = "proc (f: ?) proc (x: ?) (f x)"
+        used = Context(typed=True)
+        type_of_program(stringToExpression(generic, used), context=used)
+        with tempfile.TemporaryDirectory() as other:
+            assert encode_type(ASTCache(other).load(generic, used)[1]) == encode_type(cache.load(generic)[1])
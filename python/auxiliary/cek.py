@@ -0,0 +1,439 @@
+"""
+A CEK machine for LETREC, EXPLICIT-REFS and IMPLICIT-REFS (chapter 5 of the book, but registerized and trampolined).
+
+The interpreters recurse on the Python stack for every subexpression and every procedure call, so a loop of a few
+thousand iterations already hits Python's recursion limit. This machine instead keeps its whole state in four
+registers: the Control (the expression being evaluated), the Environment, the Kontinuation (what to do with its value,
+as a linked list of frames on the heap), and the value being passed to that continuation. One step never calls the
+next, so the Python stack stays at constant depth no matter how deep the program recurses.
+
+A procedure call in tail position passes its own continuation on to the body, so iterating with tail calls takes
+constant memory too (except for what the program puts in the store).
+
+The machine walks the same expression trees and environments as the interpreters, and produces the same values.
+"""
+from explicit_refs import *
+from typing import Callable, Dict, List, Optional
+import letrec
+import implicit_refs
+
+
+#####################
+### Continuations ###
+#####################
+class Continuation(ABC):
+
+    @abstractmethod
+    def apply(self, machine: "CEKMachine"):
+        """
+        Pass the machine's value register to this continuation, and set up the registers for the next step.
+        """
+        pass
+
+
+class EndCont(Continuation):
+
+    def apply(self, machine: "CEKMachine"):
+        raise RuntimeError("The end continuation is never applied; the machine stops at it.")
+
+
+class Diff1Cont(Continuation):
+
+    def __init__(self, exp2: Expression, env: Environment, cont: Continuation):
+        self.exp2 = exp2
+        self.env = env
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.cont = Diff2Cont(IntVal.cast(machine.val), self.cont)
+        machine.exp = self.exp2
+        machine.env = self.env
+
+
+class Diff2Cont(Continuation):
+
+    def __init__(self, val1: IntVal, cont: Continuation):
+        self.val1 = val1
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.val = IntVal.of(self.val1.value - IntVal.cast(machine.val).value)
+        machine.cont = self.cont
+
+
+class ZeroCont(Continuation):
+
+    def __init__(self, cont: Continuation):
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.val = BoolVal.of(IntVal.cast(machine.val).value == 0)
+        machine.cont = self.cont
+
+
+class IfCont(Continuation):
+
+    def __init__(self, true_exp: Expression, false_exp: Expression, env: Environment, cont: Continuation):
+        self.true_exp = true_exp
+        self.false_exp = false_exp
+        self.env = env
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.exp = self.true_exp if BoolVal.cast(machine.val).value else self.false_exp
+        machine.env = self.env
+        machine.cont = self.cont
+
+
+class LetCont(Continuation):
+
+    def __init__(self, var: str, body_exp: Expression, env: Environment, cont: Continuation):
+        self.var = var
+        self.body_exp = body_exp
+        self.env = env
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.exp = self.body_exp
+        machine.env = ExtendEnvironment(self.var, machine.val, self.env)
+        machine.cont = self.cont
+
+
+class RatorCont(Continuation):
+
+    def __init__(self, operand: Expression, env: Environment, cont: Continuation):
+        self.operand = operand
+        self.env = env
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.cont = RandCont(ProcVal.cast(machine.val), self.cont)
+        machine.exp = self.operand
+        machine.env = self.env
+
+
+class RandCont(Continuation):
+    """
+    Applying the procedure. The body gets the continuation of the call itself, which is what makes tail calls free.
+    """
+
+    def __init__(self, proc: ProcVal, cont: Continuation):
+        self.proc = proc
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.exp = self.proc.body
+        machine.env = ExtendEnvironment(self.proc.var, machine.val, self.proc.closed_env)
+        machine.cont = self.cont
+
+
+# EXPLICIT-REFS
+class BeginCont(Continuation):
+
+    def __init__(self, exps: List[Expression], index: int, env: Environment, cont: Continuation):
+        self.exps = exps
+        self.index = index  # Of the next expression to evaluate.
+        self.env = env
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        if self.index == len(self.exps) - 1:
+            machine.cont = self.cont
+        else:
+            machine.cont = BeginCont(self.exps, self.index + 1, self.env, self.cont)
+        machine.exp = self.exps[self.index]
+        machine.env = self.env
+
+
+class NewrefCont(Continuation):
+
+    def __init__(self, cont: Continuation):
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.val = machine.store.store(machine.store.new(), machine.val)
+        machine.cont = self.cont
+
+
+class Setref1Cont(Continuation):
+
+    def __init__(self, val_exp: Expression, env: Environment, cont: Continuation):
+        self.val_exp = val_exp
+        self.env = env
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.cont = Setref2Cont(Reference.cast(machine.val), self.cont)
+        machine.exp = self.val_exp
+        machine.env = self.env
+
+
+class Setref2Cont(Continuation):
+
+    def __init__(self, ref: Reference, cont: Continuation):
+        self.ref = ref
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.store.store(self.ref, machine.val)
+        machine.val = IntVal(-1_000_001)
+        machine.cont = self.cont
+
+
+class DerefCont(Continuation):
+
+    def __init__(self, cont: Continuation):
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.val = machine.store.load(Reference.cast(machine.val))
+        machine.cont = self.cont
+
+
+# IMPLICIT-REFS
+class LetContImplicit(LetCont):
+
+    def apply(self, machine: "CEKMachine"):
+        machine.exp = self.body_exp
+        machine.env = ExtendEnvironment(self.var, machine.store.store(machine.store.new(), machine.val), self.env)
+        machine.cont = self.cont
+
+
+class RatorContImplicit(RatorCont):
+
+    def apply(self, machine: "CEKMachine"):
+        machine.cont = RandContImplicit(ProcVal.cast(machine.val), self.cont)
+        machine.exp = self.operand
+        machine.env = self.env
+
+
+class RandContImplicit(RandCont):
+
+    def apply(self, machine: "CEKMachine"):
+        machine.exp = self.proc.body
+        machine.env = ExtendEnvironment(self.proc.var, machine.store.store(machine.store.new(), machine.val), self.proc.closed_env)
+        machine.cont = self.cont
+
+
+class SetCont(Continuation):
+
+    def __init__(self, var: str, env: Environment, cont: Continuation):
+        self.var = var
+        self.env = env
+        self.cont = cont
+
+    def apply(self, machine: "CEKMachine"):
+        machine.store.store(lookup(self.env, self.var), machine.val)
+        machine.val = IntVal(-1_000_002)
+        machine.cont = self.cont
+
+
+###############
+### Machine ###
+###############
+def lookup(env: Environment, var: str) -> DenVal:
+    """
+    Environment.lookup without recursion, which would otherwise still grow the Python stack with the environment.
+    """
+    while True:
+        if env.__class__ is ExtendEnvironment:
+            if env.var == var:
+                return env.val
+        elif env.__class__ is letrec.EnvlessProcEnvironment or env.__class__ is implicit_refs.EnvlessProcEnvironment:
+            if env.lookupvar == var:  # An EnvlessProcEnvironment knows its own value.
+                return env.lookup(var)
+        else:  # The empty environment, or one this loop doesn't know how to walk.
+            return env.lookup(var)
+        env = env.tail
+
+
+class CEKMachine:
+
+    def __init__(self):
+        self.exp: Optional[Expression] = None  # None when the value register holds a value to pass to the continuation.
+        self.env: Optional[Environment] = None
+        self.cont: Optional[Continuation] = None
+        self.val: Optional[ExpVal] = None
+        self.steps = 0
+        self.store: Optional[Store] = None  # That of the context the machine runs in.
+
+    def run(self, exp: Expression, env: Environment) -> ExpVal:
+        self.exp = exp
+        self.env = env
+        self.cont = EndCont()
+        self.val = None
+        self.store = the_store()
+
+        self.store.roots.append(self.registers)  # Everything the program can still reach is in the registers.
+        try:
+            steps = 0
+            while True:
+                steps += 1
+                exp = self.exp
+                if exp is not None:
+                    step = STEPS.get(exp.__class__) or find_step(exp.__class__)
+                    step(self, exp)
+                elif self.cont.__class__ is EndCont:
+                    self.steps += steps
+                    return self.val
+                else:
+                    self.cont.apply(self)
+        finally:
+            self.store.roots.remove(self.registers)
+
+    def registers(self) -> tuple:
+        """
+        Roots for the garbage collector. Every step allocates before it overwrites a register, so what a step is still
+        working with is always reachable from here.
+        """
+        return self.env, self.cont, self.val
+
+    def give(self, val: ExpVal):
+        self.val = val
+        self.exp = None
+
+
+##################
+### Eval steps ###
+##################
+# Each step either puts a value in the value register, or sets up the registers to evaluate a subexpression.
+def step_const(m: CEKMachine, exp: ConstExp):
+    m.give(IntVal.of(exp.const))
+
+def step_var(m: CEKMachine, exp: VarExp):
+    m.give(lookup(m.env, exp.var))
+
+def step_var_implicit(m: CEKMachine, exp: implicit_refs.VarExp):
+    m.give(m.store.load(lookup(m.env, exp.var)))
+
+def step_proc(m: CEKMachine, exp: ProcExp):
+    m.give(ProcVal(exp.var, exp.body_exp, m.env))
+
+def step_diff(m: CEKMachine, exp: DiffExp):
+    m.cont = Diff1Cont(exp.exp2, m.env, m.cont)
+    m.exp = exp.exp1
+
+def step_zero(m: CEKMachine, exp: IsZeroExp):
+    m.cont = ZeroCont(m.cont)
+    m.exp = exp.exp
+
+def step_if(m: CEKMachine, exp: IfExp):
+    m.cont = IfCont(exp.true_exp, exp.false_exp, m.env, m.cont)
+    m.exp = exp.cond_exp
+
+def step_let(m: CEKMachine, exp: LetExp):
+    m.cont = LetCont(exp.var, exp.body_exp, m.env, m.cont)
+    m.exp = exp.val_exp
+
+def step_let_implicit(m: CEKMachine, exp: implicit_refs.LetExp):
+    m.cont = LetContImplicit(exp.var, exp.body_exp, m.env, m.cont)
+    m.exp = exp.val_exp
+
+def step_letrec(m: CEKMachine, exp: LetrecExp):
+    m.env = letrec.EnvlessProcEnvironment(exp.procname, exp.procvar, exp.procbody, m.env)
+    m.exp = exp.letbody
+
+def step_letrec_implicit(m: CEKMachine, exp: implicit_refs.LetrecExp):
+    m.env = implicit_refs.EnvlessProcEnvironment(exp.procname, exp.procvar, exp.procbody, m.env)
+    m.exp = exp.letbody
+
+def step_call(m: CEKMachine, exp: CallExp):
+    m.cont = RatorCont(exp.operand, m.env, m.cont)
+    m.exp = exp.operator
+
+def step_call_implicit(m: CEKMachine, exp: implicit_refs.CallExp):
+    m.cont = RatorContImplicit(exp.operand, m.env, m.cont)
+    m.exp = exp.operator
+
+def step_set(m: CEKMachine, exp: implicit_refs.SetExp):
+    m.cont = SetCont(exp.var, m.env, m.cont)
+    m.exp = exp.value_exp
+
+def step_begin(m: CEKMachine, exp: BeginExp):
+    if not exp.exps:
+        m.give(IntVal(-1_000_000))
+    else:
+        m.cont = BeginCont(exp.exps, 0, m.env, m.cont)
+        m.cont.apply(m)
+
+def step_newref(m: CEKMachine, exp: NewrefExp):
+    m.cont = NewrefCont(m.cont)
+    m.exp = exp.init_exp
+
+def step_setref(m: CEKMachine, exp: SetrefExp):
+    m.cont = Setref1Cont(exp.val_exp, m.env, m.cont)
+    m.exp = exp.ref_exp
+
+def step_deref(m: CEKMachine, exp: DerefExp):
+    m.cont = DerefCont(m.cont)
+    m.exp = exp.ref_exp
+
+
+STEPS: Dict[type, Callable[[CEKMachine, Expression], None]] = {
+    ConstExp: step_const,
+    letrec.VarExp: step_var,
+    implicit_refs.VarExp: step_var_implicit,
+    ProcExp: step_proc,
+    DiffExp: step_diff,
+    IsZeroExp: step_zero,
+    IfExp: step_if,
+    letrec.LetExp: step_let,
+    implicit_refs.LetExp: step_let_implicit,
+    letrec.LetrecExp: step_letrec,
+    implicit_refs.LetrecExp: step_letrec_implicit,
+    letrec.CallExp: step_call,
+    implicit_refs.CallExp: step_call_implicit,
+    implicit_refs.SetExp: step_set,
+    BeginExp: step_begin,
+    NewrefExp: step_newref,
+    SetrefExp: step_setref,
+    DerefExp: step_deref,
+}
+
+
+def find_step(cls: type) -> Callable[[CEKMachine, Expression], None]:
+    """
+    Subclasses (like the ones in INFERRED) are evaluated like the class they inherit from.
+    """
+    for base in cls.__mro__:
+        if base in STEPS:
+            STEPS[cls] = STEPS[base]
+            return STEPS[cls]
+    raise ValueError(f"The CEK machine cannot evaluate {cls.__name__}.")
+
+
+def value_of_cek(exp: Expression, initenv: Environment) -> ExpVal:
+    """
+    Evaluator that can be given to Program.value_of_program.
+    """
+    return CEKMachine().run(exp, initenv)
+
+
+if __name__ == "__main__":
+    from parser import stringToExpression
+    import time
+
+    # Neither of these fits on the Python stack.
+    exp = stringToExpression("""
+    letrec ? foo (x: ?) = if zero?(x)
+        then 1
+        else -(x, (foo -(x,1)))
+    in (foo 100000)
+    """)
+    print(Program(exp, EmptyEnvironment()).value_of_program(value_of_cek))
+
+    exp = stringToExpression("""
+    letrec loop (n) = if zero?(n) then 0 else (loop -(n,1))
+    in (loop 200000)
+    """)
+    machine = CEKMachine()
+    start = time.perf_counter()
+    print(machine.run(exp, EmptyEnvironment()), f"after {machine.steps} steps in {time.perf_counter() - start:.1f} seconds")
+
+    # With a collector, the store stays as small as what the loop keeps alive.
+    print(f"Collected {THE_STORE.collect()} cells left behind by the runs above.")
+    THE_STORE.gc_threshold = 10_000
+    size = THE_STORE.cursor
+    start = time.perf_counter()
+    print(CEKMachine().run(exp, EmptyEnvironment()), f"in {time.perf_counter() - start:.1f} seconds, growing the store by {THE_STORE.cursor - size} cells")
+    print(THE_STORE.stats)
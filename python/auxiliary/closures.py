@@ -0,0 +1,313 @@
+"""
+Closure compilation for LETREC, EXPLICIT-REFS and IMPLICIT-REFS.
+
+Instead of walking the tree and dispatching on value_of every time a node is visited, the tree is compiled once into a
+tree of Python closures, each of which has its subexpressions and fields already bound. Running the program is then
+just calling the outermost closure with the initial environment.
+
+The closures run in the same environments and produce the same values (ProcVal included) as the interpreters, so
+compiled code and interpreted code can call each other's procedures. The only difference is that a variable is found
+by following a fixed number of tails, because the shape of the environment at every node is known while compiling:
+every let, procedure call and letrec adds exactly one frame. Names beyond the compiled program (in the initial
+environment) are still looked up by name.
+"""
+from explicit_refs import *
+from typing import Callable, Dict, Optional, Tuple
+import letrec
+import implicit_refs
+
+Code = Callable[[Environment], ExpVal]
+
+
+class Scope:
+    """
+    Compile-time image of an environment: which name each frame binds, and whether that frame is an
+    EnvlessProcEnvironment (whose value has to be looked up) rather than an ExtendEnvironment (whose value is its val).
+    """
+
+    def __init__(self, var: str, recursive: bool, tail: Optional["Scope"]):
+        self.var = var
+        self.recursive = recursive
+        self.tail = tail
+
+
+class ClosureCompiler:
+
+    def __init__(self):
+        self.bodies: Dict[Expression, Code] = dict()  # Compiled body of every procedure, by its body expression.
+
+    def compile_program(self, exp: Expression) -> Code:
+        return self.compile(exp, None)
+
+    def compile_body(self, proc: ProcVal) -> Code:
+        """
+        Compiled body of a procedure that wasn't created by compiled code (e.g. it came from the initial environment).
+        Only its argument is known statically; everything else is looked up by name.
+        """
+        code = self.bodies.get(proc.body)
+        if code is None:
+            code = self.compile(proc.body, Scope(proc.var, False, None))
+            self.bodies[proc.body] = code
+        return code
+
+    def compile(self, exp: Expression, scope: Optional[Scope]) -> Code:
+        if isinstance(exp, ConstExp):
+            return self.compile_const(exp)
+        elif isinstance(exp, (letrec.VarExp, implicit_refs.VarExp)):
+            return self.compile_var(exp, scope)
+        elif isinstance(exp, ProcExp):
+            return self.compile_proc(exp, scope)
+        elif isinstance(exp, DiffExp):
+            return self.compile_diff(exp, scope)
+        elif isinstance(exp, IsZeroExp):
+            return self.compile_zero(exp, scope)
+        elif isinstance(exp, IfExp):
+            return self.compile_if(exp, scope)
+        elif isinstance(exp, (letrec.LetExp, implicit_refs.LetExp)):
+            return self.compile_let(exp, scope)
+        elif isinstance(exp, (letrec.LetrecExp, implicit_refs.LetrecExp)):
+            return self.compile_letrec(exp, scope)
+        elif isinstance(exp, (letrec.CallExp, implicit_refs.CallExp)):
+            return self.compile_call(exp, scope)
+        elif isinstance(exp, implicit_refs.SetExp):
+            return self.compile_set(exp, scope)
+        elif isinstance(exp, BeginExp):
+            return self.compile_begin(exp, scope)
+        elif isinstance(exp, NewrefExp):
+            return self.compile_newref(exp, scope)
+        elif isinstance(exp, SetrefExp):
+            return self.compile_setref(exp, scope)
+        elif isinstance(exp, DerefExp):
+            return self.compile_deref(exp, scope)
+        else:
+            raise ValueError(f"Cannot compile {exp.__class__.__name__}.")
+
+    ### Variables ###
+    @staticmethod
+    def find(var: str, scope: Optional[Scope]) -> Tuple[int, Optional[Scope]]:
+        """
+        How many tails to follow to get to the frame binding the variable, and what that frame looks like.
+        """
+        depth = 0
+        while scope is not None and scope.var != var:
+            scope = scope.tail
+            depth += 1
+        return depth, scope
+
+    def compile_lookup(self, var: str, scope: Optional[Scope]) -> Code:
+        """
+        Code that finds the denoted value of the given variable.
+        """
+        depth, scope = self.find(var, scope)
+        if scope is None or scope.recursive:  # Unknown frame, or one whose value has to be looked up.
+            def lookup(env):
+                for _ in range(depth):
+                    env = env.tail
+                return env.lookup(var)
+        elif depth == 0:
+            def lookup(env):
+                return env.val
+        elif depth == 1:
+            def lookup(env):
+                return env.tail.val
+        else:
+            def lookup(env):
+                for _ in range(depth):
+                    env = env.tail
+                return env.val
+        return lookup
+
+    def compile_var(self, exp: VarExp, scope: Optional[Scope]) -> Code:
+        lookup = self.compile_lookup(exp.var, scope)
+        if not isinstance(exp, implicit_refs.VarExp):
+            return lookup
+
+        # In IMPLICIT-REFS, the load is fused into the most common lookups to save a call.
+        depth, scope = self.find(exp.var, scope)
+        if scope is not None and not scope.recursive and depth == 0:
+            def var_exp(env):
+                return the_store().load(env.val)
+        elif scope is not None and not scope.recursive and depth == 1:
+            def var_exp(env):
+                return the_store().load(env.tail.val)
+        else:
+            def var_exp(env):
+                return the_store().load(lookup(env))
+        return var_exp
+
+    def compile_set(self, exp: implicit_refs.SetExp, scope: Optional[Scope]) -> Code:
+        lookup = self.compile_lookup(exp.var, scope)
+        value  = self.compile(exp.value_exp, scope)
+
+        def set_exp(env):
+            the_store().store(lookup(env), value(env))
+            return IntVal(-1_000_002)
+        return set_exp
+
+    ### Integers and booleans ###
+    def compile_const(self, exp: ConstExp) -> Code:
+        val = IntVal(exp.const)  # Values are never modified, so one suffices.
+
+        def const_exp(env):
+            return val
+        return const_exp
+
+    def compile_diff(self, exp: DiffExp, scope: Optional[Scope]) -> Code:
+        exp1 = self.compile(exp.exp1, scope)
+        exp2 = self.compile(exp.exp2, scope)
+
+        def diff_exp(env):
+            val1 = exp1(env)
+            if val1.__class__ is not IntVal:
+                IntVal.cast(val1)
+            val2 = exp2(env)
+            if val2.__class__ is not IntVal:
+                IntVal.cast(val2)
+            return IntVal.of(val1.value - val2.value)
+        return diff_exp
+
+    def compile_zero(self, exp: IsZeroExp, scope: Optional[Scope]) -> Code:
+        tested = self.compile(exp.exp, scope)
+
+        def zero_exp(env):
+            val = tested(env)
+            if val.__class__ is not IntVal:
+                IntVal.cast(val)
+            return BoolVal.of(val.value == 0)
+        return zero_exp
+
+    def compile_if(self, exp: IfExp, scope: Optional[Scope]) -> Code:
+        cond  = self.compile(exp.cond_exp, scope)
+        true  = self.compile(exp.true_exp, scope)
+        false = self.compile(exp.false_exp, scope)
+
+        def if_exp(env):
+            val = cond(env)
+            if val.__class__ is not BoolVal:
+                BoolVal.cast(val)
+            if val.value:
+                return true(env)
+            else:
+                return false(env)
+        return if_exp
+
+    ### Bindings ###
+    def compile_let(self, exp: LetExp, scope: Optional[Scope]) -> Code:
+        var  = exp.var
+        val  = self.compile(exp.val_exp, scope)
+        body = self.compile(exp.body_exp, Scope(var, False, scope))
+
+        if isinstance(exp, implicit_refs.LetExp):
+            def let_exp(env):
+                store = the_store()
+                return body(ExtendEnvironment(var, store.store(store.new(), val(env)), env))
+        else:
+            def let_exp(env):
+                return body(ExtendEnvironment(var, val(env), env))
+        return let_exp
+
+    def compile_letrec(self, exp: LetrecExp, scope: Optional[Scope]) -> Code:
+        procname, procvar, procbody = exp.procname, exp.procvar, exp.procbody
+        Envless = implicit_refs.EnvlessProcEnvironment if isinstance(exp, implicit_refs.LetrecExp) else letrec.EnvlessProcEnvironment
+
+        scope = Scope(procname, True, scope)
+        self.bodies[procbody] = self.compile(procbody, Scope(procvar, False, scope))
+        letbody = self.compile(exp.letbody, scope)
+
+        def letrec_exp(env):
+            return letbody(Envless(procname, procvar, procbody, env))
+        return letrec_exp
+
+    ### Procedures ###
+    def compile_proc(self, exp: ProcExp, scope: Optional[Scope]) -> Code:
+        var, body = exp.var, exp.body_exp
+        self.bodies[body] = self.compile(body, Scope(var, False, scope))
+
+        def proc_exp(env):
+            return ProcVal(var, body, env)
+        return proc_exp
+
+    def compile_call(self, exp: CallExp, scope: Optional[Scope]) -> Code:
+        operator = self.compile(exp.operator, scope)
+        operand  = self.compile(exp.operand, scope)
+        bodies = self.bodies
+
+        if isinstance(exp, implicit_refs.CallExp):
+            def call_exp(env):
+                proc = operator(env)
+                if proc.__class__ is not ProcVal:
+                    ProcVal.cast(proc)
+                arg = operand(env)
+                body = bodies.get(proc.body) or self.compile_body(proc)
+                store = the_store()
+                return body(ExtendEnvironment(proc.var, store.store(store.new(), arg), proc.closed_env))
+        else:
+            def call_exp(env):
+                proc = operator(env)
+                if proc.__class__ is not ProcVal:
+                    ProcVal.cast(proc)
+                arg = operand(env)
+                body = bodies.get(proc.body) or self.compile_body(proc)
+                return body(ExtendEnvironment(proc.var, arg, proc.closed_env))
+        return call_exp
+
+    ### Store ###
+    def compile_begin(self, exp: BeginExp, scope: Optional[Scope]) -> Code:
+        exps = [self.compile(e, scope) for e in exp.exps]
+
+        def begin_exp(env):
+            result = IntVal(-1_000_000)
+            for e in exps:
+                result = e(env)
+            return result
+        return begin_exp
+
+    def compile_newref(self, exp: NewrefExp, scope: Optional[Scope]) -> Code:
+        init = self.compile(exp.init_exp, scope)
+
+        def newref_exp(env):
+            store = the_store()
+            return store.store(store.new(), init(env))
+        return newref_exp
+
+    def compile_setref(self, exp: SetrefExp, scope: Optional[Scope]) -> Code:
+        ref = self.compile(exp.ref_exp, scope)
+        val = self.compile(exp.val_exp, scope)
+
+        def setref_exp(env):
+            the_store().store(Reference.cast(ref(env)), val(env))
+            return IntVal(-1_000_001)
+        return setref_exp
+
+    def compile_deref(self, exp: DerefExp, scope: Optional[Scope]) -> Code:
+        ref = self.compile(exp.ref_exp, scope)
+
+        def deref_exp(env):
+            return the_store().load(Reference.cast(ref(env)))
+        return deref_exp
+
+
+def compile_program(exp: Expression) -> Code:
+    """
+    Compile once, then call the result with an initial environment as many times as needed.
+    """
+    return ClosureCompiler().compile_program(exp)
+
+
+def value_of_compiled(exp: Expression, initenv: Environment) -> ExpVal:
+    """
+    Evaluator that can be given to Program.value_of_program. Compiles every time; use compile_program to compile once.
+    """
+    return compile_program(exp)(initenv)
+
+
+if __name__ == "__main__":
+    for language in [letrec, implicit_refs]:
+        prog = Program(
+            language.LetExp("y", ConstExp(74),
+                   language.LetExp("p", ProcExp("x", DiffExp(language.VarExp("y"), language.VarExp("x"))),
+                          language.CallExp(language.VarExp("p"), ConstExp(5)))
+                   ),
+            EmptyEnvironment()
+        )
+        print(IntVal.cast(prog.value_of_program()).value, IntVal.cast(prog.value_of_program(value_of_compiled)).value)
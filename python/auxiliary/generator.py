@@ -0,0 +1,294 @@
+"""
+A random program generator for LETREC and INFERRED, for programs far bigger than anyone would write by hand.
+
+Programs are generated to a target amount of nodes (Expression objects, once parsed) and a maximum nesting depth, from
+a seed, so the same arguments always give the same program. The source text is written out while it is generated, so a
+program never has to be held in memory as a whole. What is written can be read back with stringToExpression or
+fileToExpression.
+
+Well-typed programs only use three types (int, bool and int -> int) and are int as a whole. They also always finish,
+and in about as many steps as they have nodes:
+    - Every procedure that is bound to a variable is called at most once. This is what keeps procedures that call
+      procedures from making the run exponentially long.
+    - A recursive procedure is a countdown: `letrec f (x) = if zero?(x) then ... else (f -(x,1))`, and it is only ever
+      called on a small constant.
+Without that guarantee, every subexpression gets a random type, so the program is syntactically valid, but will mostly
+fail to type-check and to run.
+"""
+from io import StringIO
+from random import Random
+from typing import List, Optional, TextIO, Tuple
+
+INT  = "int"
+BOOL = "bool"
+PROC = "int -> int"
+REC  = "recursive int -> int"  # Can only be called on a small constant.
+
+TYPES = [INT, BOOL, PROC]
+MIN_NODES = {INT: 1, BOOL: 2, PROC: 2}  # zero?(0) and proc (x) x.
+LETREC_NODES = 9  # letrec, if, zero?, x, call, f, -, x, 1 (besides the base case and the body).
+
+Scope = Tuple[Tuple[str, str], ...]  # The (name, type) of every variable in scope, innermost last.
+
+
+def fits(type: str, nodes: int) -> bool:
+    """
+    Whether an expression of the given type can have exactly the given amount of nodes. No int expression has 2 nodes,
+    so neither does zero? or proc around one.
+    """
+    return nodes >= MIN_NODES[type] and nodes - (type != INT) != 2
+
+
+class ProgramGenerator:
+
+    def __init__(self, seed: int=0, typed: bool=False, well_typed: bool=True, max_depth: int=64,
+                 out: TextIO=None, buffer_size: int=1 << 16):
+        """
+        :param typed: whether to write INFERRED's type annotations.
+        :param well_typed: whether the program has to type-check (and finish).
+        :param out: where the source text goes. Text is buffered up to the given amount of characters.
+        """
+        self.random = Random(seed)
+        self.typed = typed
+        self.well_typed = well_typed
+        self.max_depth = max_depth
+        self.out = out if out is not None else StringIO()
+        self.buffer: List[str] = []
+        self.buffered = 0
+        self.buffer_size = buffer_size
+
+        self.names = 0
+        self.called = set()  # Procedures that can't be called anymore.
+
+    def generate(self, nodes: int) -> int:
+        """
+        Write a program with about the given amount of nodes, and return how many it really has. That is the target,
+        unless the maximum depth doesn't allow for that many, or the target is too small for a bool subexpression.
+        """
+        used = self.expression(INT, max(nodes, 1), 0, ())
+        self.flush()
+        return used
+
+    ### Output ###
+    def emit(self, text: str):
+        self.buffer.append(text)
+        self.buffered += len(text) + 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.out.write(" ".join(self.buffer))
+        self.out.write("\n")
+        self.buffer = []
+        self.buffered = 0
+
+    def fresh(self) -> str:
+        self.names += 1
+        return f"v{self.names}"
+
+    def annotation(self, type: str) -> str:
+        return f": {type}" if self.typed else ""
+
+    ### Budget ###
+    def split(self, nodes: int, types: List[str]) -> Optional[List[int]]:
+        """
+        Divide nodes among subexpressions of the given types, randomly but not too unevenly, so that the depth of the
+        program grows with the logarithm of its size. None if no subexpressions of these types have that many nodes.
+        """
+        minimums = [MIN_NODES[type] for type in types]
+        extra = nodes - sum(minimums)
+        if extra < 0:
+            return None
+        weights = [0.5 + self.random.random() for _ in types]
+        total = sum(weights)
+        parts = [minimum + int(extra * weight / total) for minimum, weight in zip(minimums, weights)]
+        parts[-1] += nodes - sum(parts)
+
+        # Some sizes can't be made (e.g. there is no int expression of 2 nodes), so move a node to or from a sibling.
+        for i, type in enumerate(types):
+            if fits(type, parts[i]):
+                continue
+            for j in range(len(types)):
+                if j != i and not fits(type, parts[i]):
+                    for delta in (1, -1):
+                        if fits(type, parts[i] + delta) and fits(types[j], parts[j] - delta):
+                            parts[i] += delta
+                            parts[j] -= delta
+                            break
+            if not fits(type, parts[i]):
+                return None
+        return parts
+
+    def pick_type(self, wanted: str) -> str:
+        return wanted if self.well_typed else self.random.choice(TYPES)
+
+    ### Expressions ###
+    def expression(self, type: str, nodes: int, depth: int, scope: Scope) -> int:
+        """
+        Write an expression of the given type with about the given amount of nodes, and return how many it has.
+        """
+        if type == BOOL:
+            return self.bool_expression(nodes, depth, scope)
+        elif type == PROC:
+            return self.proc_expression(nodes, depth, scope)
+        else:
+            return self.int_expression(nodes, depth, scope)
+
+    def int_expression(self, nodes: int, depth: int, scope: Scope) -> int:
+        if nodes <= 2 or depth >= self.max_depth:
+            return self.leaf(scope)
+
+        forms = [self.diff_expression, self.let_expression, self.let_expression, self.apply_expression]
+        if nodes >= 5:
+            forms.append(self.if_expression)
+        if nodes >= LETREC_NODES + 2:
+            forms.append(self.letrec_expression)
+        if any(type in (PROC, REC) and name not in self.called for name, type in scope):
+            forms.extend([self.call_expression] * 2)
+
+        # Not every form can have every size. A let with an int can, so this ends.
+        while True:
+            form = self.random.choice(forms)
+            used = form(INT, nodes, depth + 1, scope)
+            if used is not None:
+                return used
+            forms = [f for f in forms if f != form] or [self.let_expression]
+
+    def bool_expression(self, nodes: int, depth: int, scope: Scope) -> int:
+        if nodes >= 7 and depth < self.max_depth and self.random.random() < 0.3:
+            used = self.if_expression(BOOL, nodes, depth + 1, scope)
+            if used is not None:
+                return used
+
+        self.emit("zero?(")
+        used = self.expression(self.pick_type(INT), nodes - 1, depth + 1, scope)
+        self.emit(")")
+        return 1 + used
+
+    def proc_expression(self, nodes: int, depth: int, scope: Scope) -> int:
+        var = self.fresh()
+        self.emit(f"proc ({var}{self.annotation(INT)})")
+        # Procedures from outside can be called in the body, since the body runs at most once itself.
+        return 1 + self.expression(self.pick_type(INT), nodes - 1, depth + 1, scope + ((var, INT),))
+
+    # These return None, without writing anything, when they can't have the given amount of nodes.
+    def diff_expression(self, type: str, nodes: int, depth: int, scope: Scope) -> Optional[int]:
+        types = [self.pick_type(INT), self.pick_type(INT)]
+        parts = self.split(nodes - 1, types)
+        if parts is None:
+            return None
+        self.emit("-(")
+        used = self.expression(types[0], parts[0], depth, scope)
+        self.emit(",")
+        used += self.expression(types[1], parts[1], depth, scope)
+        self.emit(")")
+        return 1 + used
+
+    def if_expression(self, type: str, nodes: int, depth: int, scope: Scope) -> Optional[int]:
+        types = [self.pick_type(BOOL), self.pick_type(type), self.pick_type(type)]
+        parts = self.split(nodes - 1, types)
+        if parts is None:
+            return None
+        self.emit("if")
+        used = self.expression(types[0], parts[0], depth, scope)
+        self.emit("then")
+        used += self.expression(types[1], parts[1], depth, scope)
+        self.emit("else")
+        used += self.expression(types[2], parts[2], depth, scope)
+        return 1 + used
+
+    def let_expression(self, type: str, nodes: int, depth: int, scope: Scope) -> Optional[int]:
+        types = [self.random.choice(TYPES), self.pick_type(type)]
+        parts = self.split(nodes - 1, types)
+        if parts is None:
+            types[0] = INT
+            parts = self.split(nodes - 1, types)
+            if parts is None:
+                return None
+        name = self.fresh()
+        self.emit(f"let {name} =")
+        used = self.expression(types[0], parts[0], depth, scope)
+        self.emit("in")
+        used += self.expression(types[1], parts[1], depth, scope + ((name, types[0]),))
+        return 1 + used
+
+    def letrec_expression(self, type: str, nodes: int, depth: int, scope: Scope) -> Optional[int]:
+        types = [self.pick_type(INT), self.pick_type(type)]
+        parts = self.split(nodes - LETREC_NODES, types)
+        if parts is None:
+            return None
+        name, var = self.fresh(), self.fresh()
+        if self.typed:
+            self.emit(f"letrec int {name} ({var}: int) =")
+        else:
+            self.emit(f"letrec {name} ({var}) =")
+        self.emit(f"if zero?({var}) then")
+        # The base case can use the variable, but not call the procedure.
+        used = self.expression(types[0], parts[0], depth, scope + ((var, INT),))
+        self.emit(f"else ({name} -({var},1)) in")
+        used += self.expression(types[1], parts[1], depth, scope + ((name, REC),))
+        return LETREC_NODES + used
+
+    def call_expression(self, type: str, nodes: int, depth: int, scope: Scope) -> Optional[int]:
+        procs = [(name, type) for name, type in scope if type in (PROC, REC) and name not in self.called]
+        name, proc_type = self.random.choice(procs)
+        operand = self.pick_type(INT)
+        if proc_type == REC and nodes != 3 or not fits(operand, nodes - 2):
+            return None
+        self.called.add(name)
+        self.emit(f"({name}")
+        if proc_type == REC:
+            self.emit(str(self.random.randint(0, 3)))
+            used = 1
+        else:
+            used = self.expression(operand, nodes - 2, depth, scope)
+        self.emit(")")
+        return 2 + used
+
+    def apply_expression(self, type: str, nodes: int, depth: int, scope: Scope) -> Optional[int]:
+        """
+        Apply a procedure right where it is made.
+        """
+        types = [PROC, self.pick_type(INT)]
+        parts = self.split(nodes - 1, types)
+        if parts is None:
+            return None
+        self.emit("(")
+        used = self.proc_expression(parts[0], depth, scope)
+        used += self.expression(types[1], parts[1], depth, scope)
+        self.emit(")")
+        return 1 + used
+
+    def leaf(self, scope: Scope) -> int:
+        ints = [name for name, type in scope if type == INT or not self.well_typed]
+        if ints and self.random.random() < 0.5:
+            self.emit(self.random.choice(ints))
+        else:
+            self.emit(str(self.random.randint(0, 9)))
+        return 1
+
+
+def generateProgram(nodes: int, seed: int=0, typed: bool=False, well_typed: bool=True, max_depth: int=64) -> str:
+    generator = ProgramGenerator(seed, typed, well_typed, max_depth)
+    generator.generate(nodes)
+    return generator.out.getvalue()
+
+
+def writeProgram(file: TextIO, nodes: int, seed: int=0, typed: bool=False, well_typed: bool=True, max_depth: int=64) -> int:
+    """
+    Stream a program to a text file. Returns its amount of nodes.
+    """
+    return ProgramGenerator(seed, typed, well_typed, max_depth, out=file).generate(nodes)
+
+
+if __name__ == "__main__":
+    from parser import stringToExpression
+    from inferred import *
+    from printer import type__repr__
+
+    source = generateProgram(60, seed=1, typed=True)
+    print(source)
+    context = Context(typed=True)
+    exp = stringToExpression(source, context)
+    print(type__repr__(type_of_program(exp, context=context)))
+    print(Program(exp, EmptyEnvironment(), context).value_of_program())
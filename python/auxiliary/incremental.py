@@ -0,0 +1,402 @@
+"""
+Incremental type inference for INFERRED programs that are checked again after every edit, like in an editor.
+
+Rather than collecting the equations of the whole program in one substitution, every subexpression gets its own
+principal typing: its type, together with the types its free variables need to have for it to have that type, solved
+as far as the subexpression itself allows. A subexpression's typing follows from the typings of its children alone, by
+the same equations that type_of uses, so it only has to be inferred again when a part of it changed.
+
+    inference = IncrementalInference()
+    inference.type_of(program)
+    ...  # Edit: build a new program that shares the unchanged subtrees with the old one.
+    inference.type_of(edited_program)  # Only infers the new nodes, i.e. the edited ones and their ancestors.
+
+Subtrees are recognised by identity, so trees must not be changed in place: an edit makes new nodes for the subtree
+that changed and for its ancestors, and keeps all others (see `replaced`). Since LET isn't polymorphic, combining the
+typings of the parts gives the same type as inferring the whole at once, up to the numbering of type variables, and
+fails exactly when that fails (though a program with several errors may fail on a different one first). Programs with
+`set` can't be inferred this way, since the type of a variable then changes along the way.
+"""
+from inferred import *
+from typing import Callable, Dict, Tuple
+import letrec
+
+from trees import rebuilt, slot_names, subexpressions
+
+PRUNE_MINIMUM = 10_000  # Typings to keep before the ones of subtrees that are no longer used are looked for.
+WORK_PER_NODE = 4  # Work (see Combination.work) that a full run takes per expression of the program, about.
+
+
+class Typing:
+    """
+    The principal typing of an expression. Its type variables are numbered 1, 2, ... and belong to it alone.
+    """
+    __slots__ = ("type", "env", "size")
+
+    def __init__(self, type: Type, env: Dict[str, Type]):
+        self.type = type
+        self.env = env  # For every free variable, the type it needs to have.
+        self.size = 1   # Expressions in the expression, filled in by IncrementalInference.
+
+
+def renamed(t: Type, renaming: Dict[int, TypeVariable], make: Callable[[], TypeVariable]) -> Type:
+    """
+    The given type with every type variable replaced by the one it is renamed to, where new ones are made as needed.
+    """
+    if isinstance(t, TypeVariable):
+        new = renaming.get(t.num)
+        if new is None:
+            new = renaming[t.num] = make()
+        return new
+    elif isinstance(t, ProcType):
+        return ProcType(renamed(t.t1, renaming, make), renamed(t.t2, renaming, make))
+    else:
+        return t
+
+
+def canonical(t: Type) -> Type:
+    """
+    The given type with its type variables numbered 1, 2, ... in the order they occur, so equal types look equal.
+    """
+    renaming = dict()
+    return renamed(t, renaming, lambda: TypeVariable(len(renaming) + 1))
+
+
+class Combination:
+    """
+    The typing of one expression being made out of the typings of its children.
+    """
+
+    def __init__(self):
+        self.sub = Substitution()
+        self.purifier = TypePurifier()
+        self.env: Dict[str, Type] = dict()
+        self.work = 1  # Children's environment entries combined, and the entries of the result.
+
+    def fresh(self) -> Type:
+        return self.purifier.toType(UnknownType())
+
+    def child(self, typing: Typing, bound: Dict[str, Type]=None) -> Type:
+        """
+        Add a child's typing with fresh type variables, where the variables that the expression binds for the child
+        get the given types, and return the child's type.
+        """
+        renaming = dict()
+        self.work += len(typing.env)
+        for var, t in typing.env.items():
+            t = renamed(t, renaming, self.fresh)
+            if bound is not None and var in bound:
+                t.unify(bound[var], self.sub)
+            elif var in self.env:
+                t.unify(self.env[var], self.sub)
+            else:
+                self.env[var] = t
+        return renamed(typing.type, renaming, self.fresh)
+
+    def result(self, t: Type) -> Typing:
+        self.work += len(self.env)
+        renaming = dict()
+        make = lambda: TypeVariable(len(renaming) + 1)
+        return Typing(renamed(self.sub.applyThisToType(t), renaming, make),
+                      {var: renamed(self.sub.applyThisToType(env_type), renaming, make) for var, env_type in self.env.items()})
+
+
+def combine_const(exp: ConstExp, c: Combination, typings: Dict[Expression, Typing]) -> Typing:
+    return Typing(INT_TYPE, dict())
+
+def combine_var(exp: VarExp, c: Combination, typings: Dict[Expression, Typing]) -> Typing:
+    return Typing(TypeVariable(1), {exp.var: TypeVariable(1)})
+
+def combine_diff(exp: DiffExp, c: Combination, typings: Dict[Expression, Typing]) -> Typing:
+    c.child(typings[exp.exp1]).unify(INT_TYPE, c.sub)
+    c.child(typings[exp.exp2]).unify(INT_TYPE, c.sub)
+    return c.result(INT_TYPE)
+
+def combine_iszero(exp: IsZeroExp, c: Combination, typings: Dict[Expression, Typing]) -> Typing:
+    c.child(typings[exp.exp]).unify(INT_TYPE, c.sub)
+    return c.result(BOOL_TYPE)
+
+def combine_if(exp: IfExp, c: Combination, typings: Dict[Expression, Typing]) -> Typing:
+    c.child(typings[exp.cond_exp]).unify(BOOL_TYPE, c.sub)
+    type_res1 = c.child(typings[exp.true_exp])
+    type_res1.unify(c.child(typings[exp.false_exp]), c.sub)
+    return c.result(type_res1)
+
+def combine_let(exp: LetExp, c: Combination, typings: Dict[Expression, Typing]) -> Typing:
+    type_val = c.child(typings[exp.val_exp])
+    return c.result(c.child(typings[exp.body_exp], {exp.var: type_val}))
+
+def combine_call(exp: CallExp, c: Combination, typings: Dict[Expression, Typing]) -> Typing:
+    res_type = c.fresh()
+    proc_type = c.child(typings[exp.operator])
+    arg_type = c.child(typings[exp.operand])
+    proc_type.unify(ProcType(arg_type, res_type), c.sub)
+    return c.result(res_type)
+
+def combine_letrec(exp: LetrecExp, c: Combination, typings: Dict[Expression, Typing]) -> Typing:
+    arg_type = c.purifier.toType(getattr(exp, "tv", UnknownType()))
+    ret_type = c.purifier.toType(getattr(exp, "tr", UnknownType()))
+    proc_type = ProcType(arg_type, ret_type)
+    c.child(typings[exp.procbody], {exp.procname: proc_type, exp.procvar: arg_type}).unify(ret_type, c.sub)
+    return c.result(c.child(typings[exp.letbody], {exp.procname: proc_type}))
+
+def combine_proc(exp: ProcExp, c: Combination, typings: Dict[Expression, Typing]) -> Typing:
+    arg_type = c.purifier.toType(getattr(exp, "tv", UnknownType()))
+    return c.result(ProcType(arg_type, c.child(typings[exp.body_exp], {exp.var: arg_type})))
+
+
+Combiner = Tuple[Callable[[Expression, Combination, Dict[Expression, Typing]], Typing], Tuple[str, ...]]
+
+
+def rule_for(cls: type) -> Combiner:
+    """
+    How to combine the typings of the subexpressions of an expression of the given class, and which fields hold those.
+    """
+    if issubclass(cls, ConstExp):
+        return combine_const, ()
+    elif issubclass(cls, (VarExp, letrec.VarExp)):
+        return combine_var, ()
+    elif issubclass(cls, DiffExp):
+        return combine_diff, ("exp1", "exp2")
+    elif issubclass(cls, IsZeroExp):
+        return combine_iszero, ("exp",)
+    elif issubclass(cls, IfExp):
+        return combine_if, ("cond_exp", "true_exp", "false_exp")
+    elif issubclass(cls, (LetExp, letrec.LetExp)):
+        return combine_let, ("val_exp", "body_exp")
+    elif issubclass(cls, (CallExp, letrec.CallExp)):
+        return combine_call, ("operator", "operand")
+    elif issubclass(cls, (LetrecExp, letrec.LetrecExp)):
+        return combine_letrec, ("procbody", "letbody")
+    elif issubclass(cls, ProcExp):
+        return combine_proc, ("body_exp",)
+    else:
+        raise ValueError(f"Can't infer the type of {cls.__name__}: only the expressions of LETREC have typing rules here.")
+
+
+RULES: Dict[type, Combiner] = dict()
+
+
+def rule(exp: Expression) -> Combiner:
+    found = RULES.get(exp.__class__)
+    if found is None:
+        found = RULES[exp.__class__] = rule_for(exp.__class__)
+    return found
+
+
+class IncrementalInference:
+
+    def __init__(self):
+        self.typings: Dict[Expression, Typing] = dict()
+        self.prune_at = PRUNE_MINIMUM
+
+        self.revisited = 0       # Expressions whose typing was inferred by the last call to type_of.
+        self.reused = 0          # Subtrees whose typing was known already.
+        self.fell_back = False   # Whether the last call to type_of ran out of work and inferred the program in full.
+
+    def type_of(self, program: Expression) -> Type:
+        """
+        The type of a whole program, with its type variables numbered like `canonical` does.
+
+        A typing carries the types of all free variables of its expression, so where many variables are free at once
+        (say, a body that uses the variables of a long chain of LETs), combining typings can take much more work than
+        inferring the program in full. When combining the typings takes more work than a full run would, the typings
+        combined so far are kept and the program is inferred in full instead.
+        """
+        self.revisited = 0
+        self.reused = 0
+        self.fell_back = False
+        new: Dict[Expression, int] = dict()  # The size of every expression without a typing, children before parents.
+        todo = [(program, False)]
+        while todo:
+            exp, children_done = todo.pop()
+            if exp in self.typings or exp in new:
+                if not children_done:
+                    self.reused += 1
+            elif children_done:
+                new[exp] = 1 + sum(new[child] if child in new else self.typings[child].size
+                                   for child in (getattr(exp, name) for name in rule(exp)[1]))
+            else:
+                todo.append((exp, True))
+                todo.extend((getattr(exp, name), False) for name in rule(exp)[1])
+
+        budget = WORK_PER_NODE * (new[program] if program in new else self.typings[program].size)
+        for exp, size in new.items():
+            if budget < 0:
+                self.fell_back = True
+                break
+            c = Combination()
+            typing = self.typings[exp] = rule(exp)[0](exp, c, self.typings)
+            typing.size = size
+            self.revisited += 1
+            budget -= c.work
+
+        if len(self.typings) > self.prune_at:
+            self.prune(program)
+        if self.fell_back:
+            return canonical(type_of_program(program if isinstance(program, TypedExpression) else annotated(program),
+                                             context=Context()))
+        for var in self.typings[program].env:
+            raise ValueError(f"Failed to find type for variable '{var}'.")
+        return self.typings[program].type
+
+    def prune(self, program: Expression):
+        """
+        Forget the typings of the subtrees that the given program doesn't contain.
+        """
+        kept = dict()
+        todo = [program]
+        while todo:
+            exp = todo.pop()
+            if exp in self.typings:  # Unless it was left to a full run.
+                kept[exp] = self.typings[exp]
+            todo.extend(getattr(exp, name) for name in rule(exp)[1])
+        self.typings = kept
+        self.prune_at = max(PRUNE_MINIMUM, 2*len(kept))
+
+
+TYPED: Dict[Callable, type] = {
+    combine_const: ConstExpTyped, combine_var: VarExpTyped, combine_diff: DiffExpTyped,
+    combine_iszero: IsZeroExpTyped, combine_if: IfExpTyped, combine_let: LetExpTyped, combine_call: CallExpTyped,
+    combine_letrec: LetrecExpTyped, combine_proc: ProcExpTyped,
+}
+
+
+def annotated(program: Expression) -> TypedExpression:
+    """
+    A copy of an untyped program in the typed classes, with every type left to infer, so type_of_program can infer it.
+    """
+    copies: Dict[Expression, Expression] = dict()
+    todo = [(program, False)]
+    while todo:
+        exp, children_done = todo.pop()
+        combine, names = rule(exp)
+        if exp in copies:
+            continue
+        elif not children_done:
+            todo.append((exp, True))
+            todo.extend((getattr(exp, name), False) for name in names)
+            continue
+
+        cls = TYPED[combine]
+        copy = cls.__new__(cls)
+        for name in slot_names(cls):
+            if name in names:
+                setattr(copy, name, copies[getattr(exp, name)])
+            else:
+                setattr(copy, name, getattr(exp, name) if hasattr(exp, name) else UnknownType())
+        copies[exp] = copy
+    return copies[program]
+
+
+def replaced(program: Expression, old: Expression, new: Expression) -> Expression:
+    """
+    The program with one subtree replaced by another. Only the ancestors of that subtree are copied, so everything
+    else is shared with the given program.
+    """
+    parents: Dict[Expression, Expression] = dict()
+    todo = [program]
+    while todo and old not in parents and old is not program:
+        exp = todo.pop()
+        for child in subexpressions(exp):
+            parents[child] = exp
+            todo.append(child)
+    if old is not program and old not in parents:
+        raise ValueError("The subtree to replace is not part of the program.")
+
+    while old is not program:
+        parent = parents[old]
+        changes = dict()
+        for name in slot_names(parent.__class__):
+            value = getattr(parent, name)
+            if value is old:
+                changes[name] = new
+            elif isinstance(value, list) and any(element is old for element in value):
+                changes[name] = [new if element is old else element for element in value]
+        old, new = parent, rebuilt(parent, **changes)
+    return new
+
+
+if __name__ == "__main__":
+    from generator import generateProgram
+    from parser import stringToExpression
+    from printer import type__repr__
+    from random import Random
+    import sys
+    import time
+
+    sys.setrecursionlimit(100_000)
+    random = Random(0)
+    context = Context(typed=True)
+    program = stringToExpression(generateProgram(100_000, seed=0, typed=True), context)
+    constants = []
+    todo = [program]
+    while todo:
+        exp = todo.pop()
+        if isinstance(exp, ConstExpTyped):
+            constants.append(exp)
+        todo.extend(subexpressions(exp))
+
+    def full(program: Expression) -> str:
+        try:
+            return type__repr__(canonical(type_of_program(program, context=Context())))
+        except (TypeError, ValueError) as e:
+            return e.__class__.__name__  # Which equation fails first can differ.
+
+    def incremental(program: Expression) -> str:
+        try:
+            return type__repr__(inference.type_of(program))
+        except (TypeError, ValueError) as e:
+            return e.__class__.__name__  # Which equation fails first can differ.
+
+    inference = IncrementalInference()
+    start = time.perf_counter()
+    result = incremental(program)
+    print(f"First run: {result}, {inference.revisited} nodes in {1000*(time.perf_counter() - start):.0f} ms.")
+
+    print(f"{'edit':<28} {'full (ms)':>10} {'incremental (ms)':>17} {'revisited':>10}  type")
+    for edit in range(10):
+        old = random.choice(constants)
+        new = IsZeroExpTyped(ConstExpTyped(0)) if edit % 3 == 2 else ConstExpTyped(random.randrange(100))
+        edited = replaced(program, old, new)
+
+        start = time.perf_counter()
+        expected = full(edited)
+        full_ms = 1000*(time.perf_counter() - start)
+        start = time.perf_counter()
+        result = incremental(edited)
+        incremental_ms = 1000*(time.perf_counter() - start)
+        assert result == expected, (result, expected)
+
+        print(f"{str(old.const) + ' -> ' + ('zero?(0)' if isinstance(new, IsZeroExp) else str(new.const)):<28} "
+              f"{full_ms:>10.1f} {incremental_ms:>17.2f} {inference.revisited:>10}  {result}")
+        if result != "TypeError":
+            program = edited
+
+    # Many variables free at once: a chain of LETs whose body uses every variable. Combining typings would take time
+    # quadratic in the length of the chain, so both the first run and an edit at the bottom run in full instead.
+    print(f"{'lets':>6} {'full (ms)':>10} {'first run (ms)':>15} {'edit (ms)':>10}  fell back")
+    for n in [1000, 2000, 4000]:
+        for typed in [False, True]:
+            source = "".join(f"let v{i} = {i} in " for i in range(n)) + "-(" * (n - 1) + "v0" + "".join(f", v{i})" for i in range(1, n))
+            program = stringToExpression(source, Context(typed=typed))
+            innermost = program
+            while not isinstance(innermost, VarExp):
+                innermost = innermost.body_exp if isinstance(innermost, LetExp) else innermost.exp1
+            edited = replaced(program, innermost, VarExpTyped("v1") if typed else VarExp("v1"))
+
+            start = time.perf_counter()
+            expected = full(program if typed else annotated(program))
+            full_ms = 1000*(time.perf_counter() - start)
+            inference = IncrementalInference()
+            start = time.perf_counter()
+            result = incremental(program)
+            first_ms = 1000*(time.perf_counter() - start)
+            assert result == expected, (result, expected)
+            fell_back = inference.fell_back
+            start = time.perf_counter()
+            result = incremental(edited)
+            edit_ms = 1000*(time.perf_counter() - start)
+            assert result == "int", result
+            print(f"{n:>6} {full_ms:>10.0f} {first_ms:>15.0f} {edit_ms:>10.0f}  {fell_back}, {inference.fell_back}"
+                  f"{'' if typed else ' (untyped)'}")
@@ -0,0 +1,239 @@
+"""
+Instrumentation for the tree-walking interpreters: how often every kind of expression is evaluated and how long that
+takes, how far variable lookups have to walk through the environment, and how much the store is used.
+
+Nothing in the interpreters knows about this. While any thread is instrumenting, the value_of of every Expression
+class, the lookup of every Environment class and the methods of the Store are replaced by wrappers, and once the last
+one stops, the originals are put back. Programs that run when nothing is instrumented hence run exactly the code they
+always did, at no extra cost.
+
+    with instrument() as report:
+        Program(exp, EmptyEnvironment()).value_of_program()
+    print(report)
+
+The report is kept in a context variable, like the current Context, so everything evaluated in the thread (or asyncio
+task) that started instrumenting is recorded in its report, and the wrappers do nothing else for any other thread.
+Other evaluators are only seen where they use the same methods: all of them use the store, and the CEK machine still
+calls lookup for some environments.
+"""
+from explicit_refs import *
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+from time import perf_counter_ns
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import letrec
+
+
+class NodeStats:
+
+    def __init__(self):
+        self.evaluations = 0
+        self.total_ns = 0  # Including the subexpressions, but only counted once for recursive evaluations.
+        self.self_ns  = 0  # Excluding the subexpressions.
+        self.active = 0    # Evaluations that are still running.
+
+    def __repr__(self):
+        return f"NodeStats(evaluations={self.evaluations}, total={self.total_ns/1e6:.2f}ms, self={self.self_ns/1e6:.2f}ms)"
+
+
+class EvaluationReport:
+
+    def __init__(self):
+        self.nodes: Dict[str, NodeStats] = dict()     # Per Expression class name.
+        self.lookup_depths: Dict[int, int] = dict()  # Frames skipped before a variable was found -> amount of lookups.
+        self.store_calls: Dict[str, int] = {"new": 0, "load": 0, "store": 0}
+
+        self.children_ns: List[int] = []  # For every running evaluation, the time spent in its subexpressions.
+        self.lookup_level = 0
+        self.lookup_frames = 0
+
+    def lookups(self) -> int:
+        return sum(self.lookup_depths.values())
+
+    def mean_lookup_depth(self) -> float:
+        return sum(depth*count for depth, count in self.lookup_depths.items()) / max(1, self.lookups())
+
+    def to_dict(self) -> dict:
+        return {
+            "nodes": {name: {"evaluations": stats.evaluations, "total_ms": stats.total_ns/1e6, "self_ms": stats.self_ns/1e6}
+                      for name, stats in self.nodes.items()},
+            "lookup_depths": dict(sorted(self.lookup_depths.items())),
+            "store_calls": dict(self.store_calls)
+        }
+
+    def __repr__(self):
+        lines = [f"{'expression':<20} {'evaluations':>12} {'total (ms)':>11} {'self (ms)':>10}"]
+        for name, stats in sorted(self.nodes.items(), key=lambda item: -item[1].self_ns):
+            lines.append(f"{name:<20} {stats.evaluations:>12} {stats.total_ns/1e6:>11.2f} {stats.self_ns/1e6:>10.2f}")
+        lines.append(f"{self.lookups()} lookups, {self.mean_lookup_depth():.1f} frames deep on average, "
+                     f"{max(self.lookup_depths, default=0)} at most")
+        lines.append("store: " + ", ".join(f"{count} {method}" for method, count in self.store_calls.items()))
+        return "\n".join(lines)
+
+
+CURRENT_REPORT: ContextVar[Optional[EvaluationReport]] = ContextVar("CURRENT_REPORT", default=None)
+
+
+def subclasses(cls: type) -> Iterator[type]:
+    for subclass in cls.__subclasses__():
+        yield subclass
+        yield from subclasses(subclass)
+
+
+def timed_value_of(value_of):
+    @wraps(value_of)
+    def wrapper(self, env):
+        report = CURRENT_REPORT.get()
+        if report is None:
+            return value_of(self, env)
+        stats = report.nodes.get(self.__class__.__name__)
+        if stats is None:
+            stats = report.nodes[self.__class__.__name__] = NodeStats()
+        stats.evaluations += 1
+        stats.active += 1
+        report.children_ns.append(0)
+        start = perf_counter_ns()
+        try:
+            return value_of(self, env)
+        finally:
+            elapsed = perf_counter_ns() - start
+            stats.active -= 1
+            stats.self_ns += elapsed - report.children_ns.pop()
+            if not stats.active:
+                stats.total_ns += elapsed
+            if report.children_ns:
+                report.children_ns[-1] += elapsed
+    return wrapper
+
+
+def counted_lookup(lookup):
+    """
+    Lookups call the lookup of the next environment until the variable is found, so only the outermost one records how
+    many environments were visited.
+    """
+    @wraps(lookup)
+    def wrapper(self, var):
+        report = CURRENT_REPORT.get()
+        if report is None:
+            return lookup(self, var)
+        if not report.lookup_level:
+            report.lookup_frames = 0
+        report.lookup_level += 1
+        report.lookup_frames += 1
+        try:
+            return lookup(self, var)
+        finally:
+            report.lookup_level -= 1
+            if not report.lookup_level:
+                depth = report.lookup_frames - 1
+                report.lookup_depths[depth] = report.lookup_depths.get(depth, 0) + 1
+    return wrapper
+
+
+def counted_store_call(method):
+    @wraps(method)
+    def wrapper(*args):
+        report = CURRENT_REPORT.get()
+        if report is not None:
+            report.store_calls[method.__name__] += 1
+        return method(*args)
+    return wrapper
+
+
+def patches() -> List[Tuple[type, str, Callable]]:
+    """
+    Every method to replace while instrumenting, with what to replace it by.
+    """
+    replacements = []
+    for cls in subclasses(Expression):
+        if "value_of" in cls.__dict__:
+            replacements.append((cls, "value_of", timed_value_of(cls.__dict__["value_of"])))
+    for cls in subclasses(letrec.Environment):
+        if "lookup" in cls.__dict__:
+            replacements.append((cls, "lookup", counted_lookup(cls.__dict__["lookup"])))
+    for name in ["new", "load", "store"]:
+        replacements.append((Store, name, counted_store_call(Store.__dict__[name])))
+    return replacements
+
+
+PATCHING = Lock()
+INSTRUMENTING = 0  # Reports being recorded, in any thread. The wrappers are in place while there are any.
+ORIGINALS: List[Tuple[type, str, Callable]] = []
+
+
+def install():
+    global INSTRUMENTING
+    with PATCHING:
+        if not INSTRUMENTING:
+            replaced = patches()
+            ORIGINALS[:] = [(cls, name, cls.__dict__[name]) for cls, name, _ in replaced]
+            for cls, name, wrapper in replaced:
+                setattr(cls, name, wrapper)
+        INSTRUMENTING += 1
+
+
+def uninstall():
+    global INSTRUMENTING
+    with PATCHING:
+        INSTRUMENTING -= 1
+        if not INSTRUMENTING:
+            for cls, name, original in ORIGINALS:
+                setattr(cls, name, original)
+            ORIGINALS.clear()
+
+
+@contextmanager
+def instrument() -> Iterator[EvaluationReport]:
+    """
+    Record all evaluation in this thread for the duration of a with-block, in the report that is given to it.
+    Expression and Environment classes have to be defined (imported) before the first block starts to be instrumented.
+    """
+    if CURRENT_REPORT.get() is not None:
+        raise RuntimeError("Instrumentation is already on.")
+
+    install()
+    token = CURRENT_REPORT.set(EvaluationReport())
+    try:
+        yield CURRENT_REPORT.get()
+    finally:
+        CURRENT_REPORT.reset(token)
+        uninstall()
+
+
+if __name__ == "__main__":
+    from parser import stringToExpression
+    import sys
+
+    sys.setrecursionlimit(20_000)
+    exp = stringToExpression("""
+        let v0 = 0 in let v1 = 1 in let v2 = 2 in let v3 = 3
+        in letrec loop (n) = if zero?(n) then v0 else -((loop -(n, v1)), -(v0, v1))
+        in (loop 2000)
+    """)
+    with instrument() as report:
+        print(Program(exp, EmptyEnvironment()).value_of_program())
+    print(report)
+
+    # Threads that instrument at the same time each get a report of only their own run, and the others run unrecorded.
+    from threading import Thread
+    reports = [None] * 4
+
+    def run(i: int):
+        if i % 2:
+            with instrument() as reports[i]:
+                Program(exp, EmptyEnvironment(), Context()).value_of_program()
+        else:
+            Program(exp, EmptyEnvironment(), Context()).value_of_program()
+
+    threads = [Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i in [1, 3]:
+        assert {name: stats.evaluations for name, stats in reports[i].nodes.items()} == {name: stats.evaluations for name, stats in report.nodes.items()}
+        assert reports[i].lookup_depths == report.lookup_depths
+    assert not any(hasattr(cls.__dict__[name], "__wrapped__") for cls, name, _ in patches())
+    print("Concurrent reports match the one above, and the originals are back.")
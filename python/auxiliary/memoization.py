@@ -0,0 +1,136 @@
+"""
+Memoization of procedure calls for programs in plain LETREC, where calling a procedure with the same argument in the
+same environment always gives the same result. Naive recursive definitions, which make the same calls over and over,
+then only make every distinct call once:
+
+    with memoize(exp) as table:
+        Program(exp, EmptyEnvironment()).value_of_program()
+    print(table)
+
+A result is cached under the body of the procedure, the environment it closed over, and its argument: an integer or
+boolean by its value, a procedure by its identity. The table holds a bounded amount of results, and forgets the one
+that was used longest ago to make room for a new one.
+
+Only programs that are built entirely out of LETREC's own expression classes can be memoized. Anything from EXPLICIT-REFS
+or IMPLICIT-REFS (whose variables, lets and calls all use the store too) may read or change the store, and so give
+different results for the same call; memoize refuses such programs. While memoizing, calls go through a layer (see
+letrec.layered) that uses the table, but only for procedures of the program that was checked. The table is only used by
+the thread that started memoizing.
+"""
+from inferred import *
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Hashable, Iterator, Set
+import letrec
+
+PURE_CLASSES = {letrec.ConstExp, letrec.VarExp, letrec.ProcExp, letrec.DiffExp, letrec.IsZeroExp, letrec.IfExp,
+                letrec.LetExp, letrec.LetrecExp, letrec.CallExp}
+
+
+class MemoTable:
+
+    def __init__(self, bodies: Set[Expression], max_entries: int=100_000):
+        """
+        :param bodies: the bodies of the procedures whose calls may be memoized.
+        """
+        self.bodies = bodies
+        self.max_entries = max_entries
+        self.results: OrderedDict[tuple, ExpVal] = OrderedDict()  # Least recently used first.
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple) -> Optional[ExpVal]:
+        result = self.results.get(key)
+        if result is not None:
+            self.results.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return result
+
+    def put(self, key: tuple, result: ExpVal):
+        self.results[key] = result
+        if len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+            self.evictions += 1
+
+    def __repr__(self):
+        calls = self.hits + self.misses
+        return f"MemoTable({len(self.results)}/{self.max_entries} entries, {self.hits} hits, {self.misses} misses " \
+               f"({100*self.hits/max(1, calls):.1f}% hit rate), {self.evictions} evictions)"
+
+
+def argument_key(arg: ExpVal) -> Hashable:
+    if isinstance(arg, (IntVal, BoolVal)):
+        return arg.__class__, arg.value
+    else:
+        return arg  # Procedures are equal only to themselves.
+
+
+def pure_bodies(exp: Expression) -> Set[Expression]:
+    """
+    The bodies of all procedures in a program, which can't touch the store because nothing in the program does.
+    Raises a ValueError for programs that are not plain LETREC.
+    """
+    bodies = set()
+    todo = [exp]
+    while todo:
+        exp = todo.pop()
+        if exp.__class__ not in PURE_CLASSES:
+            raise ValueError(f"Can only memoize plain LETREC programs, but it contains {exp.__class__.__module__}.{exp.__class__.__name__}.")
+        if isinstance(exp, letrec.ProcExp):
+            bodies.add(exp.body_exp)
+        elif isinstance(exp, letrec.LetrecExp):
+            bodies.add(exp.procbody)
+        todo.extend(field for field in fields(exp) if isinstance(field, Expression))
+    return bodies
+
+
+def memoized(table: MemoTable) -> Layer:
+    def layer(apply: Apply) -> Apply:
+        def apply_procedure(proc: ProcVal, arg: DenVal) -> ExpVal:
+            if proc.body not in table.bodies:
+                return apply(proc, arg)
+
+            key = (proc.body, proc.closed_env, argument_key(arg))
+            result = table.get(key)
+            if result is None:
+                result = apply(proc, arg)
+                table.put(key, result)
+            return result
+        return apply_procedure
+    return layer
+
+
+@contextmanager
+def memoize(exp: Expression, max_entries: int=100_000) -> Iterator[MemoTable]:
+    """
+    Memoize the calls of the given program's procedures while it runs in a with-block.
+    """
+    table = MemoTable(pure_bodies(exp), max_entries)
+    with layered(memoized(table)):
+        yield table
+
+
+if __name__ == "__main__":
+    from benchmarks.corpus import retarget
+    from parser import stringToExpression
+
+    exp = retarget(stringToExpression("""
+        letrec fib (n) = if zero?(n) then 0
+                         else if zero?(-(n,1)) then 1
+                         else -((fib -(n,1)), -(0, (fib -(n,2))))
+        in (fib 60)
+    """))
+    with memoize(exp) as table:
+        print(Program(exp, EmptyEnvironment()).value_of_program())
+    print(table)
+
+    # Memoizing combines with profiling: the profile only sees the calls that missed the table.
+    from profiler import profile
+    with profile(exp) as result, memoize(exp) as table:
+        Program(exp, EmptyEnvironment()).value_of_program()
+    assert result.totals()["fib"][0] == table.misses, (result.totals(), table)
+    print(result)
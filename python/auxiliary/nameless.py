@@ -0,0 +1,338 @@
+"""
+Lexical addressing for LETREC, EXPLICIT-REFS and IMPLICIT-REFS.
+
+Looking up a variable in an ExtendEnvironment walks the linked list and compares strings at every step. Yet where a
+variable lives can be known before running: this translation pass resolves every variable once, to a lexical address,
+and produces a nameless program whose environments are indexed instead of searched.
+
+Unlike in the book, where every binding gets a frame of its own and an address is just a depth, a frame here is an
+array holding ALL variables bound in the same procedure body: its argument, and every let and letrec inside it (but not
+inside the procedures nested in it). An address is then a pair (depth, offset): the amount of procedure boundaries to
+cross, and the index in that frame. Nesting lets hence costs nothing at lookup time.
+
+Giving every binder its own slot in the frame is safe because there are no loops: within one call of a procedure, each
+binder in its body is evaluated at most once. Recursion gets a new frame for every call.
+"""
+from explicit_refs import *
+from typing import List, Optional, Tuple
+import letrec
+import implicit_refs
+
+
+############################
+### Nameless environment ###
+############################
+class NamelessEnvironment:
+    """
+    One frame of variables, and the frame of the procedure body around it.
+    """
+
+    def __init__(self, size: int, parent: "NamelessEnvironment"):
+        self.slots = [None] * size
+        self.parent = parent
+
+    def lookup(self, depth: int, offset: int) -> DenVal:
+        frame = self
+        for _ in range(depth):
+            frame = frame.parent
+        return frame.slots[offset]
+
+
+class NamelessProcVal(ExpVal):
+    """
+    A procedure knows how big the frame for its body has to be. Its argument is put in the first slot.
+    """
+
+    def __init__(self, var: str, frame_size: int, body: Expression, closed_env: NamelessEnvironment):
+        self.var = var
+        self.frame_size = frame_size
+        self.body = body
+        self.closed_env = closed_env
+    def __repr__(self):
+        return f"NamelessProcVal({self.var})"
+
+
+def apply_nameless_procedure(proc: NamelessProcVal, arg: DenVal) -> ExpVal:
+    frame = NamelessEnvironment(proc.frame_size, proc.closed_env)
+    frame.slots[0] = arg
+    return proc.body.value_of(frame)
+
+
+############################
+### Nameless expressions ###
+############################
+# Expressions that don't bind or look up variables stay the same, with translated subexpressions:
+#   ConstExp, DiffExp, IsZeroExp, IfExp
+#   BeginExp, NewrefExp, SetrefExp, DerefExp
+
+class NamelessVarExp(Expression):
+
+    def __init__(self, depth: int, offset: int):
+        self.depth = depth
+        self.offset = offset
+
+    def value_of(self, env: NamelessEnvironment) -> ExpVal:
+        return env.lookup(self.depth, self.offset)
+
+
+class NamelessProcExp(Expression):
+
+    def __init__(self, var: str, frame_size: int, body_exp: Expression):
+        self.var = var
+        self.frame_size = frame_size
+        self.body_exp = body_exp
+
+    def value_of(self, env: NamelessEnvironment) -> ExpVal:
+        return NamelessProcVal(self.var, self.frame_size, self.body_exp, env)
+
+
+class NamelessLetExp(Expression):
+
+    def __init__(self, offset: int, val_exp: Expression, body_exp: Expression):
+        self.offset = offset
+        self.val_exp = val_exp
+        self.body_exp = body_exp
+
+    def value_of(self, env: NamelessEnvironment) -> ExpVal:
+        env.slots[self.offset] = self.val_exp.value_of(env)
+        return self.body_exp.value_of(env)
+
+
+class NamelessLetrecExp(Expression):
+    """
+    The procedure closes over the frame it is stored in, so it can find itself without an EnvlessProcEnvironment.
+    """
+
+    def __init__(self, offset: int, procvar: str, frame_size: int, procbody: Expression, letbody: Expression):
+        self.offset = offset
+        self.procvar = procvar
+        self.frame_size = frame_size
+        self.procbody = procbody
+        self.letbody = letbody
+
+    def value_of(self, env: NamelessEnvironment) -> ExpVal:
+        env.slots[self.offset] = NamelessProcVal(self.procvar, self.frame_size, self.procbody, env)
+        return self.letbody.value_of(env)
+
+
+class NamelessCallExp(Expression):
+
+    def __init__(self, operator_exp: Expression, operand_exp: Expression):
+        self.operator = operator_exp
+        self.operand = operand_exp
+
+    def value_of(self, env: NamelessEnvironment) -> ExpVal:
+        return apply_nameless_procedure(NamelessProcVal.cast(self.operator.value_of(env)), self.operand.value_of(env))
+
+
+# IMPLICIT-REFS: the frames hold references instead of values.
+class NamelessVarExpImplicit(NamelessVarExp):
+
+    def value_of(self, env: NamelessEnvironment) -> ExpVal:
+        return the_store().load(env.lookup(self.depth, self.offset))
+
+
+class NamelessLetExpImplicit(NamelessLetExp):
+
+    def value_of(self, env: NamelessEnvironment) -> ExpVal:
+        store = the_store()
+        env.slots[self.offset] = store.store(store.new(), self.val_exp.value_of(env))
+        return self.body_exp.value_of(env)
+
+
+class NamelessLetrecExpImplicit(NamelessLetrecExp):
+    """
+    The recursive procedure gets one reference, rather than a new one every time its name is looked up.
+    """
+
+    def value_of(self, env: NamelessEnvironment) -> ExpVal:
+        store = the_store()
+        env.slots[self.offset] = store.store(store.new(), NamelessProcVal(self.procvar, self.frame_size, self.procbody, env))
+        return self.letbody.value_of(env)
+
+
+class NamelessCallExpImplicit(NamelessCallExp):
+
+    def value_of(self, env: NamelessEnvironment) -> ExpVal:
+        proc = NamelessProcVal.cast(self.operator.value_of(env))
+        store = the_store()
+        return apply_nameless_procedure(proc, store.store(store.new(), self.operand.value_of(env)))
+
+
+class NamelessSetExp(Expression):
+
+    def __init__(self, depth: int, offset: int, value_exp: Expression):
+        self.depth = depth
+        self.offset = offset
+        self.value_exp = value_exp
+
+    def value_of(self, env: NamelessEnvironment) -> ExpVal:
+        the_store().store(env.lookup(self.depth, self.offset), self.value_exp.value_of(env))
+        return IntVal(-1_000_002)
+
+
+##########################
+### Static environment ###
+##########################
+class StaticEnvironment:
+    """
+    What the translator knows about the environment at runtime: in which slot of which frame each name will be.
+    Nodes without a name mark the boundary between a procedure body's frame and the frame around it.
+    """
+
+    def __init__(self, var: Optional[str], offset: int, tail: Optional["StaticEnvironment"]):
+        self.var = var
+        self.offset = offset
+        self.tail = tail
+
+
+def lexical_address(senv: Optional[StaticEnvironment], var: str) -> Tuple[int, int]:
+    depth = 0
+    while senv is not None:
+        if senv.var is None:
+            depth += 1
+        elif senv.var == var:
+            return depth, senv.offset
+        senv = senv.tail
+    raise ValueError(f"Failed to find {var} in environment.")
+
+
+class FrameLayout:
+    """
+    Hands out the slots of the frame of one procedure body while it is being translated.
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def allocate(self) -> int:
+        self.size += 1
+        return self.size - 1
+
+
+###################
+### Translation ###
+###################
+def translate(exp: Expression, names: List[str]=()) -> Tuple[Expression, int]:
+    """
+    Translate a program to its nameless equivalent. The given names are the variables in the initial environment, which
+    will occupy the first slots of the outermost frame, in that order. Returns the translated program and the size its
+    outermost frame needs.
+    """
+    layout = FrameLayout()
+    senv = None
+    for name in reversed(names):  # The first name shadows the others, like the innermost binding in an environment.
+        senv = StaticEnvironment(name, layout.allocate(), senv)
+
+    nameless_exp = translate_expression(exp, senv, layout)
+    return nameless_exp, layout.size
+
+
+def translate_expression(exp: Expression, senv: StaticEnvironment, layout: FrameLayout) -> Expression:
+    if isinstance(exp, ConstExp):
+        return ConstExp(exp.const)
+    elif isinstance(exp, implicit_refs.VarExp):
+        return NamelessVarExpImplicit(*lexical_address(senv, exp.var))
+    elif isinstance(exp, letrec.VarExp):
+        return NamelessVarExp(*lexical_address(senv, exp.var))
+    elif isinstance(exp, ProcExp):
+        body_layout = FrameLayout()
+        body_senv = StaticEnvironment(exp.var, body_layout.allocate(), StaticEnvironment(None, 0, senv))
+        body = translate_expression(exp.body_exp, body_senv, body_layout)
+        return NamelessProcExp(exp.var, body_layout.size, body)
+    elif isinstance(exp, (letrec.LetExp, implicit_refs.LetExp)):
+        offset = layout.allocate()
+        val_exp  = translate_expression(exp.val_exp, senv, layout)
+        body_exp = translate_expression(exp.body_exp, StaticEnvironment(exp.var, offset, senv), layout)
+        if isinstance(exp, implicit_refs.LetExp):
+            return NamelessLetExpImplicit(offset, val_exp, body_exp)
+        else:
+            return NamelessLetExp(offset, val_exp, body_exp)
+    elif isinstance(exp, (letrec.LetrecExp, implicit_refs.LetrecExp)):
+        offset = layout.allocate()
+        senv = StaticEnvironment(exp.procname, offset, senv)
+
+        body_layout = FrameLayout()
+        body_senv = StaticEnvironment(exp.procvar, body_layout.allocate(), StaticEnvironment(None, 0, senv))
+        procbody = translate_expression(exp.procbody, body_senv, body_layout)
+        letbody  = translate_expression(exp.letbody, senv, layout)
+        if isinstance(exp, implicit_refs.LetrecExp):
+            return NamelessLetrecExpImplicit(offset, exp.procvar, body_layout.size, procbody, letbody)
+        else:
+            return NamelessLetrecExp(offset, exp.procvar, body_layout.size, procbody, letbody)
+    elif isinstance(exp, implicit_refs.CallExp):
+        return NamelessCallExpImplicit(translate_expression(exp.operator, senv, layout), translate_expression(exp.operand, senv, layout))
+    elif isinstance(exp, letrec.CallExp):
+        return NamelessCallExp(translate_expression(exp.operator, senv, layout), translate_expression(exp.operand, senv, layout))
+    elif isinstance(exp, implicit_refs.SetExp):
+        return NamelessSetExp(*lexical_address(senv, exp.var), translate_expression(exp.value_exp, senv, layout))
+    elif isinstance(exp, DiffExp):
+        return DiffExp(translate_expression(exp.exp1, senv, layout), translate_expression(exp.exp2, senv, layout))
+    elif isinstance(exp, IsZeroExp):
+        return IsZeroExp(translate_expression(exp.exp, senv, layout))
+    elif isinstance(exp, IfExp):
+        return IfExp(
+            translate_expression(exp.cond_exp, senv, layout),
+            translate_expression(exp.true_exp, senv, layout),
+            translate_expression(exp.false_exp, senv, layout)
+        )
+    elif isinstance(exp, BeginExp):
+        return BeginExp([translate_expression(e, senv, layout) for e in exp.exps])
+    elif isinstance(exp, NewrefExp):
+        return NewrefExp(translate_expression(exp.init_exp, senv, layout))
+    elif isinstance(exp, SetrefExp):
+        return SetrefExp(translate_expression(exp.ref_exp, senv, layout), translate_expression(exp.val_exp, senv, layout))
+    elif isinstance(exp, DerefExp):
+        return DerefExp(translate_expression(exp.ref_exp, senv, layout))
+    else:
+        raise ValueError(f"Cannot translate {exp.__class__.__name__} to a nameless expression.")
+
+
+def unpack_environment(env: Environment) -> Tuple[List[str], List[DenVal]]:
+    """
+    The names and values in an initial environment, innermost first.
+    """
+    names  = []
+    values = []
+    while not isinstance(env, EmptyEnvironment):
+        if not isinstance(env, ExtendEnvironment):
+            raise ValueError(f"Cannot translate an initial environment containing {env.__class__.__name__}.")
+        names.append(env.var)
+        values.append(env.val)
+        env = env.tail
+    return names, values
+
+
+def value_of_nameless(exp: Expression, initenv: Environment) -> ExpVal:
+    """
+    Evaluator that can be given to Program.value_of_program.
+    """
+    names, values = unpack_environment(initenv)
+    nameless_exp, size = translate(exp, names)
+
+    frame = NamelessEnvironment(size, None)
+    frame.slots[:len(values)] = values
+    return nameless_exp.value_of(frame)
+
+
+if __name__ == "__main__":
+    for language in [letrec, implicit_refs]:
+        prog = Program(
+            language.LetExp("y", ConstExp(74),
+                   language.LetExp("p", ProcExp("x", DiffExp(language.VarExp("y"), language.VarExp("x"))),
+                          language.CallExp(language.VarExp("p"), ConstExp(5)))
+                   ),
+            EmptyEnvironment()
+        )
+        print(IntVal.cast(prog.value_of_program()).value, IntVal.cast(prog.value_of_program(value_of_nameless)).value)
+
+    prog = Program(
+        LetExp("r", NewrefExp(ConstExp(10)),
+               LetrecExp("count", "n", IfExp(IsZeroExp(VarExp("n")),
+                                             DerefExp(VarExp("r")),
+                                             BeginExp([SetrefExp(VarExp("r"), DiffExp(DerefExp(VarExp("r")), ConstExp(-1))),
+                                                       CallExp(VarExp("count"), DiffExp(VarExp("n"), ConstExp(1)))])),
+                         CallExp(VarExp("count"), ConstExp(5)))),
+        EmptyEnvironment()
+    )
+    print(IntVal.cast(prog.value_of_program()).value, IntVal.cast(prog.value_of_program(value_of_nameless)).value)
@@ -0,0 +1,414 @@
+"""
+An optimizer for LETREC and IMPLICIT-REFS programs (and the INFERRED versions of them), which rewrites a tree once
+before it runs, so work that doesn't depend on the input isn't redone every time that part of the tree is evaluated:
+    - -(5, 3) becomes 2, and an if on zero? of a constant becomes the branch that would run.
+    - let x = 7 in -(x, 1) becomes -(7, 1) and then 6: bindings to constants and variables are inlined everywhere,
+      bindings to procedures where they are used once, and unused bindings to any of those are dropped.
+    - (proc (x) body arg) becomes let x = arg in body, which then may be inlined in turn.
+    - A letrec whose procedure is never called is dropped.
+
+Everything that is moved or dropped is something that can't fail or loop: a constant, a variable that the program
+binds, a procedure, or zero? of a constant. So the optimized program gives the same value, or the same error, as the
+original. Variables that are assigned with `set` are never inlined. A binder that would shadow a variable is renamed,
+so nothing that is moved can be captured: the optimized program never shadows.
+
+The optimizer visits every node once. It first finds the binding of every variable and counts the uses of every
+binding, and then keeps those counts up to date while it inlines, copies and drops uses, so that it knows a binding
+became unused by the time it leaves its scope. Procedures that are used once aren't optimized where they are bound,
+but where they are used, so a call of one is optimized as a let right away.
+
+Typed programs are only optimized when they are well-typed, since dropping code could drop what makes them ill-typed.
+
+The input is not changed; the optimized tree shares the parts that stayed the same, and has no node in two places.
+"""
+from inferred import *
+from typing import Dict, List, Optional, Set, Tuple
+import letrec
+import implicit_refs
+
+from trees import copied, rebuilt, slot_names, subexpressions
+
+VAR_EXPS    = (letrec.VarExp, implicit_refs.VarExp)
+LET_EXPS    = (letrec.LetExp, implicit_refs.LetExp)
+LETREC_EXPS = (letrec.LetrecExp, implicit_refs.LetrecExp)
+CALL_EXPS   = (letrec.CallExp, implicit_refs.CallExp)
+
+
+def let_for_call(call: Expression) -> type:
+    """
+    The let of the same language as the given call.
+    """
+    if isinstance(call, TypedExpression):
+        return LetExpTyped
+    elif isinstance(call, implicit_refs.CallExp):
+        return implicit_refs.LetExp
+    else:
+        return letrec.LetExp
+
+
+class Binding:
+    """
+    A variable that a let, a letrec or a procedure binds.
+    """
+    __slots__ = ("name", "uses", "recursive", "assigned", "value", "suspended")
+
+    def __init__(self, var: str):
+        self.name = var        # In the optimized program, where it is renamed if it would shadow.
+        self.uses = 0          # In the part of the program that is left to optimize, plus in the optimized part.
+        self.recursive = 0     # For the procedure of a letrec, the uses in its own body.
+        self.assigned = False  # Whether a set changes it.
+        self.value: Optional[Expression] = None    # Optimized value that replaces every use, with a copy each.
+        self.suspended: Optional[ProcExp] = None   # Procedure that replaces its only use, and is optimized there.
+
+
+class Optimizer:
+
+    def __init__(self, program: Expression):
+        self.binders: Dict[int, Binding] = dict()     # By id of a let, a procedure, or a letrec (for its procedure).
+        self.parameters: Dict[int, Binding] = dict()  # By id of a letrec, the parameter of its procedure.
+        self.references: Dict[int, Binding] = dict()  # By id of a variable or set, the binding it refers to.
+        self.free: Set[str] = set()   # Variables the program uses but doesn't bind. Looking them up fails.
+        self.names: Set[str] = set()  # Every variable in the program, which new names must differ from.
+        self.renamed: Dict[str, int] = dict()
+        self.scope: Dict[str, Binding] = dict()  # The bindings around the part of the optimized program being built.
+        self.resolve(program)
+
+    def resolve(self, program: Expression):
+        """
+        Find the binding of every variable and set, and count the uses of every binding.
+        """
+        scope: Dict[str, List[Binding]] = dict()
+        todo = [program]  # Also (var, binding) to bind a variable, (var, None) to unbind it, and the procedure of a letrec once its body is done.
+        while todo:
+            item = todo.pop()
+            if item.__class__ is tuple:
+                var, binding = item
+                if binding is None:
+                    scope[var].pop()
+                else:
+                    scope.setdefault(var, []).append(binding)
+                    self.names.add(var)
+                continue
+            elif item.__class__ is Binding:
+                item.recursive = item.uses
+                continue
+
+            exp = item
+            if isinstance(exp, (*VAR_EXPS, SetExp)):
+                bindings = scope.get(exp.var)
+                if bindings:
+                    binding = self.references[id(exp)] = bindings[-1]
+                    binding.uses += 1
+                    binding.assigned |= isinstance(exp, SetExp)
+                else:
+                    self.free.add(exp.var)
+                    self.names.add(exp.var)
+                if isinstance(exp, SetExp):
+                    todo.append(exp.value_exp)
+            elif isinstance(exp, ProcExp):
+                binding = self.binders[id(exp)] = Binding(exp.var)
+                todo += [(exp.var, None), exp.body_exp, (exp.var, binding)]
+            elif isinstance(exp, LET_EXPS):
+                binding = self.binders[id(exp)] = Binding(exp.var)
+                todo += [(exp.var, None), exp.body_exp, (exp.var, binding), exp.val_exp]
+            elif isinstance(exp, LETREC_EXPS):
+                procedure = self.binders[id(exp)] = Binding(exp.procname)
+                parameter = self.parameters[id(exp)] = Binding(exp.procvar)
+                todo += [(exp.procname, None), exp.letbody, procedure, (exp.procvar, None), exp.procbody,
+                         (exp.procvar, parameter), (exp.procname, procedure)]
+            else:
+                todo.extend(subexpressions(exp))
+
+    ### Scope ###
+    def enter(self, binding: Binding):
+        if binding.name in self.scope or binding.name in self.free:
+            number = self.renamed.get(binding.name, 0)
+            while True:
+                number += 1
+                name = f"{binding.name}_{number}"
+                if name not in self.names:
+                    break
+            self.renamed[binding.name] = number
+            self.names.add(name)
+            binding.name = name
+        self.scope[binding.name] = binding
+
+    def leave(self, binding: Binding):
+        del self.scope[binding.name]
+
+    def is_safe(self, exp: Expression) -> bool:
+        """
+        Whether evaluating the optimized expression can neither fail nor loop, nor has any effect on the store that
+        can be seen.
+        """
+        return isinstance(exp, (ConstExp, ProcExp)) \
+            or isinstance(exp, VAR_EXPS) and exp.var in self.scope \
+            or isinstance(exp, IsZeroExp) and isinstance(exp.exp, ConstExp)
+
+    def copy(self, value: Expression) -> Expression:
+        if isinstance(value, VAR_EXPS):
+            self.scope[value.var].uses += 1
+        return copied(value)
+
+    def discard(self, exp: Expression):
+        """
+        Take the uses in an expression that is dropped, of the original program or of the optimized one, off the
+        counts. Variables of the optimized one are found by name, since it never shadows.
+        """
+        todo = [exp]
+        while todo:
+            exp = todo.pop()
+            if isinstance(exp, (*VAR_EXPS, SetExp)):
+                binding = self.references.get(id(exp)) or self.scope.get(exp.var)
+                if binding is not None:
+                    binding.uses -= 1
+            todo.extend(subexpressions(exp))
+
+    def take_procedure(self, operator: Expression) -> Optional[ProcExp]:
+        """
+        The procedure that a call calls, if it is known there: written in place, or suspended until its only use.
+        """
+        if isinstance(operator, ProcExp):
+            return operator
+        elif isinstance(operator, VAR_EXPS):
+            binding = self.references.get(id(operator))
+            if binding is not None and binding.suspended is not None:
+                binding.uses -= 1
+                procedure, binding.suspended = binding.suspended, None
+                return procedure
+        return None
+
+    ### Rewriting ###
+    def optimize(self, exp: Expression) -> Expression:
+        if isinstance(exp, VAR_EXPS):
+            binding = self.references.get(id(exp))
+            if binding is None:
+                return exp
+            elif binding.value is not None:
+                binding.uses -= 1
+                return self.copy(binding.value)
+            elif binding.suspended is not None:
+                binding.uses -= 1
+                procedure, binding.suspended = binding.suspended, None
+                return self.optimize(procedure)
+            return rebuilt(exp, var=binding.name)
+
+        elif isinstance(exp, DiffExp):
+            exp1, exp2 = self.optimize(exp.exp1), self.optimize(exp.exp2)
+            if isinstance(exp1, ConstExp) and isinstance(exp2, ConstExp):
+                return exp1.__class__(exp1.const - exp2.const)
+            return rebuilt(exp, exp1=exp1, exp2=exp2)
+
+        elif isinstance(exp, IfExp):
+            condition = self.optimize(exp.cond_exp)
+            if isinstance(condition, IsZeroExp) and isinstance(condition.exp, ConstExp):
+                taken, dropped = (exp.true_exp, exp.false_exp) if condition.exp.const == 0 else (exp.false_exp, exp.true_exp)
+                self.discard(dropped)
+                return self.optimize(taken)
+            return rebuilt(exp, cond_exp=condition, true_exp=self.optimize(exp.true_exp), false_exp=self.optimize(exp.false_exp))
+
+        elif isinstance(exp, CALL_EXPS):
+            procedure = self.take_procedure(exp.operator)
+            if procedure is not None:  # Evaluating the operand and then the body is just what a let does.
+                return self.optimize_let(let_for_call(exp)(procedure.var, exp.operand, procedure.body_exp), self.binders[id(procedure)])
+            return rebuilt(exp, operator=self.optimize(exp.operator), operand=self.optimize(exp.operand))
+
+        elif isinstance(exp, ProcExp):
+            binding = self.binders[id(exp)]
+            self.enter(binding)
+            body = self.optimize(exp.body_exp)
+            self.leave(binding)
+            return rebuilt(exp, var=binding.name, body_exp=body)
+
+        elif isinstance(exp, LET_EXPS):
+            return self.optimize_let(exp, self.binders[id(exp)])
+
+        elif isinstance(exp, LETREC_EXPS):
+            procedure, parameter = self.binders[id(exp)], self.parameters[id(exp)]
+            self.enter(procedure)
+            letbody = self.optimize(exp.letbody)
+            if procedure.uses == procedure.recursive and not procedure.assigned:  # Nothing but itself calls it.
+                self.leave(procedure)
+                self.discard(exp.procbody)
+                return letbody
+            self.enter(parameter)
+            procbody = self.optimize(exp.procbody)
+            self.leave(parameter)
+            self.leave(procedure)
+            return rebuilt(exp, procname=procedure.name, procvar=parameter.name, procbody=procbody, letbody=letbody)
+
+        elif isinstance(exp, SetExp):
+            binding = self.references.get(id(exp))
+            return rebuilt(exp, var=binding.name if binding is not None else exp.var, value_exp=self.optimize(exp.value_exp))
+
+        else:
+            changes = dict()
+            for name in slot_names(exp.__class__):
+                value = getattr(exp, name)
+                if isinstance(value, Expression):
+                    changes[name] = self.optimize(value)
+                elif isinstance(value, list):
+                    changes[name] = [self.optimize(element) for element in value]
+            return rebuilt(exp, **changes) if changes else exp
+
+    def optimize_let(self, exp: Expression, binding: Binding) -> Expression:
+        """
+        Inline the binding of a let into its body, drop it, or keep it.
+        """
+        if isinstance(exp.val_exp, ProcExp) and binding.uses <= 1 and not binding.assigned:
+            binding.suspended = exp.val_exp
+            body = self.optimize(exp.body_exp)
+            if binding.suspended is not None:  # Its use was dropped, or there was none.
+                self.discard(binding.suspended)
+                binding.suspended = None
+            return body
+
+        value = self.optimize(exp.val_exp)
+        if not binding.assigned and self.is_safe(value) and not isinstance(value, ProcExp) \
+                and not (isinstance(value, VAR_EXPS) and self.scope[value.var].assigned):
+            binding.value = value
+            body = self.optimize(exp.body_exp)
+            binding.value = None
+            self.discard(value)  # Every use got a copy of it.
+            return body
+
+        self.enter(binding)
+        body = self.optimize(exp.body_exp)
+        self.leave(binding)
+        if binding.uses == 0 and self.is_safe(value):
+            self.discard(value)
+            return body
+        return rebuilt(exp, var=binding.name, val_exp=value, body_exp=body)
+
+
+def optimize(program: Expression) -> Expression:
+    if isinstance(program, TypedExpression):
+        try:
+            type_of_program(program, context=Context())
+        except (TypeError, ValueError):
+            return program
+    return Optimizer(program).optimize(program)
+
+
+def count_nodes(exp: Expression) -> int:
+    count = 0
+    todo = [exp]
+    while todo:
+        count += 1
+        todo.extend(subexpressions(todo.pop()))
+    return count
+
+
+def is_tree(exp: Expression) -> bool:
+    """
+    Whether no node is in two places, which passes that keep something per node (closures, incremental) rely on.
+    """
+    seen = set()
+    todo = [exp]
+    while todo:
+        exp = todo.pop()
+        if id(exp) in seen:
+            return False
+        seen.add(id(exp))
+        todo.extend(subexpressions(exp))
+    return True
+
+
+def typing(exp: Expression) -> Optional[str]:
+    """
+    Whether a typed program is well-typed, or the error it fails with.
+    """
+    if not isinstance(exp, TypedExpression):
+        return None
+    try:
+        type_of_program(exp, context=Context())
+        return "well-typed"
+    except (TypeError, ValueError) as e:
+        return e.__class__.__name__
+
+
+def outcome(exp: Expression):
+    """
+    The value of a program, or the error it fails with.
+    """
+    try:
+        val = Program(exp, EmptyEnvironment(), Context()).value_of_program()
+        return val.__class__.__name__, getattr(val, "value", None)
+    except Exception as e:
+        return e.__class__.__name__, str(e)
+
+
+def check_equivalence(exp: Expression) -> Tuple[Expression, bool]:
+    """
+    Optimize a program, and check that both versions end the same way, and are typed the same way.
+    """
+    optimized = optimize(exp)
+    return optimized, outcome(exp) == outcome(optimized) and typing(exp) == typing(optimized) and is_tree(optimized)
+
+
+if __name__ == "__main__":
+    # Equivalence harness: optimize programs that cover every rewrite, and many generated ones, and compare the results.
+    from generator import generateProgram
+    from parser import stringToExpression
+    from printer import expression__repr__
+    from benchmarks.suite import best
+    import sys
+    import time
+
+    sys.setrecursionlimit(100_000)
+    handwritten = [
+        "let x = 7 in -(x, -(5, 3))",
+        "if zero?(-(3, 3)) then 1 else (proc (x) x zero?(0))",
+        "let f = proc (x) -(x, 1) in (f (f 3))",
+        "let y = 2 in let f = proc (x) -(x, y) in let y = 10 in (f y)",
+        "(proc (x) let y = x in -(y, x) 5)",
+        "letrec f (x) = (f x) in 5",
+        "let x = zero?(1) in 3",
+        "let x = -(1, zero?(1)) in 3",
+        "let x = undefined in 3",
+        "letrec f (n) = if zero?(n) then 0 else -((f -(n,1)), -(0,1)) in let g = proc (n) (f n) in (g 10)",
+        "let f = proc (y) let g = proc (x) -(x, y) in let y = -(y, 1) in (g y) in (f 5)",
+        "let x = 3 in let y = x in -(y, -(y, x))",
+        "let x = 1 in let f = proc (y) -(y, x) in if zero?(0) then 3 else (f 2)",
+        "let f = proc (x: int) -(x, zero?(1)) in 5",
+        "(proc (x: bool) x 1)",
+    ]
+    # let x = 5 in let y = x in begin set x = 6; -(x, y) end, which the parser can't read yet.
+    handwritten.append(implicit_refs.LetExp("x", ConstExp(5), implicit_refs.LetExp("y", implicit_refs.VarExp("x"), BeginExp([
+        implicit_refs.SetExp("x", ConstExp(6)),
+        DiffExp(implicit_refs.VarExp("x"), implicit_refs.VarExp("y"))
+    ]))))
+    for source in handwritten:
+        exp = stringToExpression(source) if isinstance(source, str) else source
+        optimized, same = check_equivalence(exp)
+        print(f"{'OK  ' if same else 'FAIL'} {expression__repr__(exp)}  ==>  {expression__repr__(optimized)}")
+        assert same
+
+    checked = 0
+    start = time.perf_counter()
+    for seed in range(300):
+        for typed, well_typed in [(False, True), (True, True), (False, False), (True, False)]:
+            exp = stringToExpression(generateProgram(300, seed=seed, typed=typed, well_typed=well_typed), Context(typed=typed))
+            optimized, same = check_equivalence(exp)
+            if not same:
+                print(f"FAIL: seed {seed}, typed={typed}, well_typed={well_typed}")
+            assert same
+            checked += 1
+    print(f"{checked} generated programs optimized to the same outcome in {time.perf_counter() - start:.1f} seconds.")
+
+    def best_ms(exp: Expression) -> float:
+        return best(lambda: Program(exp, EmptyEnvironment()).value_of_program(), 5)
+
+    exp = stringToExpression(generateProgram(100_000, seed=0))
+    start = time.perf_counter()
+    optimized = optimize(exp)
+    optimize_ms = 1000*(time.perf_counter() - start)
+    print(f"Generated program: {count_nodes(exp)} -> {count_nodes(optimized)} nodes in {optimize_ms:.0f} ms, "
+          f"evaluated in {best_ms(exp):.1f} -> {best_ms(optimized):.1f} ms.")
+
+    # Every node is visited once, so chains of lets that are all inlined take time in proportion to their length.
+    for length in [1000, 2000, 4000, 8000]:
+        exp = stringToExpression("".join(f"let v{i} = {'0' if i == 0 else f'-(v{i-1}, 1)'} in " for i in range(length)) + f"v{length - 1}")
+        start = time.perf_counter()
+        optimized = optimize(exp)
+        print(f"Chain of {length} lets: {1000*(time.perf_counter() - start):.0f} ms to {expression__repr__(optimized)}.")
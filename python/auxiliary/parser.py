@@ -7,15 +7,25 @@ Author: Thomas Bauwens
 Date: 2023-01-24
 """
 from inferred import *
+from typing import Iterable, Iterator, List, NamedTuple, TextIO, Union
 import re
 
-typed = False
+def stringToExpression(program: str, context: Context=None):
+    """
+    Whether the program is typed is decided by the context, or else guessed from whether it contains type annotations.
+    """
+    typed = getattr(context, "typed", None)  # Contexts of the untyped languages leave it to the program text.
+    if typed is None:
+        typed = COLON in program
+    return parse(tokenize(program), typed)
 
 
-def stringToExpression(program: str):
-    global typed
-    typed = COLON in program  # It causes less clutter to do this than to recursively pass the same argument over and over.
-    return parse(lex(program))
+def fileToExpression(file: TextIO, is_typed: bool=False):
+    """
+    Parses a program straight from a text file, which is read in chunks. The whole file is never held in memory, so
+    whether the program is typed cannot be sniffed from its text and has to be given instead.
+    """
+    return parse(tokenize(file), is_typed)
 
 
 LET     = "let"
@@ -31,206 +41,252 @@ ZEROTEST = "zero?"
 MINUS   = "-"
 COMMA   = ","
 COLON   = ":"
+EQUAL   = "="
 
-KEYWORDS = {LET, LETREC, IN, PROC, IF, THEN, ELSE, LEFT, RIGHT, ZEROTEST, MINUS, COMMA, COLON}
-
-TARGET_TO_HEADS = {   # When searching for this thing -> this thing means you have to find it a second time.
-    IN    : {LET, LETREC},
-    THEN  : {IF},
-    ELSE  : {THEN},
-    RIGHT : {LEFT},  # Note that commas by themselves never appear without their parenthesis.
-    COMMA : {MINUS},
-}
-HEAD_TO_TARGET = {
-    LET    : IN,
-    LETREC : IN,
-    IF     : THEN,
-    THEN   : ELSE,
-    LEFT   : RIGHT,
-    MINUS  : COMMA
-}
-
-
-def flatten(l: list):
-    flattened = []
-    for nested in l:
-        flattened.extend(nested)
-    return flattened
-
-
-def lex(s: str) -> list:
-    """
-    Converts a program string into a flat list of meaningful tokens.
-    """
-    s = s.replace("\n", " ")
-    s = s.split(" ")
-    s = flatten([re.compile(r"([(),:])").split(t) for t in s])
-    s = [t for t in s if t != ""]
-    return s
+KEYWORDS = {LET, LETREC, IN, PROC, IF, THEN, ELSE, LEFT, RIGHT, ZEROTEST, MINUS, COMMA, COLON, EQUAL}
 
 
-def findUnmatched(tokens: list, target: str):
-    """
-    Finds the first unmatched occurrence of the target token in the list.
+class Token(NamedTuple):
+    text: str
+    offset: int  # Counted in characters from the start of the source, starting at 0.
+    line: int    # Starting at 1.
+    column: int  # Starting at 1.
+
+
+TOKEN_PATTERN = re.compile(r"(\s+)|([(),:])|[^\s(),:]+")  # Whitespace, punctuation, or anything else up to either of those.
+WHITESPACE  = 1
+PUNCTUATION = 2
+CHUNK_SIZE = 1 << 16
+
+
+def tokenize(source: Union[str, TextIO], chunk_size: int=CHUNK_SIZE) -> Iterator[Token]:
     """
-    heads = TARGET_TO_HEADS.get(target, set())
+    Converts a program into a stream of meaningful tokens, in one regex pass. The source can be a string or a text file,
+    which is then read in chunks of the given size. Tokens are generated as the parser asks for them.
 
-    stack = 0
-    for idx, token in enumerate(tokens):
-        if token == target:
-            if not stack:
-                return idx
+    A word that touches the end of a chunk might continue in the next chunk, so it is held back until then.
+    """
+    if isinstance(source, str):
+        chunks = iter((source,))
+    else:
+        chunks = iter(lambda: source.read(chunk_size), "")
+
+    line = 1
+    line_start = 0   # Offset of the first character on the current line.
+    base = 0         # Offset of the first character in the buffer.
+    pending = ""
+    for chunk in chunks:
+        buffer = pending + chunk
+        consumed = 0
+        for match in TOKEN_PATTERN.finditer(buffer):
+            kind = match.lastindex  # Index of the group that matched, or None for a word.
+            if kind == WHITESPACE:
+                text = match.group()
+                newlines = text.count("\n")
+                if newlines:
+                    line += newlines
+                    line_start = base + match.start() + text.rfind("\n") + 1
+            elif kind != PUNCTUATION and match.end() == len(buffer):
+                break
             else:
-                stack -= 1
-        elif token in heads:
-            stack += 1
+                offset = base + match.start()
+                yield Token(match.group(), offset, line, offset - line_start + 1)
+            consumed = match.end()
+
+        pending = buffer[consumed:]
+        base += consumed
 
-    raise ValueError(f"Target not found: {target} in {tokens}")
+    if pending:
+        yield Token(pending, base, line, base - line_start + 1)
 
 
-def pop0many(lst: list, amount: int):
+def lex(s: str) -> List[Token]:
     """
-    In-place pop(0) many times.
+    Converts a program string into a flat list of meaningful tokens.
+    Only useful when the tokens are needed more than once; the parser itself is happy with the stream from tokenize().
     """
-    return [lst.pop(0) for _ in range(amount)]
+    return list(tokenize(s))
 
 
-def nextGroup(tokens: list, target: str) -> list:
+class TokenCursor:
     """
-    Combines findUnmatched with pop0many.
-    The returned subexpression is removed entirely from the given list.
+    Reads through a stream of tokens one at a time. Only the token under the cursor is kept, so the full list of
+    tokens never has to exist. Every construct in the grammar can be recognised from its first token, so no more
+    lookahead than that is ever needed.
+
+    The cursor also carries whether the program is typed, since every parsing function needs to know that.
     """
-    index      = findUnmatched(tokens, target)
-    expression = pop0many(tokens, index)
-    tokens.pop(0)  # pop the target
-    return expression
 
+    def __init__(self, tokens: Iterable[Token], typed: bool=False):
+        self.tokens = iter(tokens)
+        self.typed = typed
+        self.current = next(self.tokens, None)
+        self.last = None
 
-def parse(lexed: list) -> Expression:
-    """
-    Turn a list of tokens into an expression.
+    def atEnd(self) -> bool:
+        return self.current is None
+
+    def next(self) -> str:
+        token = self.current
+        if token is None:
+            raise ValueError(f"Unexpected end of program{' after ' + where(self.last) if self.last else ''}.")
+        self.last = token
+        self.current = next(self.tokens, None)
+        return token.text
+
+    def expect(self, expected: str):
+        text = self.next()
+        if text != expected:
+            raise ValueError(f"Expected '{expected}' but found '{text}' at {where(self.last)}.")
 
-    More precisely: pops the first token off the list. If this token is a keyword, then all following tokens that belong
-    to its subexpression are popped from the list too and parsed recursively. Else, it is just an identifier/number.
+    def expression(self) -> "Expression":
+        """
+        Parse the expression that starts under the cursor. Subclasses can hook into every (sub)expression here.
+        """
+        return parseExpression(self)
+
+
+def where(token: Token) -> str:
+    return f"line {token.line}, column {token.column}"
+
+
+def parse(lexed: Iterable[Token], typed: bool=False) -> Expression:
+    """
+    Turn a stream of tokens into an expression. All tokens have to be used.
     """
-    if not lexed:
+    return parseProgram(TokenCursor(lexed, typed))
+
+
+def parseProgram(tokens: TokenCursor) -> Expression:
+    if tokens.atEnd():
         raise ValueError("Cannot parse empty expression.")
 
-    final_exp: Expression = None
+    final_exp = tokens.expression()
+    if not tokens.atEnd():
+        raise ValueError(f"Unexpected '{tokens.current.text}' after the end of the program at {where(tokens.current)}.")
+    return final_exp
 
-    head = lexed.pop(0)
-    if head == PROC:
-        if typed:
-            leftparen, var, colon, var_type, rightparen = pop0many(lexed, 5)
-            body = lexed
 
-            final_exp = ProcExpTyped(var, parse(body), parseType(var_type))
+def parseExpression(tokens: TokenCursor) -> Expression:
+    """
+    Recursive descent: reads the first token under the cursor. If this token is a keyword, then all following tokens
+    that belong to its subexpression are read too, parsing subexpressions recursively. Else, it is just an
+    identifier/number.
+
+    Every expression ends by itself (nothing in the grammar comes after a body), so there is never a need to look ahead
+    for the token that closes the expression. That's what makes a single pass enough.
+    """
+    head = tokens.next()
+    if head == PROC:
+        tokens.expect(LEFT)
+        var = parseIdentifier(tokens)
+        if tokens.typed:
+            tokens.expect(COLON)
+            var_type = parseType(tokens.next())
+            tokens.expect(RIGHT)
+
+            return ProcExpTyped(var, tokens.expression(), var_type)
         else:
-            leftparen, var, rightparen = pop0many(lexed, 3)
-            body = lexed
+            tokens.expect(RIGHT)
 
-            final_exp = ProcExp(var, parse(body))
+            return ProcExp(var, tokens.expression())
 
     elif head == LET:
-        var, equal = pop0many(lexed, 2)
-        val_body = nextGroup(lexed, IN)
-        let_body = lexed
-
-        if typed:
-            final_exp = LetExpTyped(var, parse(val_body), parse(let_body))
+        var = parseIdentifier(tokens)
+        tokens.expect(EQUAL)
+        val_exp = tokens.expression()
+        tokens.expect(IN)
+        let_body = tokens.expression()
+
+        if tokens.typed:
+            return LetExpTyped(var, val_exp, let_body)
         else:
-            final_exp = LetExp(var, parse(val_body), parse(let_body))
+            return LetExp(var, val_exp, let_body)
 
     elif head == LETREC:
-        if typed:
-            return_type, name, leftparen, var, colon, var_type, rightparen, equal = pop0many(lexed, 8)
-            proc_body = nextGroup(lexed, IN)
-            let_body = lexed
-
-            final_exp = LetrecExpTyped(name, var,
-                parse(proc_body),
-                parse(let_body),
-                parseType(return_type), parseType(var_type)
-            )
+        if tokens.typed:
+            return_type = parseType(tokens.next())
+        name = parseIdentifier(tokens)
+        tokens.expect(LEFT)
+        var = parseIdentifier(tokens)
+        if tokens.typed:
+            tokens.expect(COLON)
+            var_type = parseType(tokens.next())
+        tokens.expect(RIGHT)
+        tokens.expect(EQUAL)
+        proc_body = tokens.expression()
+        tokens.expect(IN)
+        let_body = tokens.expression()
+
+        if tokens.typed:
+            return LetrecExpTyped(name, var, proc_body, let_body, return_type, var_type)
         else:
-            name, leftparen, var, rightparen, equal = pop0many(lexed, 5)
-            proc_body = nextGroup(lexed, IN)
-            let_body = lexed
-
-            final_exp = LetrecExp(name, var,
-                parse(proc_body),
-                parse(let_body)
-            )
+            return LetrecExp(name, var, proc_body, let_body)
 
     elif head == IF:
-        condition = nextGroup(lexed, THEN)
-        then_body = nextGroup(lexed, ELSE)
-        else_body = lexed
-
-        if typed:
-            final_exp = IfExpTyped(
-                parse(condition),
-                parse(then_body),
-                parse(else_body)
-            )
+        condition = tokens.expression()
+        tokens.expect(THEN)
+        then_body = tokens.expression()
+        tokens.expect(ELSE)
+        else_body = tokens.expression()
+
+        if tokens.typed:
+            return IfExpTyped(condition, then_body, else_body)
         else:
-            final_exp = IfExp(
-                parse(condition),
-                parse(then_body),
-                parse(else_body)
-            )
+            return IfExp(condition, then_body, else_body)
 
     elif head == MINUS:
-        lexed.pop(0)  # (
-
-        diff1_body = nextGroup(lexed, COMMA)
-        diff2_body = nextGroup(lexed, RIGHT)
-
-        if typed:
-            final_exp = DiffExpTyped(
-                parse(diff1_body),
-                parse(diff2_body)
-            )
+        tokens.expect(LEFT)
+        diff1 = tokens.expression()
+        tokens.expect(COMMA)
+        diff2 = tokens.expression()
+        tokens.expect(RIGHT)
+
+        if tokens.typed:
+            return DiffExpTyped(diff1, diff2)
         else:
-            final_exp = DiffExp(
-                parse(diff1_body),
-                parse(diff2_body)
-            )
+            return DiffExp(diff1, diff2)
 
     elif head == LEFT:
-        call_body = nextGroup(lexed, RIGHT)
-        operator_exp = parse(call_body)  # There is no comma that stops the operator and starts the operand. We let the operator consume as much as it can recognise.
-        operand_exp  = parse(call_body)
+        operator_exp = tokens.expression()  # There is no comma that stops the operator and starts the operand. We let the operator consume as much as it can recognise.
+        operand_exp  = tokens.expression()
+        tokens.expect(RIGHT)
 
-        if typed:
-            final_exp = CallExpTyped(operator_exp, operand_exp)
+        if tokens.typed:
+            return CallExpTyped(operator_exp, operand_exp)
         else:
-            final_exp = CallExp(operator_exp, operand_exp)
+            return CallExp(operator_exp, operand_exp)
 
     elif head == ZEROTEST:
-        lexed.pop(0)  # (
-        tested_body = nextGroup(lexed, RIGHT)
+        tokens.expect(LEFT)
+        tested = tokens.expression()
+        tokens.expect(RIGHT)
 
-        if typed:
-            final_exp = IsZeroExpTyped(parse(tested_body))
+        if tokens.typed:
+            return IsZeroExpTyped(tested)
         else:
-            final_exp = IsZeroExp(parse(tested_body))
+            return IsZeroExp(tested)
 
     else:  # Identifier or number
-        if head.isnumeric():
-            if typed:
-                final_exp = ConstExpTyped(head)
+        if head.isdecimal():
+            if tokens.typed:
+                return ConstExpTyped(int(head))
             else:
-                final_exp = ConstExp(head)
-        elif head.isidentifier():
-            if typed:
-                final_exp = VarExpTyped(head)
+                return ConstExp(int(head))
+        elif head.isidentifier() and head not in KEYWORDS:
+            if tokens.typed:
+                return VarExpTyped(head)
             else:
-                final_exp = VarExp(head)
+                return VarExp(head)
         else:
-            raise ValueError(f"Weird symbol found: {head}")
+            raise ValueError(f"Weird symbol found at {where(tokens.last)}: {head}")
 
-    return final_exp
+
+def parseIdentifier(tokens: TokenCursor) -> str:
+    name = tokens.next()
+    if not name.isidentifier() or name in KEYWORDS:
+        raise ValueError(f"Expected an identifier but found '{name}' at {where(tokens.last)}.")
+    return name
 
 
 def parseType(annotation: str) -> Typish:
@@ -239,9 +295,9 @@ def parseType(annotation: str) -> Typish:
     annotation, but could still be the type of an expression.
     """
     if annotation == "int":
-        return BaseType("int")
+        return INT_TYPE
     elif annotation == "bool":
-        return BaseType("bool")
+        return BOOL_TYPE
     elif annotation == "?":
         return UnknownType()
     else:
@@ -272,9 +328,10 @@ if __name__ == "__main__":
 
     from printer import *
 
-    exp = stringToExpression(s)
+    context = Context()
+    exp = stringToExpression(s, context)
     sub = Substitution()
-    prog_type: Type = exp.type_of(EmptyEnvironmentTyped(), sub)
+    prog_type: Type = type_of_program(exp, sub=sub, context=context)
     print(expression__repr__(exp))
     print(substitution__repr__(sub))
-    print(type__repr__(sub.applyThisToType(prog_type)))
+    print(type__repr__(prog_type))
@@ -6,71 +6,204 @@ support methods that are not needed for the interpreter to work. This is one of
 language with "type classes" (Haskell) or "traits" (Rust) shines, since they allow adding methods to existing classes
 in other files.
 
+The printer doesn't recurse: it keeps a stack of what is left to print, so trees of any depth can be printed. Output is
+collected in pieces that are written to a text sink (a file, io.StringIO ...) a few thousand at a time, so printing
+takes time linear in the size of the output, and little memory besides. The __repr__ functions give the same output as a string.
+
+With a width, every subexpression that fits on the rest of the line is printed on one line, and only the ones that
+don't are broken up over lines like they are without a width.
+
 TODO: extend to other languages.
 
 Author: Thomas Bauwens
 Date: 2023-01-24
 """
 from inferred import *
+from io import StringIO
+from typing import Callable, List, TextIO, Tuple, Union
+import letrec
 
 
 TAB = "\t"
+TAB_WIDTH = 4  # Columns that a TAB counts for when fitting a line to a width.
 
+VAR_EXPS    = (letrec.VarExp, VarExp)
+CALL_EXPS   = (letrec.CallExp, CallExp)
+LET_EXPS    = (letrec.LetExp, LetExp)
+LETREC_EXPS = (letrec.LetrecExp, LetrecExp)
 
-def expression__repr__(exp: Expression, indent=0) -> str:
-    if isinstance(exp, VarExp):
-        return exp.var
-    elif isinstance(exp, ConstExp):
-        return str(exp.const)
-    elif isinstance(exp, ProcExp):
-        if isinstance(exp, ProcExpTyped):
-            return "proc (" + exp.var + ": " + type__repr__(exp.tv) + ") " + expression__repr__(exp.body_exp, indent+1)
-        else:
-            return "proc (" + exp.var + ") " + expression__repr__(exp.body_exp, indent+1)
-    elif isinstance(exp, CallExp):
-        return "({" + expression__repr__(exp.operator, indent+1) + "} " + expression__repr__(exp.operand, indent+1) + ")"
-    elif isinstance(exp, LetExp):
-        return "let " + exp.var + " = " + expression__repr__(exp.val_exp, indent+1) + \
-            "\n" + indent*TAB + "in " + expression__repr__(exp.body_exp, indent+1)
-    elif isinstance(exp, LetrecExp):
-        if isinstance(exp, LetrecExpTyped):
-            return "letrec " + type__repr__(exp.tr) + " " + exp.procname + " (" + exp.procvar + ": " + type__repr__(exp.tv) + ") = " + expression__repr__(exp.procbody, indent+1) + \
-                "\n" + indent*TAB + "in " + expression__repr__(exp.letbody, indent+1)
-        else:
-            return "letrec " + exp.procname + " (" + exp.procvar + ") = " + expression__repr__(exp.procbody, indent+1) + \
-                "\n" + indent*TAB + "in " + expression__repr__(exp.letbody, indent+1)
-    elif isinstance(exp, IsZeroExp):
-        return "zero?(" + expression__repr__(exp.exp, indent+1) + ")"
-    elif isinstance(exp, IfExp):
-        return "if " + expression__repr__(exp.cond_exp, indent+1) + \
-            "\n" + indent*TAB + "then " + expression__repr__(exp.true_exp, indent+1) + \
-            "\n" + indent*TAB + "else " + expression__repr__(exp.false_exp, indent+1)
-    elif isinstance(exp, DiffExp):
-        return "{" + expression__repr__(exp.exp1, indent+1) + " - " + expression__repr__(exp.exp2, indent+1) + "}"
-    else:
-        return "{PRINTER}"
 
+CHUNKS = 2**12  # Pieces of text to collect before writing them to the sink at once.
 
-def type__repr__(type_to_print: Type) -> str:
-    if isinstance(type_to_print, ProcType):
-        part1 = type__repr__(type_to_print.t1)
-        if isinstance(type_to_print.t1, ProcType):
-            part1 = "(" + part1 + ")"
 
-        part2 = type__repr__(type_to_print.t2)
-        if isinstance(type_to_print.t2, ProcType):
-            part2 = "(" + part2 + ")"
+# What is left to print: text, a line break with the given indentation, or an expression at the given indentation
+# that is either printed on one line (flat) or not.
+Item = Union[str, int, Tuple[Expression, int, bool]]
+Layout = Callable[[Expression, int, bool], List[Item]]
+
+
+def layout_proc(exp: ProcExp, indent: int, flat: bool) -> List[Item]:
+    return ["proc (" + exp.var + ") ", (exp.body_exp, indent+1, flat)]
+
+def layout_proc_typed(exp: ProcExpTyped, indent: int, flat: bool) -> List[Item]:
+    return ["proc (" + exp.var + ": " + type__repr__(exp.tv) + ") ", (exp.body_exp, indent+1, flat)]
+
+def layout_call(exp: CallExp, indent: int, flat: bool) -> List[Item]:
+    return ["({", (exp.operator, indent+1, flat), "} ", (exp.operand, indent+1, flat), ")"]
 
-        return part1 + " -> " + part2
+def layout_let(exp: LetExp, indent: int, flat: bool) -> List[Item]:
+    return ["let " + exp.var + " = ", (exp.val_exp, indent+1, flat), " " if flat else indent, "in ", (exp.body_exp, indent+1, flat)]
 
-    elif isinstance(type_to_print, BaseType):
-        return type_to_print.name
+def layout_letrec(exp: LetrecExp, indent: int, flat: bool) -> List[Item]:
+    return ["letrec " + exp.procname + " (" + exp.procvar + ") = ", (exp.procbody, indent+1, flat),
+            " " if flat else indent, "in ", (exp.letbody, indent+1, flat)]
 
-    elif isinstance(type_to_print, TypeVariable):
-        return f"t_{type_to_print.num}"
+def layout_letrec_typed(exp: LetrecExpTyped, indent: int, flat: bool) -> List[Item]:
+    return ["letrec " + type__repr__(exp.tr) + " " + exp.procname + " (" + exp.procvar + ": " + type__repr__(exp.tv) + ") = ",
+            (exp.procbody, indent+1, flat), " " if flat else indent, "in ", (exp.letbody, indent+1, flat)]
 
-    elif isinstance(type_to_print, UnknownType):
-        return "?"
+def layout_iszero(exp: IsZeroExp, indent: int, flat: bool) -> List[Item]:
+    return ["zero?(", (exp.exp, indent+1, flat), ")"]
+
+def layout_if(exp: IfExp, indent: int, flat: bool) -> List[Item]:
+    separator = " " if flat else indent
+    return ["if ", (exp.cond_exp, indent+1, flat), separator, "then ", (exp.true_exp, indent+1, flat),
+            separator, "else ", (exp.false_exp, indent+1, flat)]
+
+def layout_diff(exp: DiffExp, indent: int, flat: bool) -> List[Item]:
+    return ["{", (exp.exp1, indent+1, flat), " - ", (exp.exp2, indent+1, flat), "}"]
+
+
+def layout_for(cls: type) -> Layout:
+    if issubclass(cls, VAR_EXPS):
+        return lambda exp, indent, flat: [exp.var]
+    elif issubclass(cls, ConstExp):
+        return lambda exp, indent, flat: [str(exp.const)]
+    elif issubclass(cls, ProcExp):
+        return layout_proc_typed if issubclass(cls, ProcExpTyped) else layout_proc
+    elif issubclass(cls, CALL_EXPS):
+        return layout_call
+    elif issubclass(cls, LET_EXPS):
+        return layout_let
+    elif issubclass(cls, LETREC_EXPS):
+        return layout_letrec_typed if issubclass(cls, LetrecExpTyped) else layout_letrec
+    elif issubclass(cls, IsZeroExp):
+        return layout_iszero
+    elif issubclass(cls, IfExp):
+        return layout_if
+    elif issubclass(cls, DiffExp):
+        return layout_diff
+    else:
+        return lambda exp, indent, flat: ["{PRINTER}"]
+
+
+LAYOUTS: Dict[type, Layout] = dict()
+
+
+def layout(exp: Expression, indent: int, flat: bool) -> List[Item]:
+    """
+    How to print one expression, in terms of its subexpressions.
+    """
+    function = LAYOUTS.get(exp.__class__)
+    if function is None:
+        function = LAYOUTS[exp.__class__] = layout_for(exp.__class__)
+    return function(exp, indent, flat)
+
+
+def flat_lengths(exp: Expression, limit: int) -> Dict[Expression, int]:
+    """
+    For every subexpression, the length it has on one line, or the limit if it is longer than that.
+    """
+    lengths = dict()
+    todo = [(exp, None)]
+    while todo:
+        exp, items = todo.pop()
+        if items is not None:  # All subexpressions have been measured.
+            length = sum(len(item) if item.__class__ is str else lengths[item[0]] for item in items)
+            lengths[exp] = min(length, limit)
+        elif exp not in lengths:
+            items = layout(exp, 0, True)
+            todo.append((exp, items))
+            todo.extend((item[0], None) for item in items if item.__class__ is tuple)
+    return lengths
+
+
+def write_expression(exp: Expression, out: TextIO, indent: int=0, width: Optional[int]=None):
+    lengths = flat_lengths(exp, width + 1) if width is not None else None
+    chunks = []
+    column = 0
+    todo: List[Item] = [(exp, indent, False)]
+    while todo:
+        item = todo.pop()
+        if item.__class__ is str:
+            chunks.append(item)
+            column += len(item)
+            if len(chunks) >= CHUNKS:
+                out.write("".join(chunks))
+                chunks.clear()
+        elif item.__class__ is int:
+            chunks.append("\n" + item*TAB)
+            column = item*TAB_WIDTH
+        else:
+            exp, indent, flat = item
+            if not flat and lengths is not None:
+                flat = lengths[exp] <= width - column
+            todo.extend(reversed(layout(exp, indent, flat)))
+    out.write("".join(chunks))
+
+
+def write_type(type_to_print: Type, out: TextIO, sub: Substitution=None):
+    """
+    With a substitution, the type is printed with the substitution applied to it.
+    """
+    chunks = []
+    todo: List[Union[str, Typish]] = [type_to_print]
+    while todo:
+        item = todo.pop()
+        if sub is not None and isinstance(item, TypeVariable):
+            item = sub.find(item)
+
+        if isinstance(item, str):
+            chunks.append(item)
+        elif isinstance(item, ProcType):
+            t1, t2 = (sub.find(item.t1), sub.find(item.t2)) if sub is not None else (item.t1, item.t2)
+            parts = ["(", t1, ")"] if isinstance(t1, ProcType) else [t1]
+            parts.append(" -> ")
+            parts.extend(["(", t2, ")"] if isinstance(t2, ProcType) else [t2])
+            todo.extend(reversed(parts))
+        elif isinstance(item, BaseType):
+            chunks.append(item.name)
+        elif isinstance(item, TypeVariable):
+            chunks.append(f"t_{item.num}")
+        elif isinstance(item, UnknownType):
+            chunks.append("?")
+    out.write("".join(chunks))
+
+
+def write_substitution(sub: Substitution, out: TextIO):
+    """
+    Every rule on its own line, with the substitution applied to its body, like the rules property gives them.
+    """
+    out.write("{\n")
+    for head in sub.heads:
+        out.write("\t(")
+        write_type(head, out)
+        out.write(", ")
+        write_type(head, out, sub)
+        out.write(")\n")
+    out.write("}")
+
+
+def expression__repr__(exp: Expression, indent=0, width: Optional[int]=None) -> str:
+    out = StringIO()
+    write_expression(exp, out, indent, width)
+    return out.getvalue()
+
+
+def type__repr__(type_to_print: Type) -> str:
+    out = StringIO()
+    write_type(type_to_print, out)
+    return out.getvalue()
 
 
 def rule__repr__(rule: Rule):
@@ -78,7 +211,9 @@ def rule__repr__(rule: Rule):
 
 
 def substitution__repr__(sub: Substitution):
-    return "{\n" + "".join(["\t" + rule__repr__(r) + "\n" for r in sub.rules]) + "}"
+    out = StringIO()
+    write_substitution(sub, out)
+    return out.getvalue()
 
 
 if __name__ == "__main__":
@@ -89,4 +224,4 @@ if __name__ == "__main__":
     rhs = ProcType(BaseType("bool"), ProcType(TypeVariable(3), TypeVariable(4)))
 
     lhs.unify(rhs, sub)
-    print(substitution__repr__(sub))
\ No newline at end of file
+    print(substitution__repr__(sub))
@@ -0,0 +1,189 @@
+"""
+A profiler for LETREC programs rather than for the Python code that runs them: it measures how much time goes to every
+procedure of the program, along every chain of calls that leads to it.
+
+Procedures get the name they were bound to, by a letrec or by a let. Any other procedure is named after its variable,
+as "proc(x)". While profiling, calls go through a layer (see letrec.layered) that keeps the stack of procedures that are
+running, and the time between entering and leaving them is added to that stack. The result is a tree of stacks, which
+can be written in the collapsed-stack format that flame graph tools (flamegraph.pl, speedscope, inferno ...) read:
+
+    with profile(exp) as result:
+        Program(exp, EmptyEnvironment()).value_of_program()
+    result.write_collapsed(open("program.folded", "w"))
+
+Only the tree-walking interpreters call apply_procedure, so the other evaluators can't be profiled this way. The
+profile is only kept for the thread that started it.
+"""
+from inferred import *
+from contextlib import contextmanager
+from time import perf_counter_ns
+from typing import Dict, Iterator, List, TextIO, Tuple
+import letrec
+import implicit_refs
+
+ROOT = "<program>"
+
+
+class Frame:
+    """
+    One stack of procedure calls: the procedure on top of it, and the stacks that continue from it.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.self_ns = 0  # Spent in this procedure itself, not in the procedures it called.
+        self.children: Dict[str, "Frame"] = dict()
+
+    def child(self, name: str) -> "Frame":
+        frame = self.children.get(name)
+        if frame is None:
+            frame = self.children[name] = Frame(name)
+        return frame
+
+
+class Profile:
+
+    def __init__(self, names: Dict[Expression, str], merge_recursion: bool=False):
+        """
+        :param names: for the body of every named procedure, its name.
+        :param merge_recursion: whether a procedure calling itself directly stays one frame. Otherwise, deep recursion
+                                gives stacks as deep as the recursion.
+        """
+        self.names = names
+        self.merge_recursion = merge_recursion
+        self.root = Frame(ROOT)
+
+        self.stack: List[Frame] = [self.root]
+        self.children_ns: List[int] = [0]  # For every frame on the stack, the time spent in the ones above it.
+
+    def name(self, proc: ProcVal) -> str:
+        name = self.names.get(proc.body)
+        return name if name is not None else f"proc({proc.var})"
+
+    def stacks(self) -> Iterator[Tuple[List[str], Frame]]:
+        """
+        Every stack that was seen, from the bottom up, with its top frame.
+        """
+        todo = [([self.root.name], self.root)]
+        while todo:
+            path, frame = todo.pop()
+            yield path, frame
+            for name, child in frame.children.items():
+                todo.append((path + [name], child))
+
+    def totals(self) -> Dict[str, Tuple[int, int]]:
+        """
+        For every procedure, how often it was called and how much time was spent in it itself, whatever called it.
+        """
+        totals = dict()
+        for _, frame in self.stacks():
+            calls, self_ns = totals.get(frame.name, (0, 0))
+            totals[frame.name] = (calls + frame.calls, self_ns + frame.self_ns)
+        return totals
+
+    def collapsed(self) -> Iterator[str]:
+        """
+        One line per stack: the names of its frames separated by semicolons, and the microseconds spent on top of it.
+        """
+        for path, frame in self.stacks():
+            microseconds = frame.self_ns // 1000
+            if microseconds:
+                yield f"{';'.join(path)} {microseconds}"
+
+    def write_collapsed(self, file: TextIO):
+        for line in self.collapsed():
+            file.write(line + "\n")
+
+    def __repr__(self):
+        lines = [f"{'procedure':<20} {'calls':>8} {'self (ms)':>10}"]
+        for name, (calls, self_ns) in sorted(self.totals().items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<20} {calls:>8} {self_ns/1e6:>10.2f}")
+        return "\n".join(lines)
+
+
+def procedure_names(exp: Expression) -> Dict[Expression, str]:
+    """
+    Find the name of every procedure in a program, by the expression that is its body.
+    """
+    names = dict()
+    todo = [exp]
+    while todo:
+        exp = todo.pop()
+        if isinstance(exp, (letrec.LetrecExp, implicit_refs.LetrecExp)):
+            names[exp.procbody] = exp.procname
+        elif isinstance(exp, (letrec.LetExp, implicit_refs.LetExp)) and isinstance(exp.val_exp, ProcExp):
+            names[exp.val_exp.body_exp] = exp.var
+        for field in fields(exp):
+            if isinstance(field, Expression):
+                todo.append(field)
+            elif isinstance(field, list):  # The subexpressions of a BeginExp.
+                todo.extend(field)
+    return names
+
+
+def profiled(profile: Profile) -> Layer:
+    def layer(apply: Apply) -> Apply:
+        def apply_procedure(proc: ProcVal, arg: DenVal) -> ExpVal:
+            caller = profile.stack[-1]
+            name = profile.name(proc)
+            frame = caller if profile.merge_recursion and caller.name == name else caller.child(name)
+            frame.calls += 1
+            profile.stack.append(frame)
+            profile.children_ns.append(0)
+            start = perf_counter_ns()
+            try:
+                return apply(proc, arg)
+            finally:
+                elapsed = perf_counter_ns() - start
+                profile.stack.pop()
+                frame.self_ns += elapsed - profile.children_ns.pop()
+                profile.children_ns[-1] += elapsed
+        return apply_procedure
+    return layer
+
+
+@contextmanager
+def profile(exp: Expression, merge_recursion: bool=False) -> Iterator[Profile]:
+    """
+    Profile the given program while it runs in a with-block. Time spent outside of any procedure goes to the root.
+    """
+    result = Profile(procedure_names(exp), merge_recursion)
+    start = perf_counter_ns()
+    try:
+        with layered(profiled(result)):
+            yield result
+    finally:
+        result.root.calls += 1
+        result.root.self_ns += perf_counter_ns() - start - result.children_ns[0]
+
+
+if __name__ == "__main__":
+    from parser import stringToExpression
+    import sys
+
+    sys.setrecursionlimit(20_000)
+    exp = stringToExpression("""
+        let zero = proc (f) proc (x) x
+        in let succ = proc (n) proc (f) proc (x) (f ((n f) x))
+        in let mult = proc (m) proc (n) proc (f) (m (n f))
+        in letrec church (k) = if zero?(k) then zero else (succ (church -(k,1)))
+        in let toint = proc (n) ((n proc (v) -(v,-(0,1))) 0)
+        in (toint ((mult (church 20)) (church 20)))
+    """)
+    with profile(exp, merge_recursion=True) as result:
+        print(Program(exp, EmptyEnvironment()).value_of_program())
+    print(result)
+    result.write_collapsed(sys.stdout)
+
+    # Layers nest, so a profile inside another one sees the same calls, and both stop seeing them afterwards.
+    with profile(exp) as outer:
+        with profile(exp) as inner:
+            Program(exp, EmptyEnvironment()).value_of_program()
+        Program(exp, EmptyEnvironment()).value_of_program()
+    Program(exp, EmptyEnvironment()).value_of_program()
+    outer_calls = {name: calls for name, (calls, _) in outer.totals().items() if name != ROOT}
+    inner_calls = {name: calls for name, (calls, _) in inner.totals().items() if name != ROOT}
+    assert outer_calls == {name: 2*calls for name, calls in inner_calls.items()}, (outer_calls, inner_calls)
+    assert CURRENT_APPLY.get() is None
+    print("Nested profiles agree.")
@@ -0,0 +1,321 @@
+"""
+Incremental parsing for programs that are edited over and over, like in an editor.
+
+An IncrementalParser holds the source of a program, its tokens and its tree. An edit (offset, amount of characters
+removed, text inserted) only re-lexes the text around the edit, and the parse after it reuses every subtree whose tokens
+are all outside of the part that changed:
+
+    parser = IncrementalParser(source)
+    tree = parser.edit(120, 1, "42")  # Replace the character at offset 120 by "42".
+
+Re-lexing starts at the token the edit touches, and stops at the first token that starts where an old token starts
+(after the edit, shifted by the change in length). From any token on, the lexer gives the same tokens for the same
+text, so all tokens after that one are the old ones. Their offsets aren't all shifted on every edit: like the gap of a
+gap buffer, one shift is kept for all tokens from a boundary on, and the boundary moves to where the next edit is. An
+edit hence costs time in the distance to the last one, rather than in the length of the program.
+
+Every expression is parsed from its own tokens only (nothing in the grammar looks past the end of an expression), so an
+old subtree whose tokens didn't change is what parsing them again would give. For every node, the parser remembers how
+many tokens it spans and where its subexpressions start in it. Since both are relative to the node itself, they stay
+valid when the node moves. The parse asks for old nodes at increasing tokens, so it finds each one by walking down from
+the last one it found (see OldNodes), rather than from the root. The new tree hence is equal to a fresh parse of the
+new source, and shares everything that didn't change with the old tree. That is exactly what IncrementalInference needs
+to type it again quickly.
+
+When the new source doesn't parse, the edit is still applied to the source, the error is raised, and the next edit
+parses the whole program again.
+"""
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+from parser import *
+
+PRUNE_MINIMUM = 10_000  # Shapes to keep before the ones of nodes that are no longer used are looked for.
+
+Shape = Tuple[int, Tuple[Tuple[int, Expression], ...]]  # Tokens spanned, and (first token, node) of the subexpressions.
+
+
+class ReusingCursor(TokenCursor):
+    """
+    Reads through a list of tokens, given as their texts and offsets, and records the shape of every expression it
+    parses. Where an old expression can be reused, it is returned without parsing it again.
+    """
+
+    def __init__(self, parser: "IncrementalParser", reusable: Callable[[int], Optional[Expression]]):
+        self.parser = parser
+        self.texts = parser.texts
+        self.typed = parser.typed
+        self.reusable = reusable
+        self.position = 0
+        self.children: List[List[Tuple[int, Expression]]] = [[]]
+
+        self.parsed = 0
+        self.reused = 0
+
+    def token(self, index: int) -> Optional[Token]:
+        if not 0 <= index < len(self.texts):
+            return None
+        offset = self.parser.start(index)
+        line_start = self.parser.source.rfind("\n", 0, offset) + 1
+        return Token(self.texts[index], offset, self.parser.source.count("\n", 0, offset) + 1, offset - line_start + 1)
+
+    @property
+    def current(self) -> Optional[Token]:  # Only needed for error messages, so made when asked for.
+        return self.token(self.position)
+
+    @property
+    def last(self) -> Optional[Token]:
+        return self.token(self.position - 1)
+
+    def atEnd(self) -> bool:
+        return self.position >= len(self.texts)
+
+    def next(self) -> str:
+        if self.position >= len(self.texts):
+            raise ValueError(f"Unexpected end of program{' after ' + where(self.last) if self.position else ''}.")
+        self.position += 1
+        return self.texts[self.position - 1]
+
+    def expression(self) -> Expression:
+        start = self.position
+        old = self.reusable(start)
+        if old is not None:
+            self.position = start + self.parser.shapes[old][0]
+            self.reused += 1
+            exp = old
+        else:
+            self.children.append([])
+            exp = parseExpression(self)
+            self.parser.shapes[exp] = (self.position - start, tuple((child_start - start, child) for child_start, child in self.children.pop()))
+            self.parsed += 1
+        self.children[-1].append((start, exp))
+        return exp
+
+
+class OldNodes:
+    """
+    Finds the expressions of an old tree that start at given tokens, which are asked for in increasing order. Keeps the
+    path from the root to the last expression found, so every lookup walks down from its nearest ancestor on that path.
+    """
+
+    def __init__(self, shapes: Dict[Expression, Shape], root: Expression):
+        self.shapes = shapes
+        self.path: List[Tuple[Expression, int]] = [(root, 0)]  # Expressions with their first token.
+
+    def at(self, index: int) -> Optional[Expression]:
+        """
+        The outermost expression of the tree that starts at the given token, if any.
+        """
+        path, shapes = self.path, self.shapes
+        while len(path) > 1 and not path[-1][1] <= index < path[-1][1] + shapes[path[-1][0]][0]:
+            path.pop()
+        exp, start = path[-1]
+        if not start <= index < start + shapes[exp][0]:
+            return None
+        while start != index:
+            for child_start, child in shapes[exp][1]:
+                if start + child_start <= index < start + child_start + shapes[child][0]:
+                    exp, start = child, start + child_start
+                    path.append((exp, start))
+                    break
+            else:
+                return None
+        return exp
+
+
+class IncrementalParser:
+
+    def __init__(self, source: str, context: Context=None):
+        """
+        Whether the program is typed is decided by the context, or else guessed from the program text again after
+        every edit.
+        """
+        self.source = ""
+        self.texts: List[str] = []
+        self.starts: List[int] = []  # Offset of every token, less the shift from the boundary on (see start).
+        self.boundary = 0
+        self.shift = 0
+        self.typed_by_context = getattr(context, "typed", None)
+        self.typed = None
+
+        self.tree: Optional[Expression] = None
+        self.shapes: Dict[Expression, Shape] = dict()
+        self.prune_at = PRUNE_MINIMUM
+
+        self.relexed = 0  # Tokens lexed by the last edit.
+        self.parsed = 0   # Expressions parsed by the last edit.
+        self.reused = 0   # Subtrees reused by the last edit.
+        self.edit(0, 0, source)
+
+    def start(self, index: int) -> int:
+        """
+        The offset of the given token.
+        """
+        return self.starts[index] + self.shift if index >= self.boundary else self.starts[index]
+
+    def move_boundary(self, boundary: int):
+        if boundary > self.boundary:
+            self.starts[self.boundary:boundary] = [start + self.shift for start in self.starts[self.boundary:boundary]]
+        elif boundary < self.boundary:
+            self.starts[boundary:self.boundary] = [start - self.shift for start in self.starts[boundary:self.boundary]]
+        self.boundary = boundary
+
+    def relex(self, offset: int, removed: int, inserted: str) -> Tuple[int, int]:
+        """
+        Apply an edit to the source and its tokens. Returns the range of old tokens that were replaced.
+        """
+        old_source = self.source
+        self.source = old_source[:offset] + inserted + old_source[offset+removed:]
+        delta = len(inserted) - removed
+
+        first = bisect_left(self.starts, offset, 0, self.boundary)  # The first token that starts at or after the edit,
+        if first == self.boundary:
+            first = bisect_left(self.starts, offset - self.shift, first)
+        if first > 0 and self.start(first-1) + len(self.texts[first-1]) >= offset:
+            first -= 1                                               # or the one before, if it reaches the edit.
+        self.move_boundary(first)  # From here on, the old offsets are self.starts[index] + self.shift.
+        position = min(self.starts[first] + self.shift, offset) if first < len(self.starts) else offset
+
+        texts, starts = [], []
+        end = len(self.texts)
+        for match in TOKEN_PATTERN.finditer(self.source, position):
+            if match.lastindex == WHITESPACE:
+                continue
+            start = match.start()
+            if start >= offset + len(inserted):  # Might be an old token again.
+                old_start = start - delta
+                old = bisect_left(self.starts, old_start - self.shift, first)
+                if old < len(self.starts) and self.starts[old] + self.shift == old_start >= offset + removed:
+                    end = old
+                    break
+            texts.append(match.group())
+            starts.append(start)
+
+        self.texts[first:end] = texts
+        self.starts[first:end] = starts
+        self.boundary = first + len(starts)
+        self.shift += delta
+        self.relexed = len(texts)
+        return first, end
+
+    def edit(self, offset: int, removed: int, inserted: str) -> Expression:
+        """
+        Replace the given amount of characters at the given offset by the given text, and return the new tree.
+        """
+        if not 0 <= offset <= offset + removed <= len(self.source):
+            raise ValueError(f"Edit of {removed} characters at offset {offset} is outside of the program.")
+        old_tree, old_typed, old_count = self.tree, self.typed, len(self.texts)
+        first, end = self.relex(offset, removed, inserted)
+        token_delta = len(self.texts) - old_count
+
+        self.typed = self.typed_by_context
+        if self.typed is None:
+            self.typed = COLON in self.source
+
+        old_nodes = OldNodes(self.shapes, old_tree) if old_tree is not None and self.typed == old_typed else None
+
+        def reusable(index: int) -> Optional[Expression]:
+            if old_nodes is None:
+                return None
+            if index < first:
+                old_index = index
+            elif index >= first + self.relexed:
+                old_index = index - token_delta
+            else:
+                return None
+            exp = old_nodes.at(old_index)
+            if exp is None:
+                return None
+            if old_index + self.shapes[exp][0] <= first or old_index >= end:
+                return exp
+            return None
+
+        self.tree = None
+        cursor = ReusingCursor(self, reusable)
+        try:
+            self.tree = parseProgram(cursor)
+        finally:
+            self.parsed, self.reused = cursor.parsed, cursor.reused
+        if len(self.shapes) > self.prune_at:
+            self.prune()
+        return self.tree
+
+    def prune(self):
+        """
+        Forget the shapes of the expressions that are no longer part of the tree.
+        """
+        kept = dict()
+        todo = [self.tree]
+        while todo:
+            exp = todo.pop()
+            kept[exp] = self.shapes[exp]
+            todo.extend(child for _, child in kept[exp][1])
+        self.shapes = kept
+        self.prune_at = max(PRUNE_MINIMUM, 2*len(kept))
+
+
+if __name__ == "__main__":
+    from cache import encode_tree
+    from generator import generateProgram
+    from incremental import IncrementalInference
+    from random import Random
+    import sys
+    import time
+
+    sys.setrecursionlimit(100_000)
+    random = Random(0)
+    context = Context(typed=True)
+    source = generateProgram(100_000, seed=0, typed=True)
+
+    start = time.perf_counter()
+    parser = IncrementalParser(source, context)
+    print(f"First parse: {parser.parsed} nodes in {1000*(time.perf_counter() - start):.0f} ms.")
+    inference = IncrementalInference()
+    inference.type_of(parser.tree)
+
+    print(f"{'edit':<16} {'fresh (ms)':>11} {'edit (ms)':>10} {'relexed':>8} {'parsed':>7} {'reused':>7} {'retype (ms)':>12}")
+    for _ in range(10):
+        number = random.choice([index for index in range(0, len(parser.texts), 97) if parser.texts[index].isdecimal()])
+        offset, removed, inserted = parser.start(number), len(parser.texts[number]), str(random.randrange(1000))
+        edited = parser.source[:offset] + inserted + parser.source[offset+removed:]
+
+        start = time.perf_counter()
+        fresh = stringToExpression(edited, context)
+        fresh_ms = 1000*(time.perf_counter() - start)
+        start = time.perf_counter()
+        tree = parser.edit(offset, removed, inserted)
+        edit_ms = 1000*(time.perf_counter() - start)
+        start = time.perf_counter()
+        inference.type_of(tree)
+        retype_ms = 1000*(time.perf_counter() - start)
+        assert encode_tree(tree) == encode_tree(fresh)
+
+        print(f"{parser.source[offset:offset+len(inserted)] + ' at ' + str(offset):<16} {fresh_ms:>11.1f} {edit_ms:>10.2f} "
+              f"{parser.relexed:>8} {parser.parsed:>7} {parser.reused:>7} {retype_ms:>12.2f}")
+
+    # Typing in one place: the boundary of the shifted offsets stays there, so no keystroke shifts the rest.
+    middle = len(parser.texts) // 2
+    offset = parser.start(next(index for index in range(middle, len(parser.texts)) if parser.texts[index].isdecimal()))
+    start = time.perf_counter()
+    for digit in "1234567890":
+        parser.edit(offset, 0, digit)
+        offset += 1
+    typing_ms = 1000*(time.perf_counter() - start) / 10
+    assert encode_tree(parser.tree) == encode_tree(stringToExpression(parser.source, context))
+    print(f"Typing 10 digits in the middle: {typing_ms:.2f} ms per keystroke.")
+
+    # A deep tree: every node of a chain of LETs is parsed again when the last constant changes.
+    print(f"{'lets':>6} {'fresh (ms)':>11} {'edit (ms)':>10} {'parsed':>7} {'reused':>7}")
+    for n in [1000, 4000, 8000]:
+        parser = IncrementalParser("".join(f"let v{i} = {i} in " for i in range(n)) + f"v{n - 1}", context)
+        offset = parser.source.rindex(f"= {n - 1} in") + 2
+        edited = parser.source[:offset] + "42" + parser.source[offset+len(str(n - 1)):]
+
+        start = time.perf_counter()
+        fresh = stringToExpression(edited, context)
+        fresh_ms = 1000*(time.perf_counter() - start)
+        start = time.perf_counter()
+        tree = parser.edit(offset, len(str(n - 1)), "42")
+        edit_ms = 1000*(time.perf_counter() - start)
+        assert encode_tree(tree) == encode_tree(fresh)
+        print(f"{n:>6} {fresh_ms:>11.1f} {edit_ms:>10.1f} {parser.parsed:>7} {parser.reused:>7}")
@@ -0,0 +1,175 @@
+"""
+Specialization of well-typed programs: once type inference has proven that a program is well-typed, every subtraction
+gets integers, every condition is a boolean and every operator of a call is a procedure. The casts that check this while
+the program runs (ExpVal.cast, on every evaluation of those expressions) can then never fail, so they can be left out.
+
+`specialize` first infers the type of the program, which raises if it isn't well-typed, and then rewrites a copy of it
+where DiffExp, IsZeroExp, IfExp and CallExp are replaced by their unchecked variants below. These evaluate the same way,
+without the casts, and unchecked calls apply the procedure themselves rather than calling apply_procedure, unless there
+are layers (see letrec.layered) to go through. Calls keep the semantics of the language they came from: in
+IMPLICIT-REFS (and INFERRED), the argument is put in a new cell.
+
+Typed programs are checked with type_of_program. Untyped ones (of LETREC or IMPLICIT-REFS) are checked by it too, on a
+copy in the typed classes with every type left to infer (see incremental.annotated), so they can be specialized too, as
+long as they can be typed. That only covers the expressions of LETREC: an untyped program with `begin` can't be typed.
+
+Programs with `set` are never specialized, typed or not. INFERRED types `set` by giving the variable its new type from
+then on, which isn't sound: a procedure made before the `set` was checked with the old type, and still reads the
+variable. Such a program is well-typed, yet the checked evaluator raises a TypeError where the specialized one would
+silently compute with the wrong kind of value. specialize raises a ValueError for these programs instead.
+
+The specialized tree is only meant to be evaluated: the unchecked variants aren't TypedExpressions.
+"""
+from inferred import *
+from typing import Dict
+import letrec
+import implicit_refs
+
+from trees import slot_names, subexpressions
+from incremental import annotated
+
+
+class UncheckedDiffExp(DiffExp):
+    __slots__ = ()
+
+    def value_of(self, env: Environment) -> ExpVal:
+        return IntVal.of(self.exp1.value_of(env).value - self.exp2.value_of(env).value)
+
+
+class UncheckedIsZeroExp(IsZeroExp):
+    __slots__ = ()
+
+    def value_of(self, env: Environment) -> ExpVal:
+        return TRUE if self.exp.value_of(env).value == 0 else FALSE
+
+
+class UncheckedIfExp(IfExp):
+    __slots__ = ()
+
+    def value_of(self, env: Environment) -> ExpVal:
+        if self.cond_exp.value_of(env).value:
+            return self.true_exp.value_of(env)
+        else:
+            return self.false_exp.value_of(env)
+
+
+class UncheckedCallExp(letrec.CallExp):
+    __slots__ = ()
+
+    def value_of(self, env: Environment) -> ExpVal:
+        proc = self.operator.value_of(env)
+        arg = self.operand.value_of(env)
+        apply = CURRENT_APPLY.get()
+        if apply is not None:
+            return apply(proc, arg)
+        return proc.body.value_of(ExtendEnvironment(proc.var, arg, proc.closed_env))
+
+
+class UncheckedImplicitCallExp(implicit_refs.CallExp):
+    __slots__ = ()
+
+    def value_of(self, env: Environment) -> ExpVal:
+        proc = self.operator.value_of(env)
+        arg = self.operand.value_of(env)
+        store = the_store()
+        ref = store.store(store.new(), arg)
+        apply = CURRENT_APPLY.get()
+        if apply is not None:
+            return apply(proc, ref)
+        return proc.body.value_of(ExtendEnvironment(proc.var, ref, proc.closed_env))
+
+
+def unchecked_class(cls: type) -> Optional[type]:
+    if issubclass(cls, DiffExp):
+        return UncheckedDiffExp
+    elif issubclass(cls, IsZeroExp):
+        return UncheckedIsZeroExp
+    elif issubclass(cls, IfExp):
+        return UncheckedIfExp
+    elif issubclass(cls, implicit_refs.CallExp):
+        return UncheckedImplicitCallExp
+    elif issubclass(cls, letrec.CallExp):
+        return UncheckedCallExp
+    else:
+        return None
+
+
+def specialized(exp: Expression) -> Expression:
+    """
+    A copy of the given tree with the unchecked variant of every expression that has one. Doesn't check any types.
+    """
+    copies: Dict[Expression, Expression] = dict()
+    todo = [(exp, False)]
+    while todo:
+        node, children_done = todo.pop()
+        if node in copies:
+            continue
+        if not children_done:
+            todo.append((node, True))
+            todo.extend((child, False) for child in fields(node) if isinstance(child, Expression))
+            todo.extend((child, False) for value in fields(node) if isinstance(value, list) for child in value)
+            continue
+
+        cls = unchecked_class(node.__class__) or node.__class__
+        copy = cls.__new__(cls)
+        for name in slot_names(cls):
+            value = getattr(node, name)
+            if isinstance(value, Expression):
+                value = copies[value]
+            elif isinstance(value, list):
+                value = [copies[element] for element in value]
+            setattr(copy, name, value)
+        copies[node] = copy
+    return copies[exp]
+
+
+def specialize(exp: Expression, context: Context=None) -> Expression:
+    """
+    Prove that the program is well-typed, and return its specialized copy. Raises a TypeError (or ValueError, for
+    variables that aren't bound) if it isn't, and a ValueError if it contains a `set`.
+    """
+    todo = [exp]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, implicit_refs.SetExp):
+            raise ValueError(f"Can't specialize a program that assigns to a variable ('{node.var}'): type inference doesn't follow how that changes its type.")
+        todo.extend(subexpressions(node))
+    type_of_program(exp if isinstance(exp, TypedExpression) else annotated(exp), context=context)
+    return specialized(exp)
+
+
+if __name__ == "__main__":
+    import sys
+
+    sys.setrecursionlimit(100_000)
+
+    def outcome(exp: Expression):
+        try:
+            return Program(exp, EmptyEnvironment(), Context()).value_of_program()
+        except (TypeError, ValueError) as e:
+            return e.__class__.__name__
+
+    # Well-typed by INFERRED, since the set gives x its new type only from then on, but f still reads x as an int.
+    exp = LetExpTyped("x", ConstExpTyped(1),
+          LetExpTyped("f", ProcExpTyped("y", DiffExpTyped(VarExpTyped("x"), ConstExpTyped(1)), INT_TYPE),
+          LetExpTyped("d", SetExpTyped("x", IsZeroExpTyped(ConstExpTyped(0))),
+          CallExpTyped(VarExpTyped("f"), ConstExpTyped(0)))))
+    type_of_program(exp, context=Context())
+    assert outcome(exp) == "TypeError"
+    try:
+        specialize(exp)
+        raise AssertionError("A program with set was specialized.")
+    except ValueError:
+        pass
+
+    # Unchecked calls evaluate the operand before they make its cell, like checked ones, so cells get the same numbers.
+    exp = LetExpTyped("f", ProcExpTyped("a", ProcExpTyped("b", VarExpTyped("b"), INT_TYPE), INT_TYPE),
+          CallExpTyped(CallExpTyped(VarExpTyped("f"), ConstExpTyped(1)),
+                       LetExpTyped("z", ConstExpTyped(2), DiffExpTyped(VarExpTyped("z"), ConstExpTyped(1)))))
+    stores = []
+    for program in [exp, specialize(exp)]:
+        context = Context()
+        assert Program(program, EmptyEnvironment(), context).value_of_program().value == 1
+        stores.append([getattr(value, "value", value.__class__.__name__) for value in context.store.values])
+    assert stores[0] == stores[1], stores
+    print("Programs with set are refused, and unchecked calls make their cells in the same order.")
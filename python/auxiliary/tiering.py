@@ -0,0 +1,177 @@
+"""
+Tiered execution: programs start out in the tree-walking interpreter, and only the procedures that turn out to be hot
+are compiled. Most programs are short and run once, so they never pay for compiling; the few that spend their time
+in one procedure get that procedure compiled after a while, and run it compiled from then on:
+
+    with tier_up(exp, threshold=1000) as tiers:
+        Program(exp, EmptyEnvironment()).value_of_program()
+    print(tiers)
+
+While tiering, calls go through a layer (see letrec.layered) that counts the calls of every procedure body. When a body
+has been called as often as the threshold, it is compiled by the closure compiler, and every later call of it runs the
+compiled code instead. That code runs in the same environments and produces the same values as the interpreter (see
+closures.py), so it can take over in the middle of a run, with interpreted calls still further down the stack.
+
+Compiled code calls procedures itself rather than through apply_procedure, and compiles the bodies it calls when it
+first calls them. So after a procedure is promoted, the procedures it calls (and the procedures it makes) are compiled
+along with it, and calls between compiled procedures are neither counted nor seen by the profiler.
+
+Calls that run compiled code don't go on to the layers below tiering, so those only see interpreted calls. Profile or
+memoize a program inside tier_up, so their layers run first and see every call. Without layers below it, tiering
+evaluates interpreted calls itself, since another Python call per LETREC call costs more than the counting does.
+"""
+from inferred import *
+from contextlib import contextmanager
+from time import perf_counter_ns
+from typing import Dict, Iterator, List, Tuple
+
+from closures import ClosureCompiler, Code
+from profiler import procedure_names
+
+THRESHOLD = 1_000  # Calls of a procedure body before it is compiled.
+
+
+class TieringCompiler(ClosureCompiler):
+    """
+    A closure compiler that keeps track of how long it takes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.compile_ns = 0
+        self.compiled = 0  # Bodies compiled on their own, i.e. not as part of another one.
+
+    def compile_body(self, proc: ProcVal) -> Code:
+        code = self.bodies.get(proc.body)
+        if code is None:
+            start = perf_counter_ns()
+            code = super().compile_body(proc)
+            self.compile_ns += perf_counter_ns() - start
+            self.compiled += 1
+        return code
+
+
+class Tiers:
+
+    def __init__(self, exp: Expression, threshold: int=THRESHOLD):
+        self.exp = exp
+        self.names: Optional[Dict[Expression, str]] = None  # Only found once a procedure is promoted, since that takes a walk over the whole program.
+        self.threshold = threshold
+        self.compiler = TieringCompiler()
+        self.calls: Dict[Expression, int] = dict()  # Interpreted calls of every body that isn't compiled yet.
+        self.promotions: List[Tuple[str, int]] = []  # Name and compile time of every body that was promoted.
+
+        self.interpreted_calls = 0
+        self.compiled_calls = 0  # Calls through apply_procedure that ran compiled code.
+
+    def name(self, proc: ProcVal) -> str:
+        if self.names is None:
+            self.names = procedure_names(self.exp)
+        name = self.names.get(proc.body)
+        return name if name is not None else f"proc({proc.var})"
+
+    def promote(self, proc: ProcVal) -> Code:
+        before = self.compiler.compile_ns
+        code = self.compiler.compile_body(proc)
+        self.promotions.append((self.name(proc), self.compiler.compile_ns - before))
+        self.calls.pop(proc.body, None)
+        return code
+
+    @property
+    def compile_ns(self) -> int:
+        return self.compiler.compile_ns
+
+    def __repr__(self):
+        lines = [f"{'promoted':<20} {'compile (ms)':>13}"]
+        for name, elapsed in self.promotions:
+            lines.append(f"{name:<20} {elapsed/1e6:>13.2f}")
+        lines.append(f"{len(self.promotions)} promotions and {self.compiler.compiled - len(self.promotions)} bodies compiled along with them "
+                     f"in {self.compile_ns/1e6:.2f} ms. "
+                     f"Calls through apply_procedure: {self.interpreted_calls} interpreted, {self.compiled_calls} compiled.")
+        return "\n".join(lines)
+
+
+def tiered(tiers: Tiers) -> Layer:
+    def layer(apply: Apply) -> Apply:
+        inline = apply is call
+
+        def apply_procedure(proc: ProcVal, arg: DenVal) -> ExpVal:
+            code = tiers.compiler.bodies.get(proc.body)
+            if code is None:
+                calls = tiers.calls.get(proc.body, 0) + 1
+                if calls < tiers.threshold:
+                    tiers.calls[proc.body] = calls
+                    tiers.interpreted_calls += 1
+                    if inline:
+                        return proc.body.value_of(ExtendEnvironment(proc.var, arg, proc.closed_env))
+                    return apply(proc, arg)
+                code = tiers.promote(proc)
+
+            tiers.compiled_calls += 1
+            return code(ExtendEnvironment(proc.var, arg, proc.closed_env))
+        return apply_procedure
+    return layer
+
+
+@contextmanager
+def tier_up(exp: Expression, threshold: int=THRESHOLD) -> Iterator[Tiers]:
+    """
+    Run the given program in tiers while it runs in a with-block.
+    """
+    tiers = Tiers(exp, threshold)
+    with layered(tiered(tiers)):
+        yield tiers
+
+
+if __name__ == "__main__":
+    from benchmarks.corpus import CORPUS, retarget
+    from generator import generateProgram
+    from parser import stringToExpression
+    import sys
+
+    sys.setrecursionlimit(100_000)
+
+    def outcome(exp: Expression):
+        try:
+            value = Program(exp, EmptyEnvironment(), Context()).value_of_program()
+        except (TypeError, ValueError) as e:
+            return e.__class__.__name__, str(e)
+        return value.__class__.__name__, getattr(value, "value", None)
+
+    # Every threshold gives the same outcome as the interpreter, with the switch at any point of the run.
+    sources = [(workload.name, workload.program) for workload in CORPUS if isinstance(workload.program, str)]
+    sources += [(f"generated {seed}", generateProgram(300, seed=seed, well_typed=seed % 3 != 0)) for seed in range(100)]
+    programs = [(workload.name, workload.program()) for workload in CORPUS if not isinstance(workload.program, str)]
+    for name, source in sources:
+        parsed = stringToExpression(source)
+        programs += [(name, parsed), (name, retarget(parsed))]
+    for name, exp in programs:
+        expected = outcome(exp)
+        for threshold in [1, 2, 5, 50]:
+            with tier_up(exp, threshold):
+                assert outcome(exp) == expected, (name, threshold)
+    print(f"{len(programs)} programs agree with the interpreter at every threshold.")
+
+    exp = stringToExpression("""
+        letrec fib (n) = if zero?(n) then 0
+                         else if zero?(-(n,1)) then 1
+                         else -((fib -(n,1)), -(0, (fib -(n,2))))
+        in let double = proc (x) -(x, -(0, x))
+        in (double (fib 18))
+    """)
+    with tier_up(exp, threshold=100) as tiers:
+        print(Program(exp, EmptyEnvironment(), Context()).value_of_program())
+    print(tiers)
+
+    # Tiering is a layer, so other layers inside it see every call that goes through it.
+    from memoization import memoize
+    from profiler import ROOT, profile
+    exp = retarget(exp)
+    with tier_up(exp, threshold=5) as tiers:
+        with memoize(exp) as table:
+            with profile(exp) as result:
+                assert Program(exp, EmptyEnvironment(), Context()).value_of_program().value == 5168
+    calls = sum(calls for name, (calls, _) in result.totals().items() if name != ROOT)
+    assert calls == table.hits + table.misses and table.misses == tiers.interpreted_calls + tiers.compiled_calls
+    assert CURRENT_APPLY.get() is None
+    print(f"Profiled and memoized in tiers: {calls} calls, {table.misses} of them through tiering, {tiers.compiled_calls} compiled.")
@@ -0,0 +1,498 @@
+"""
+Transpilation of LETREC and IMPLICIT-REFS programs to Python, for programs that are run very many times.
+
+A program is lowered to a Python syntax tree (the ast module) once and compiled with compile(). After that, running it
+is just calling a Python function, so it runs as CPython bytecode, without an interpreter in between:
+
+    transpiled = transpile(exp, ["x", "y"])  # A program whose initial environment binds x and y.
+    transpiled(5, 7)                         # Run it with x = 5 and y = 7.
+
+The program becomes a function `program` with a parameter for every name in the initial environment. Every letrec
+becomes a nested def and so does every proc. A let becomes a local variable: an assignment if the let is in tail
+position, and otherwise an assignment expression (:=) inside the expression it is part of. Every variable gets a Python
+name of its own, so shadowing is never a problem, and `set` simply assigns to it again (with a nonlocal declaration
+when the variable belongs to a def around it). In IMPLICIT-REFS, a Python local is exactly a store cell that belongs
+to one variable, so the store isn't needed.
+
+Like the bytecode machine, the transpiled program computes with plain Python ints and bools, and its procedures are
+Python functions. Casts become class checks that raise the same errors as the interpreter does, unless the program is
+transpiled unchecked, which should only be done for programs that were proven to be well-typed (see specialization.py).
+
+Compiled programs can be saved: `dumps` gives their code object as bytes, which `loads` turns back into a program, and
+a CodeCache keeps them in a folder, keyed by the tree they were made from (see cache.FolderCache).
+
+Programs are recursive in Python, both while being transpiled and while running, so deep trees and deep recursion
+need a higher recursion limit. Trees nested deeper than compile() can take (see MAX_DEPTH and MAX_DEFS) aren't
+transpiled at all: value_of_transpiled runs them in the interpreter.
+"""
+from explicit_refs import *
+from importlib.util import MAGIC_NUMBER
+from types import FunctionType
+from typing import Dict, List, Tuple
+import ast
+import hashlib
+import marshal
+import letrec
+import implicit_refs
+
+from bytecode import to_raw, to_expval
+from cache import FolderCache, FORMAT, encode_tree
+from nameless import unpack_environment
+from trees import subexpressions
+
+ENTRY = "program"  # Name of the function that the transpiled module defines.
+MAX_DEPTH = 10_000  # Expressions nested deeper than this aren't compiled, since compile() recurses in C and crashes.
+MAX_DEFS = 100      # Nor are defs nested deeper than this, since compiling nested scopes takes superquadratic time and memory.
+
+
+###############
+### Runtime ###
+###############
+def cast_error(value, expected: type) -> TypeError:
+    """
+    The same error that ExpVal.cast would raise in the interpreter.
+    """
+    names = {int: IntVal.__name__, bool: BoolVal.__name__, FunctionType: ProcVal.__name__}
+    return TypeError(f"Tried to cast {names.get(value.__class__, value.__class__.__name__)} to {names[expected]}!")
+
+
+def not_int(value):
+    raise cast_error(value, int)
+
+def not_bool(value):
+    raise cast_error(value, bool)
+
+def not_proc(value):
+    raise cast_error(value, FunctionType)
+
+def unbound(var: str):
+    raise ValueError(f"Failed to find {var} in environment.")
+
+
+RUNTIME = {  # The globals of every transpiled program.
+    "_function": FunctionType,
+    "_not_int":  not_int,
+    "_not_bool": not_bool,
+    "_not_proc": not_proc,
+    "_unbound":  unbound,
+}
+
+
+##################
+### Transpiler ###
+##################
+class Function:
+    """
+    A def being generated, with the Python names of the defs around it that it assigns to.
+    """
+
+    def __init__(self):
+        self.nonlocals: set = set()
+
+
+class Transpiler:
+
+    def __init__(self, checked: bool=True):
+        self.checked = checked
+        self.scope: Dict[str, str] = dict()  # Python name of every variable in scope.
+        self.owners: Dict[str, Function] = dict()
+        self.function = Function()
+        self.count = 0
+
+        self.assigned: set = set()    # Variables that some `set` assigns to.
+        self.procedures: set = set()  # Python names of defs that are never assigned to, so always a procedure.
+
+    def fresh(self, hint: str) -> str:
+        self.count += 1
+        return "".join(c if c.isalnum() or c == "_" else "_" for c in hint) + "_" + str(self.count)
+
+    def temporary(self) -> str:
+        self.count += 1
+        return "_" + str(self.count)
+
+    def bind(self, var: str) -> Tuple[str, Optional[str]]:
+        """
+        Give the variable a new Python name in the current def. Returns that name and the one it shadows, if any.
+        """
+        name = self.fresh(var)
+        self.owners[name] = self.function
+        shadowed = self.scope.get(var)
+        self.scope[var] = name
+        return name, shadowed
+
+    def unbind(self, var: str, shadowed: Optional[str]):
+        if shadowed is None:
+            del self.scope[var]
+        else:
+            self.scope[var] = shadowed
+
+    def transpile_program(self, exp: Expression, names: List[str]=()) -> ast.Module:
+        """
+        A module that defines the program as a function of the values of the given names, innermost first.
+        """
+        todo = [exp]
+        while todo:
+            e = todo.pop()
+            if isinstance(e, implicit_refs.SetExp):
+                self.assigned.add(e.var)
+            todo.extend(subexpressions(e))
+
+        parameters = [None] * len(names)
+        for i in reversed(range(len(names))):  # Outermost first, so inner names shadow outer ones.
+            parameters[i], _ = self.bind(names[i])
+        program = self.define(ENTRY, parameters, exp)
+        return ast.fix_missing_locations(ast.Module([program], type_ignores=[]))
+
+    def define(self, name: str, parameters: List[str], body: Expression) -> ast.FunctionDef:
+        """
+        A def whose parameters were bound in the current def, which is made the def's own for the duration.
+        """
+        outer, self.function = self.function, Function()
+        for parameter in parameters:
+            self.owners[parameter] = self.function
+        statements = self.statements(body)
+        if self.function.nonlocals:
+            statements.insert(0, ast.Nonlocal(sorted(self.function.nonlocals)))
+        self.function = outer
+        return ast.FunctionDef(name, ast.arguments([], [ast.arg(p) for p in parameters], None, [], [], None, []),
+                               statements, [], None)
+
+    ### Tail position ###
+    def statements(self, exp: Expression, hoisted: List[ast.stmt]=None) -> List[ast.stmt]:
+        """
+        Statements that return the value of the expression, added to the given ones.
+        """
+        if hoisted is None:
+            hoisted = []
+        if isinstance(exp, (letrec.LetExp, implicit_refs.LetExp)):
+            value = self.expression(exp.val_exp, hoisted)
+            name, shadowed = self.bind(exp.var)
+            hoisted.append(ast.Assign([ast.Name(name, ast.Store())], value))
+            self.statements(exp.body_exp, hoisted)
+            self.unbind(exp.var, shadowed)
+        elif isinstance(exp, (letrec.LetrecExp, implicit_refs.LetrecExp)):
+            name, shadowed = self.bind(exp.procname)
+            hoisted.append(self.define_letrec(exp, name))
+            self.statements(exp.letbody, hoisted)
+            self.unbind(exp.procname, shadowed)
+        elif isinstance(exp, IfExp):
+            test = self.condition(exp.cond_exp, hoisted)
+            hoisted.append(ast.If(test, self.statements(exp.true_exp), self.statements(exp.false_exp)))
+        elif isinstance(exp, BeginExp) and exp.exps:
+            for e in exp.exps[:-1]:
+                hoisted.append(ast.Expr(self.expression(e, hoisted)))
+            self.statements(exp.exps[-1], hoisted)
+        else:
+            hoisted.append(ast.Return(self.expression(exp, hoisted)))
+        return hoisted
+
+    ### Anywhere ###
+    def expression(self, exp: Expression, hoisted: List[ast.stmt]) -> ast.expr:
+        """
+        An expression with the value of the given one. The defs it needs are added to the given statements, which come
+        before it. Making a function has no effects, so that's the same as making it where it is used.
+        """
+        if isinstance(exp, ConstExp):
+            return ast.Constant(exp.const)
+        elif isinstance(exp, (letrec.VarExp, implicit_refs.VarExp)):
+            name = self.scope.get(exp.var)
+            return ast.Name(name, ast.Load()) if name is not None else self.unbound(exp.var)
+        elif isinstance(exp, DiffExp):
+            return ast.BinOp(self.integer(exp.exp1, hoisted), ast.Sub(), self.integer(exp.exp2, hoisted))
+        elif isinstance(exp, IsZeroExp):
+            return ast.Compare(self.integer(exp.exp, hoisted), [ast.Eq()], [ast.Constant(0)])
+        elif isinstance(exp, IfExp):
+            test = self.condition(exp.cond_exp, hoisted)
+            return ast.IfExp(test, self.expression(exp.true_exp, hoisted), self.expression(exp.false_exp, hoisted))
+        elif isinstance(exp, (letrec.LetExp, implicit_refs.LetExp)):
+            value = self.expression(exp.val_exp, hoisted)
+            name, shadowed = self.bind(exp.var)
+            body = self.expression(exp.body_exp, hoisted)
+            self.unbind(exp.var, shadowed)
+            return last(ast.NamedExpr(ast.Name(name, ast.Store()), value), body)
+        elif isinstance(exp, (letrec.LetrecExp, implicit_refs.LetrecExp)):
+            name, shadowed = self.bind(exp.procname)
+            hoisted.append(self.define_letrec(exp, name))
+            body = self.expression(exp.letbody, hoisted)
+            self.unbind(exp.procname, shadowed)
+            return body
+        elif isinstance(exp, ProcExp):
+            name = self.fresh("proc")
+            self.procedures.add(name)
+            parameter, shadowed = self.bind(exp.var)
+            hoisted.append(self.define(name, [parameter], exp.body_exp))
+            self.unbind(exp.var, shadowed)
+            return ast.Name(name, ast.Load())
+        elif isinstance(exp, (letrec.CallExp, implicit_refs.CallExp)):
+            operator = self.expression(exp.operator, hoisted)
+            if not (isinstance(operator, ast.Name) and operator.id in self.procedures):
+                operator = self.checked_value(operator, "_function", "_not_proc")
+            return ast.Call(operator, [self.expression(exp.operand, hoisted)], [])
+        elif isinstance(exp, implicit_refs.SetExp):
+            return self.assignment(exp, hoisted)
+        elif isinstance(exp, BeginExp):
+            return last(*[self.expression(e, hoisted) for e in exp.exps]) if exp.exps else ast.Constant(-1_000_000)
+        else:
+            raise ValueError(f"Cannot transpile {exp.__class__.__name__}.")
+
+    def define_letrec(self, exp: LetrecExp, name: str) -> ast.FunctionDef:
+        if exp.procname not in self.assigned:
+            self.procedures.add(name)
+        parameter, shadowed = self.bind(exp.procvar)
+        definition = self.define(name, [parameter], exp.procbody)
+        self.unbind(exp.procvar, shadowed)
+        return definition
+
+    def assignment(self, exp: implicit_refs.SetExp, hoisted: List[ast.stmt]) -> ast.expr:
+        name = self.scope.get(exp.var)
+        if name is None:  # Looked up before the value is computed, like in the interpreter.
+            return last(self.unbound(exp.var), self.expression(exp.value_exp, hoisted))
+        if self.owners[name] is not self.function:
+            self.function.nonlocals.add(name)
+        return last(ast.NamedExpr(ast.Name(name, ast.Store()), self.expression(exp.value_exp, hoisted)),
+                    ast.Constant(-1_000_002))
+
+    @staticmethod
+    def unbound(var: str) -> ast.expr:
+        return ast.Call(ast.Name("_unbound", ast.Load()), [ast.Constant(var)], [])
+
+    ### Casts ###
+    def integer(self, exp: Expression, hoisted: List[ast.stmt]) -> ast.expr:
+        value = self.expression(exp, hoisted)
+        if isinstance(exp, (ConstExp, DiffExp)):  # Can only be an int.
+            return value
+        return self.checked_value(value, "int", "_not_int")
+
+    def condition(self, exp: Expression, hoisted: List[ast.stmt]) -> ast.expr:
+        value = self.expression(exp, hoisted)
+        if isinstance(exp, IsZeroExp):  # Can only be a bool.
+            return value
+        return self.checked_value(value, "bool", "_not_bool")
+
+    def checked_value(self, value: ast.expr, expected: str, failure: str) -> ast.expr:
+        """
+        (t if (t := value).__class__ is expected else failure(t)), or just the value when unchecked.
+        """
+        if not self.checked:
+            return value
+        t = self.temporary()
+        test = ast.Compare(ast.Attribute(ast.NamedExpr(ast.Name(t, ast.Store()), value), "__class__", ast.Load()),
+                           [ast.Is()], [ast.Name(expected, ast.Load())])
+        return ast.IfExp(test, ast.Name(t, ast.Load()), ast.Call(ast.Name(failure, ast.Load()), [ast.Name(t, ast.Load())], []))
+
+
+def last(*exps: ast.expr) -> ast.expr:
+    """
+    Evaluates all expressions in order, and has the value of the last one.
+    """
+    return ast.Subscript(ast.Tuple(list(exps), ast.Load()), ast.Constant(-1), ast.Load())
+
+
+################
+### Programs ###
+################
+class Transpiled:
+    """
+    A compiled program. Call it with the raw values (ints, bools, procedures) of the names it was transpiled for.
+    """
+
+    def __init__(self, code, names: List[str]):
+        self.code = code
+        self.names = list(names)
+        namespace = dict(RUNTIME)
+        exec(code, namespace)
+        self.function = namespace[ENTRY]
+
+    def __call__(self, *values):
+        return self.function(*values)
+
+    def dumps(self) -> bytes:
+        """
+        The program as bytes, which can only be loaded by the same version of Python.
+        """
+        return MAGIC_NUMBER + marshal.dumps((self.code, self.names))
+
+    @staticmethod
+    def loads(data: bytes) -> "Transpiled":
+        if data[:len(MAGIC_NUMBER)] != MAGIC_NUMBER:
+            raise ValueError("Program was saved by a different version of Python.")
+        code, names = marshal.loads(data[len(MAGIC_NUMBER):])
+        return Transpiled(code, names)
+
+
+def transpile_to_ast(exp: Expression, names: List[str]=(), checked: bool=True) -> ast.Module:
+    return Transpiler(checked).transpile_program(exp, names)
+
+
+def nesting(exp: Expression) -> Tuple[int, int]:
+    """
+    How deeply the expressions of the tree are nested, and how deeply the defs they become are.
+    """
+    depth, defs = 0, 0
+    todo = [(exp, 1, 0)]
+    while todo:
+        e, e_depth, e_defs = todo.pop()
+        if isinstance(e, (ProcExp, letrec.LetrecExp, implicit_refs.LetrecExp)):
+            e_defs += 1
+        depth, defs = max(depth, e_depth), max(defs, e_defs)
+        todo.extend((child, e_depth + 1, e_defs) for child in subexpressions(e))
+    return depth, defs
+
+
+def compilable(exp: Expression) -> bool:
+    depth, defs = nesting(exp)
+    return depth <= MAX_DEPTH and defs <= MAX_DEFS
+
+
+def transpile(exp: Expression, names: List[str]=(), checked: bool=True) -> Transpiled:
+    """
+    Transpile and compile once, then call the result with the values of the given names as many times as needed.
+    Raises a ValueError for programs that are nested too deeply to compile (see MAX_DEPTH and MAX_DEFS).
+    """
+    if not compilable(exp):
+        raise ValueError(f"Program is nested too deeply to compile: at most {MAX_DEPTH} expressions and {MAX_DEFS} procedures deep.")
+    return Transpiled(compile(transpile_to_ast(exp, names, checked), "<transpiled>", "exec"), names)
+
+
+def value_of_transpiled(exp: Expression, initenv: Environment) -> ExpVal:
+    """
+    Evaluator that can be given to Program.value_of_program. Transpiles every time; use transpile to do so once.
+    Raises a ValueError for programs that evaluate to a procedure (see to_expval). Programs that are nested too deeply
+    to compile are run by the interpreter instead.
+    """
+    if not compilable(exp):
+        return exp.value_of(initenv)
+    names, values = unpack_environment(initenv)
+    return to_expval(transpile(exp, names)(*[to_raw(v) for v in values]))
+
+
+class CodeCache(FolderCache):
+    """
+    Transpiled programs in a folder, keyed by a hash of the tree they were made from (and the names and checks they
+    were made with). Can share its folder with an ASTCache.
+    """
+    SUFFIX = ".pyc"
+
+    def key(self, exp: Expression, names: List[str], checked: bool) -> str:
+        data = marshal.dumps((FORMAT, MAGIC_NUMBER, list(names), checked, encode_tree(exp)))
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, exp: Expression, names: List[str]=(), checked: bool=True) -> Optional[Transpiled]:
+        return self.read(self.key(exp, names, checked), Transpiled.loads)
+
+    def put(self, exp: Expression, transpiled: Transpiled, checked: bool=True):
+        self.write(self.key(exp, transpiled.names, checked), transpiled.dumps())
+
+    def load(self, exp: Expression, names: List[str]=(), checked: bool=True) -> Transpiled:
+        """
+        The transpiled program. From the cache if possible, else transpiled and cached.
+        """
+        cached = self.get(exp, names, checked)
+        if cached is not None:
+            return cached
+        transpiled = transpile(exp, names, checked)
+        self.put(exp, transpiled, checked)
+        return transpiled
+
+
+if __name__ == "__main__":
+    from generator import generateProgram
+    from parser import stringToExpression
+    from benchmarks.corpus import CORPUS, retarget
+    import sys
+    import tempfile
+    import time
+
+    sys.setrecursionlimit(100_000)
+
+    # One program, many initial environments.
+    exp = retarget(stringToExpression("""
+    letrec sum (n) = if zero?(n) then 0 else -((sum -(n,1)), -(0,n))
+    in let limit = -(x, y)
+    in if zero?(limit) then zero?(0) else (sum limit)
+    """))
+    print(ast.unparse(transpile_to_ast(exp, ["x", "y"])))
+    transpiled = transpile(exp, ["x", "y"])
+    assert transpiled(30, 10) == 210 and transpiled(7, 7) is True
+
+    start = time.perf_counter()
+    for x in range(100_000):
+        transpiled(x % 50, 0)
+    transpiled_ms = 1000*(time.perf_counter() - start)
+    start = time.perf_counter()
+    for x in range(1_000):
+        Program(exp, ExtendEnvironment("y", IntVal(0), ExtendEnvironment("x", IntVal(x % 50), EmptyEnvironment()))).value_of_program()
+    interpreted_ms = 100*1000*(time.perf_counter() - start)
+    print(f"100000 runs: {transpiled_ms:.0f} ms transpiled, {interpreted_ms:.0f} ms interpreted (estimated from 1000 runs).")
+
+    # Differential test against the interpreter.
+    def outcome(run):
+        try:
+            value = run()
+        except (TypeError, ValueError) as e:
+            return e.__class__.__name__, str(e)
+        if isinstance(value, (ProcVal, FunctionType)):
+            return "procedure"
+        return value.__class__.__name__, value.value
+
+    programs = [(workload.name, workload.program) for workload in CORPUS if isinstance(workload.program, str)]
+    programs += [
+        ("shadowing", "let x = 1 in let f = proc (y) -(y, x) in let x = 10 in (f x)"),
+        ("letrec in operand", "-(letrec f (n) = if zero?(n) then 0 else -((f -(n,1)), 2) in (f 5), let x = 3 in x)"),
+        ("bad condition", "if 1 then 2 else 3"),
+        ("bad operator", "(zero?(0) 1)"),
+        ("unbound", "let x = 1 in -(x, z)"),
+        ("procedure", "proc (x) x"),
+    ]
+    programs += [(f"generated {seed}", generateProgram(300, seed=seed, typed=seed % 2 == 0, well_typed=seed % 3 != 0)) for seed in range(300)]
+
+    checked = 0
+    for name, source in programs:
+        parsed = stringToExpression(source)
+        for exp in [parsed, retarget(parsed)]:
+            expected = outcome(lambda: Program(exp, EmptyEnvironment(), Context()).value_of_program())
+            result = outcome(lambda: Program(exp, EmptyEnvironment(), Context()).value_of_program(value_of_transpiled))
+            if expected == "procedure":  # Can't be handed back as a ProcVal.
+                assert result[0] == "ValueError", (name, result)
+                assert transpile(exp)().__class__ is FunctionType, name
+                continue
+            assert result == expected, (name, result, expected)
+            if expected[0] in ("IntVal", "BoolVal"):
+                assert transpile(exp, checked=False)() == expected[1], name
+            checked += 1
+
+    # Set, including on a variable of a def around it, and on a letrec's name.
+    exp = implicit_refs.LetExp("counter", ConstExp(0),
+          implicit_refs.LetExp("tick", ProcExp("d", implicit_refs.SetExp("counter", DiffExp(implicit_refs.VarExp("counter"), implicit_refs.VarExp("d")))),
+          BeginExp([implicit_refs.CallExp(implicit_refs.VarExp("tick"), ConstExp(-2)),
+                    implicit_refs.CallExp(implicit_refs.VarExp("tick"), ConstExp(-3)),
+                    implicit_refs.LetrecExp("f", "x", implicit_refs.VarExp("x"),
+                        BeginExp([implicit_refs.SetExp("f", ProcExp("y", ConstExp(42))),
+                                  DiffExp(implicit_refs.VarExp("counter"), implicit_refs.CallExp(implicit_refs.VarExp("f"), ConstExp(1)))]))])))
+    expected = outcome(lambda: Program(exp, EmptyEnvironment(), Context()).value_of_program())
+    assert outcome(lambda: Program(exp, EmptyEnvironment(), Context()).value_of_program(value_of_transpiled)) == expected == ("IntVal", -37)
+    print(f"{checked + 1} programs agree with the interpreter.")
+
+    # Too deep to compile: run by the interpreter instead.
+    for name, source in [("10000 nested procs", "".join(f"(proc (x{i}) " for i in range(10_000)) + "x0" + " 1)" * 10_000),
+                         ("20000 nested differences", "-(" * 20_000 + "1" + ", 1)" * 20_000)]:
+        exp = stringToExpression(source)
+        assert not compilable(exp), name
+        start = time.perf_counter()
+        result = outcome(lambda: Program(exp, EmptyEnvironment(), Context()).value_of_program(value_of_transpiled))
+        assert result == outcome(lambda: Program(exp, EmptyEnvironment(), Context()).value_of_program()), name
+        assert outcome(lambda: transpile(exp))[0] == "ValueError", name
+        print(f"{name}: {result} from the interpreter in {1000*(time.perf_counter() - start):.0f} ms.")
+
+    # Caching.
+    exp = stringToExpression(generateProgram(20_000, seed=0))
+    with tempfile.TemporaryDirectory() as folder:
+        cache = CodeCache(folder)
+        start = time.perf_counter()
+        first = cache.load(exp)
+        miss_ms = 1000*(time.perf_counter() - start)
+        start = time.perf_counter()
+        second = cache.load(exp)
+        hit_ms = 1000*(time.perf_counter() - start)
+        assert first() == second() and cache.hits == 1
+        print(f"Cache miss: {miss_ms:.0f} ms, hit: {hit_ms:.0f} ms, entry: {cache.size / 2**10:.0f} KiB.")
@@ -0,0 +1,57 @@
+"""
+Helpers for passes that read or rebuild expression trees generically, by the fields their classes declare in __slots__,
+rather than knowing every Expression class.
+"""
+from inferred import *
+from typing import List
+
+
+def slot_names(cls: type) -> List[str]:
+    return [name for base in reversed(cls.__mro__) for name in base.__dict__.get("__slots__", ())]
+
+
+def subexpressions(exp: Expression) -> List[Expression]:
+    children = []
+    for value in fields(exp):
+        if isinstance(value, Expression):
+            children.append(value)
+        elif isinstance(value, list):
+            children.extend(value)
+    return children
+
+
+def rebuilt(node: Expression, /, **changes) -> Expression:
+    """
+    A copy of the given node with some of its fields changed, or the node itself if nothing changes.
+    """
+    if all(getattr(node, name) is value for name, value in changes.items()):
+        return node
+    copy = node.__class__.__new__(node.__class__)
+    for name in slot_names(node.__class__):
+        setattr(copy, name, changes[name] if name in changes else getattr(node, name))
+    return copy
+
+
+def copied(exp: Expression) -> Expression:
+    """
+    A copy of the whole tree, sharing no nodes with it.
+    """
+    copies = dict()
+    todo = [(exp, False)]
+    while todo:
+        node, children_done = todo.pop()
+        if not children_done:
+            todo.append((node, True))
+            todo.extend((child, False) for child in subexpressions(node))
+            continue
+
+        copy = node.__class__.__new__(node.__class__)
+        for name in slot_names(node.__class__):
+            value = getattr(node, name)
+            if isinstance(value, Expression):
+                value = copies[id(value)]
+            elif isinstance(value, list):
+                value = [copies[id(element)] for element in value]
+            setattr(copy, name, value)
+        copies[id(node)] = copy
+    return copies[id(exp)]
@@ -0,0 +1,6 @@
+"""
+Benchmarks for the interpreters and their tooling.
+
+Like the parser, these need both the python/ and the python/auxiliary/ folder on the path. From the python/ folder:
+    PYTHONPATH=auxiliary python -m benchmarks.parsing
+"""
@@ -0,0 +1,159 @@
+"""
+The programs of the benchmark suite, for each language they are meant to be run in.
+
+LETREC and IMPLICIT-REFS programs are given as text. The parser only knows the syntax of LETREC and INFERRED, so
+programs that use the store explicitly (newref, setref, deref, begin, set) are built from their expression classes.
+"""
+from typing import Callable, NamedTuple, Optional, Union
+
+import letrec
+import explicit_refs
+import implicit_refs
+from inferred import Expression
+
+LETREC        = "LETREC"
+EXPLICIT_REFS = "EXPLICIT-REFS"
+IMPLICIT_REFS = "IMPLICIT-REFS"
+INFERRED      = "INFERRED"
+
+LANGUAGES = [LETREC, EXPLICIT_REFS, IMPLICIT_REFS, INFERRED]
+
+
+class Workload(NamedTuple):
+    name: str
+    language: str
+    program: Union[str, Callable[[], Expression]]  # Source text, or a function that builds the expression.
+    expected: Optional[Union[int, bool]]           # The value the program evaluates to.
+
+
+COUNTDOWN = """
+    letrec foo (x) = if zero?(x)
+        then 1
+        else -(x, (foo -(x,1)))
+    in (foo 500)
+"""
+
+COUNTDOWN_TYPED = """
+    letrec ? foo (x: ?) = if zero?(x)
+        then 1
+        else -(x, (foo -(x,1)))
+    in (foo 500)
+"""
+
+CHURCH = """
+    let zero = proc (f) proc (x) x
+    in let succ = proc (n) proc (f) proc (x) (f ((n f) x))
+    in let mult = proc (m) proc (n) proc (f) (m (n f))
+    in letrec church (k) = if zero?(k) then zero else (succ (church -(k,1)))
+    in let toint = proc (n) ((n proc (v) -(v,-(0,1))) 0)
+    in (toint ((mult (church 20)) (church 20)))
+"""
+
+CURRIED = """
+    letrec add (n) = proc (m) if zero?(n) then m else ((add -(n,1)) -(m,-(0,1)))
+    in let twice = proc (f) proc (x) (f (f x))
+    in ((twice (add 300)) 5)
+"""
+
+CURRIED_TYPED = """
+    letrec ? add (n: ?) = proc (m: ?) if zero?(n) then m else ((add -(n,1)) -(m,-(0,1)))
+    in let twice = proc (f: ?) proc (x: ?) (f (f x))
+    in ((twice (add 300)) 5)
+"""
+
+
+def letChain(length: int) -> str:
+    """
+    A long chain of lets, each applying a new procedure to the value before it: every let adds type variables to solve,
+    while the program still runs in linear time.
+    """
+    lets = " ".join(f"let v{i} = (proc (x: ?) -(x, v{i-1}) v{i-1}) in" for i in range(1, length + 1))
+    return f"let v0 = 1 in {lets} zero?(v{length})"
+
+
+def explicitCounter(iterations: int=500) -> Expression:
+    """
+    let c = newref(0)
+    in letrec loop (n) = if zero?(n) then deref(c)
+                         else begin setref(c, -(deref(c), -1)); (loop -(n,1)) end
+    in (loop iterations)
+    """
+    m = explicit_refs
+    return m.LetExp("c", m.NewrefExp(m.ConstExp(0)),
+        m.LetrecExp("loop", "n",
+            m.IfExp(m.IsZeroExp(m.VarExp("n")),
+                m.DerefExp(m.VarExp("c")),
+                m.BeginExp([
+                    m.SetrefExp(m.VarExp("c"), m.DiffExp(m.DerefExp(m.VarExp("c")), m.ConstExp(-1))),
+                    m.CallExp(m.VarExp("loop"), m.DiffExp(m.VarExp("n"), m.ConstExp(1)))
+                ])
+            ),
+            m.CallExp(m.VarExp("loop"), m.ConstExp(iterations))
+        )
+    )
+
+
+def explicitCells(cells: int=500) -> Expression:
+    """
+    letrec fill (n) = if zero?(n) then 0
+                      else -(deref(newref(n)), -((fill -(n,1)), 0))
+    in (fill cells)
+    """
+    m = explicit_refs
+    return m.LetrecExp("fill", "n",
+        m.IfExp(m.IsZeroExp(m.VarExp("n")),
+            m.ConstExp(0),
+            m.DiffExp(m.DerefExp(m.NewrefExp(m.VarExp("n"))),
+                      m.DiffExp(m.CallExp(m.VarExp("fill"), m.DiffExp(m.VarExp("n"), m.ConstExp(1))), m.ConstExp(0)))
+        ),
+        m.CallExp(m.VarExp("fill"), m.ConstExp(cells))
+    )
+
+
+def implicitCounter(iterations: int=500) -> Expression:
+    """
+    let c = 0
+    in letrec loop (n) = if zero?(n) then c
+                         else begin set c = -(c, -1); (loop -(n,1)) end
+    in (loop iterations)
+    """
+    m = implicit_refs
+    return m.LetExp("c", m.ConstExp(0),
+        m.LetrecExp("loop", "n",
+            m.IfExp(m.IsZeroExp(m.VarExp("n")),
+                m.VarExp("c"),
+                m.BeginExp([
+                    m.SetExp("c", m.DiffExp(m.VarExp("c"), m.ConstExp(-1))),
+                    m.CallExp(m.VarExp("loop"), m.DiffExp(m.VarExp("n"), m.ConstExp(1)))
+                ])
+            ),
+            m.CallExp(m.VarExp("loop"), m.ConstExp(iterations))
+        )
+    )
+
+
+CORPUS = [
+    Workload("countdown", LETREC,        COUNTDOWN,       251),
+    Workload("church",    LETREC,        CHURCH,          400),
+    Workload("curried",   LETREC,        CURRIED,         605),
+    Workload("counter",   EXPLICIT_REFS, explicitCounter, 500),
+    Workload("cells",     EXPLICIT_REFS, explicitCells,   250),
+    Workload("countdown", IMPLICIT_REFS, COUNTDOWN,       251),
+    Workload("church",    IMPLICIT_REFS, CHURCH,          400),
+    Workload("curried",   IMPLICIT_REFS, CURRIED,         605),
+    Workload("counter",   IMPLICIT_REFS, implicitCounter, 500),
+    Workload("countdown", INFERRED,      COUNTDOWN_TYPED, 251),
+    Workload("curried",   INFERRED,      CURRIED_TYPED,   605),
+    Workload("lets",      INFERRED,      letChain(2000),  True),
+]
+
+
+def retarget(exp: Expression, module=letrec) -> Expression:
+    """
+    Rebuild a parsed expression (whose classes are INFERRED's, or IMPLICIT-REFS's when untyped) out of the classes of
+    the same name in another language's module, e.g. to run it with LETREC semantics.
+    The constructors of these classes take their fields in the order of their __slots__.
+    """
+    cls = getattr(module, exp.__class__.__name__.removesuffix("Typed"))
+    return cls(*[retarget(field, module) if isinstance(field, Expression) else field
+                 for field in (getattr(exp, name) for name in cls.__slots__)])
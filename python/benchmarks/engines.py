@@ -0,0 +1,69 @@
+"""
+Benchmark for the alternative evaluators: runs recursive programs with each of them and compares their time with the
+tree-walking interpreter's. Programs are parsed and prepared (translated, compiled ...) once, then run many times.
+"""
+import sys
+
+from parser import stringToExpression
+from closures import compile_program
+from bytecode import compile_bytecode, run
+from cek import CEKMachine
+from transpiler import transpile
+from benchmarks.suite import best
+from inferred import *
+
+PROGRAMS = {
+    "countdown": """
+        letrec ? foo (x: ?) = if zero?(x)
+            then 1
+            else -(x, (foo -(x,1)))
+        in (foo 300)
+    """,
+    "curried": """
+        letrec add (n) = proc (m) if zero?(n) then m else ((add -(n,1)) -(m,-(0,1)))
+        in let twice = proc (f) proc (x) (f (f x))
+        in ((twice (add 100)) 5)
+    """,
+    "even-odd": """
+        letrec parity (n) = proc (even) if zero?(n) then even else ((parity -(n,1)) if even then zero?(1) else zero?(0))
+        in ((parity 301) zero?(0))
+    """,
+}
+
+
+REPEAT = 20
+
+
+def engines(exp: Expression):
+    """
+    Name and zero-argument runner of every evaluator, with all preparation done up front.
+    """
+    compiled = compile_program(exp)
+    bytecode = compile_bytecode(exp)
+    transpiled = transpile(exp)
+    return {
+        "tree":     lambda: exp.value_of(EmptyEnvironment()),
+        "closures": lambda: compiled(EmptyEnvironment()),
+        "bytecode": lambda: run(bytecode),
+        "cek":      lambda: CEKMachine().run(exp, EmptyEnvironment()),
+        "python":   transpiled,
+    }
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(20_000)
+
+    for name, source in PROGRAMS.items():
+        exp = stringToExpression(source)
+        runners = engines(exp)
+
+        expected = runners["tree"]().value
+        times = dict()
+        for engine, runner in runners.items():
+            result = runner()
+            assert getattr(result, "value", result) == expected, engine
+            times[engine] = best(runner, REPEAT)
+
+        print(f"{name}: {expected}")
+        for engine, t in times.items():
+            print(f"\t{engine:<10} {t:>8.2f} ms {times['tree']/t:>6.1f}x")
@@ -0,0 +1,36 @@
+"""
+Benchmark for lexical addressing: a recursive loop that keeps referring to a variable bound outside of a growing amount
+of nested lets, run by the tree-walking interpreter (which searches the environment by name) and by the nameless one.
+"""
+import sys
+
+from parser import stringToExpression
+from nameless import value_of_nameless, translate
+from benchmarks.suite import best
+from inferred import *
+
+
+def nestedLoop(depth: int, iterations: int) -> str:
+    lets = " ".join(f"let v{i} = {i} in" for i in range(depth))
+    return lets + f"""
+        letrec loop (n) = if zero?(n) then v0 else -((loop -(n, 1)), -(v0, 1))
+        in (loop {iterations})
+    """
+
+
+REPEAT = 5
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(20_000)
+
+    print(f"{'depth':>6} {'tree (ms)':>10} {'nameless (ms)':>14} {'translation (ms)':>17} {'speedup':>8}")
+    for depth in [1, 10, 100, 1000]:
+        exp = stringToExpression(nestedLoop(depth, iterations=500))
+        prog = Program(exp, EmptyEnvironment())
+        assert IntVal.cast(prog.value_of_program()).value == IntVal.cast(prog.value_of_program(value_of_nameless)).value
+
+        t_tree     = best(lambda: prog.value_of_program(), REPEAT)
+        t_nameless = best(lambda: prog.value_of_program(value_of_nameless), REPEAT)
+        t_translate = best(lambda: translate(exp), REPEAT)
+        print(f"{depth:>6} {t_tree:>10.2f} {t_nameless:>14.2f} {t_translate:>17.2f} {t_tree/t_nameless:>7.1f}x")
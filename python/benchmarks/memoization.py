@@ -0,0 +1,41 @@
+"""
+Benchmark for memoization of LETREC calls: naive Fibonacci, which makes exponentially many calls without memoization
+and linearly many with it. That stays so with a table of only three entries, since every call needs just the results
+of the two calls before it; with two, most results are evicted before they are used.
+"""
+import sys
+import time
+from typing import Tuple
+
+from memoization import memoize
+from parser import stringToExpression
+from benchmarks.corpus import retarget
+from inferred import *
+
+
+def fibonacci(n: int) -> str:
+    return f"""
+        letrec fib (n) = if zero?(n) then 0
+                         else if zero?(-(n,1)) then 1
+                         else -((fib -(n,1)), -(0, (fib -(n,2))))
+        in (fib {n})
+    """
+
+
+def timed(exp: Expression) -> Tuple[int, float]:
+    start = time.perf_counter()
+    result = IntVal.cast(Program(exp, EmptyEnvironment()).value_of_program()).value
+    return result, 1000*(time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(100_000)
+
+    print(f"{'n':>5} {'entries':>8} {'plain (ms)':>11} {'memoized (ms)':>14} {'hits':>6} {'misses':>7} {'evictions':>10}")
+    for n, max_entries in [(15, 100_000), (20, 100_000), (25, 100_000), (25, 3), (25, 2), (1000, 100_000), (1000, 3)]:
+        exp = retarget(stringToExpression(fibonacci(n)))
+        plain, plain_ms = timed(exp) if n <= 25 else (None, float("nan"))
+        with memoize(exp, max_entries) as table:
+            result, memoized_ms = timed(exp)
+        assert plain is None or result == plain
+        print(f"{n:>5} {max_entries:>8} {plain_ms:>11.1f} {memoized_ms:>14.1f} {table.hits:>6} {table.misses:>7} {table.evictions:>10}")
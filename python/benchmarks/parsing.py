@@ -0,0 +1,73 @@
+"""
+Benchmark for the parser: times lexing and parsing separately on generated programs of growing size, to show that
+both scale linearly in the amount of tokens. Also compares the peak memory of parsing from a list of tokens with
+parsing straight from the token stream.
+
+The programs are balanced trees of differences, so that their nesting depth stays logarithmic in their size and the
+recursive descent never comes near Python's recursion limit.
+"""
+import io
+import time
+import tracemalloc
+
+from parser import lex, parse, tokenize
+
+
+def balancedDifference(leaves: int) -> str:
+    """
+    Source text of a program "let x = 1 in -(-(0, x), -(2, x)) ..." with the given amount of leaves, which is about
+    a fifth of its amount of tokens.
+    """
+    parts = []
+    stack = [(0, leaves)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+
+        lo, hi = item
+        if hi - lo == 1:
+            parts.append("x" if lo % 2 else str(lo % 10))
+        else:
+            mid = (lo + hi) // 2
+            stack.extend([")", (mid, hi), ",", (lo, mid), "-("])
+
+    return "let x = 1 in " + " ".join(parts)
+
+
+def timeParser(source: str):
+    start = time.perf_counter()
+    tokens = lex(source)
+    lexed = time.perf_counter()
+    parse(tokens)
+    parsed = time.perf_counter()
+
+    stream_start = time.perf_counter()
+    parse(tokenize(io.StringIO(source)))
+    streamed = time.perf_counter()
+
+    return len(tokens), lexed - start, parsed - lexed, streamed - stream_start
+
+
+def peakMemory(source: str, streaming: bool) -> int:
+    tracemalloc.start()
+    if streaming:
+        parse(tokenize(io.StringIO(source)))
+    else:
+        parse(lex(source))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+if __name__ == "__main__":
+    print(f"{'tokens':>10} {'lex (s)':>10} {'parse (s)':>10} {'parse (us/token)':>17} {'streamed (s)':>13}")
+    for leaves in [200, 2_000, 20_000, 200_000]:
+        n, t_lex, t_parse, t_stream = timeParser(balancedDifference(leaves))
+        print(f"{n:>10} {t_lex:>10.3f} {t_parse:>10.3f} {1e6*t_parse/n:>17.2f} {t_stream:>13.3f}")
+
+    source = balancedDifference(20_000)
+    print(f"Peak memory for {len(source)} characters: "
+          f"{peakMemory(source, streaming=False) / 2**20:.1f} MiB from a token list, "
+          f"{peakMemory(source, streaming=True) / 2**20:.1f} MiB streamed.")
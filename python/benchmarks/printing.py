@@ -0,0 +1,39 @@
+"""
+Benchmark for the printer: generated programs of growing size, printed to a file in the default layout and fitted to
+a width, and a chain of subtractions far deeper than Python's recursion limit.
+"""
+import io
+import os
+import tempfile
+import time
+
+from generator import generateProgram
+from parser import stringToExpression
+from printer import expression__repr__, write_expression
+from inferred import *
+import letrec
+
+
+if __name__ == "__main__":
+    print(f"{'nodes':>8} {'output (MiB)':>13} {'to file (ms)':>13} {'width 80 (ms)':>14}")
+    for nodes in [10_000, 100_000, 300_000]:
+        exp = stringToExpression(generateProgram(nodes, seed=0))
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "program.txt")
+            start = time.perf_counter()
+            with open(path, "w") as file:
+                write_expression(exp, file)
+            default_ms = 1000*(time.perf_counter() - start)
+            size = os.path.getsize(path)
+
+        start = time.perf_counter()
+        write_expression(exp, io.StringIO(), width=80)
+        width_ms = 1000*(time.perf_counter() - start)
+        print(f"{nodes:>8} {size/2**20:>13.2f} {default_ms:>13.1f} {width_ms:>14.1f}")
+
+    exp = ConstExp(0)
+    for _ in range(100_000):
+        exp = letrec.DiffExp(exp, ConstExp(1))
+    start = time.perf_counter()
+    printed = expression__repr__(exp)
+    print(f"Chain of 100000 subtractions: {len(printed)} characters in {1000*(time.perf_counter() - start):.1f} ms.")
@@ -0,0 +1,38 @@
+"""
+Benchmark for recursive bindings: deep recursion in IMPLICIT-REFS, where every cell of the store stays allocated until
+the run ends. Each iteration needs one cell for its argument; anything more is allocated by looking up the recursive
+procedure, and grows with the depth just the same.
+"""
+import sys
+import time
+import tracemalloc
+
+from parser import stringToExpression
+from inferred import *
+
+
+def countdown(depth: int) -> str:
+    return f"letrec foo (x) = if zero?(x) then 0 else -((foo -(x,1)), -(0,1)) in (foo {depth})"
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(100_000)
+
+    print(f"{'depth':>6} {'cells':>7} {'per call':>9} {'retained (MiB)':>15} {'time (ms)':>10}")
+    for depth in [1000, 2000, 4000, 8000]:
+        exp = stringToExpression(countdown(depth))
+
+        context = Context()
+        start = time.perf_counter()
+        result = Program(exp, EmptyEnvironment(), context).value_of_program()
+        elapsed = time.perf_counter() - start
+        assert IntVal.cast(result).value == depth
+        cells = context.store.cursor
+
+        # Timed separately, since tracing allocations slows down deep Python stacks a lot.
+        context = Context()
+        tracemalloc.start()
+        result = Program(exp, EmptyEnvironment(), context).value_of_program()
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{depth:>6} {cells:>7} {cells/depth:>9.2f} {retained/2**20:>15.2f} {1000*elapsed:>10.1f}")
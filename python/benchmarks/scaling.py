@@ -0,0 +1,51 @@
+"""
+Benchmark for scaling: generates well-typed programs from 10^2 up to 10^6 nodes, streams each to a file and back, and
+times every phase on them. A phase that scales linearly keeps the same time per node.
+
+Only part of a generated program runs (one branch of every if, and procedures that are called), so evaluation takes
+less time per node than the phases that see the whole program.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from generator import writeProgram
+from parser import fileToExpression
+from inferred import *
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(100_000)
+
+    arguments = argparse.ArgumentParser(description="Time every phase on generated programs of growing size.")
+    arguments.add_argument("--max-exponent", type=int, default=6, help="the largest programs have 10^this nodes")
+    arguments.add_argument("--seed", type=int, default=0)
+    args = arguments.parse_args()
+
+    print(f"{'nodes':>8} {'generate':>9} {'parse':>9} {'type_of':>9} {'evaluate':>9}   (microseconds per node)")
+    for exponent in range(2, args.max_exponent + 1):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "program.txt")
+
+            start = time.perf_counter()
+            with open(path, "w") as file:
+                nodes = writeProgram(file, 10**exponent, seed=args.seed, typed=True)
+            t_generate = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with open(path) as file:
+                exp = fileToExpression(file, is_typed=True)
+            t_parse = time.perf_counter() - start
+
+        context = Context()
+        start = time.perf_counter()
+        type_of_program(exp, context=context)
+        t_type = time.perf_counter() - start
+
+        start = time.perf_counter()
+        Program(exp, EmptyEnvironment(), context).value_of_program()
+        t_evaluate = time.perf_counter() - start
+
+        print(f"{nodes:>8} " + " ".join(f"{1e6*t/nodes:>9.2f}" for t in [t_generate, t_parse, t_type, t_evaluate]))
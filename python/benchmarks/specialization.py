@@ -0,0 +1,42 @@
+"""
+Benchmark for specialization: evaluation of well-typed programs with the casts of the checked evaluator, and without
+them after specialization. Typed programs are evaluated as INFERRED, untyped ones as IMPLICIT-REFS (both with a store)
+and, retargeted, as LETREC (without one).
+"""
+import sys
+
+from generator import generateProgram
+from parser import stringToExpression
+from specialization import specialize
+from benchmarks.corpus import *
+from benchmarks.suite import best
+from inferred import *
+
+REPEAT = 5
+
+
+def evaluate(exp: Expression) -> ExpVal:
+    return Program(exp, EmptyEnvironment(), Context()).value_of_program()
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(100_000)
+    programs = [
+        ("countdown", COUNTDOWN_TYPED, COUNTDOWN),
+        ("church",    None,            CHURCH),
+        ("curried",   CURRIED_TYPED,   CURRIED),
+        ("generated", generateProgram(100_000, seed=0, typed=True), generateProgram(100_000, seed=0)),
+    ]
+
+    print(f"{'program':<10} {'language':<13} {'checked (ms)':>13} {'unchecked (ms)':>15} {'speedup':>8}")
+    for name, typed_source, source in programs:
+        untyped = stringToExpression(source, Context(typed=False))
+        versions = [(LETREC, retarget(untyped)), (IMPLICIT_REFS, untyped)]
+        if typed_source is not None:
+            versions.append((INFERRED, stringToExpression(typed_source, Context(typed=True))))
+        for language, exp in versions:
+            fast = specialize(exp, Context())
+            assert evaluate(exp).value == evaluate(fast).value
+            checked_ms = best(lambda: evaluate(exp), REPEAT)
+            unchecked_ms = best(lambda: evaluate(fast), REPEAT)
+            print(f"{name:<10} {language:<13} {checked_ms:>13.2f} {unchecked_ms:>15.2f} {checked_ms/unchecked_ms:>7.2f}x")
@@ -0,0 +1,152 @@
+"""
+Benchmark suite: runs the corpus in every language, timing parsing, type inference and evaluation separately, and
+recording the peak memory of the whole pipeline. Times are the best of a fixed number of repetitions, each phase runs
+on fresh input from the phase before it, and every program runs in its own context, so runs don't affect each other.
+
+Results can be written as JSON, and compared with earlier results to flag regressions. From the python/ folder:
+    PYTHONPATH=auxiliary python -m benchmarks.suite --output baseline.json
+    PYTHONPATH=auxiliary python -m benchmarks.suite --compare baseline.json
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from parser import stringToExpression
+from benchmarks.corpus import *
+from inferred import *
+
+METRICS = ["parse_ms", "infer_ms", "eval_ms", "peak_kib"]
+
+
+def interleaved(functions: List[Callable[[], object]], repeat: int) -> List[float]:
+    """
+    Shortest time of every function in milliseconds, calling each of them once per round so they share conditions.
+    """
+    times = [float("inf")] * len(functions)
+    for _ in range(repeat):
+        for i, function in enumerate(functions):
+            gc.collect()
+            start = time.perf_counter()
+            function()
+            times[i] = min(times[i], 1000*(time.perf_counter() - start))
+    return times
+
+
+def best(function: Callable[[], object], repeat: int) -> float:
+    """
+    Shortest time of the given number of calls, in milliseconds.
+    """
+    return interleaved([function], repeat)[0]
+
+
+def prepare(workload: Workload) -> Expression:
+    """
+    Turn the program of a workload into an expression of its language.
+    """
+    if not isinstance(workload.program, str):
+        return workload.program()
+
+    exp = stringToExpression(workload.program, Context(typed=workload.language == INFERRED))
+    if workload.language == LETREC:
+        exp = retarget(exp, letrec)
+    elif workload.language == EXPLICIT_REFS:
+        exp = retarget(exp, explicit_refs)
+    return exp
+
+
+def pipeline(workload: Workload) -> ExpVal:
+    exp = prepare(workload)
+    context = Context()
+    if workload.language == INFERRED:
+        type_of_program(exp, context=context)
+    return Program(exp, EmptyEnvironment(), context).value_of_program()
+
+
+def measure(workload: Workload, repeat: int) -> Dict[str, Optional[float]]:
+    exp = prepare(workload)
+    result = pipeline(workload)
+    if workload.expected is not None and result.value != workload.expected:
+        raise ValueError(f"{workload.language}/{workload.name} evaluated to {result.value} instead of {workload.expected}.")
+
+    results = dict.fromkeys(METRICS)
+    if isinstance(workload.program, str):
+        results["parse_ms"] = best(lambda: prepare(workload), repeat)
+    if workload.language == INFERRED:
+        results["infer_ms"] = best(lambda: type_of_program(exp, context=Context()), repeat)
+    results["eval_ms"] = best(lambda: Program(exp, EmptyEnvironment(), Context()).value_of_program(), repeat)
+
+    gc.collect()
+    tracemalloc.start()
+    pipeline(workload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results["peak_kib"] = peak / 1024
+    return results
+
+
+def run(workloads: List[Workload], repeat: int) -> dict:
+    return {
+        "python": platform.python_version(),
+        "repeat": repeat,
+        "results": {f"{w.language}/{w.name}": measure(w, repeat) for w in workloads}
+    }
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> List[str]:
+    """
+    Every metric that got worse than the baseline by more than the given fraction, described in a line.
+    """
+    regressions = []
+    for key, results in report["results"].items():
+        old_results = baseline["results"].get(key)
+        if old_results is None:
+            continue
+        for metric in METRICS:
+            new, old = results.get(metric), old_results.get(metric)
+            if new is None or old is None or old == 0:
+                continue
+            if new > old * (1 + threshold):
+                regressions.append(f"{key} {metric}: {old:.2f} -> {new:.2f} (+{100*(new/old - 1):.0f}%)")
+    return regressions
+
+
+def table(report: dict) -> str:
+    lines = [f"{'workload':<28}" + "".join(f"{metric:>11}" for metric in METRICS)]
+    for key, results in report["results"].items():
+        lines.append(f"{key:<28}" + "".join(f"{results[metric]:>11.2f}" if results[metric] is not None else f"{'-':>11}"
+                                            for metric in METRICS))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(100_000)
+
+    arguments = argparse.ArgumentParser(description="Benchmark the interpreters on a fixed corpus of programs.")
+    arguments.add_argument("--output", help="file to write the results to, as JSON")
+    arguments.add_argument("--compare", help="JSON file with earlier results to compare with")
+    arguments.add_argument("--threshold", type=float, default=0.25, help="fraction by which a metric may get worse")
+    arguments.add_argument("--repeat", type=int, default=5, help="how many times each phase is timed")
+    arguments.add_argument("--language", choices=LANGUAGES, action="append", help="only run these languages")
+    args = arguments.parse_args()
+
+    workloads = [w for w in CORPUS if args.language is None or w.language in args.language]
+    report = run(workloads, args.repeat)
+    print(table(report))
+
+    if args.output:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            regressions = compare(report, json.load(handle), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {100*args.threshold:.0f}%:")
+            print("\n".join(regressions))
+            sys.exit(1)
+        print(f"\nNo regressions beyond {100*args.threshold:.0f}%.")
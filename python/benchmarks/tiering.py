@@ -0,0 +1,46 @@
+"""
+Benchmark for tiered execution: programs that are run once, each with the tree-walking interpreter, with the closure
+compiler (compiling the whole program first), and in tiers. Short programs without hot procedures should cost what
+they cost in the interpreter; programs with hot procedures should get close to running them compiled.
+"""
+import sys
+
+from closures import compile_program
+from generator import generateProgram
+from parser import stringToExpression
+from tiering import tier_up
+from benchmarks.corpus import *
+from benchmarks.memoization import fibonacci
+from benchmarks.suite import interleaved
+from inferred import *
+
+REPEAT = 30
+THRESHOLD = 1_000
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(100_000)
+    programs = [
+        ("generated 10k", generateProgram(10_000, seed=0)),
+        ("generated 100k", generateProgram(100_000, seed=0)),
+        ("countdown", COUNTDOWN),
+        ("church", CHURCH),
+        ("fib 20", fibonacci(20)),
+        ("fib 22", fibonacci(22)),
+    ]
+
+    print(f"{'program':<15} {'tree (ms)':>10} {'compiled (ms)':>14} {'tiered (ms)':>12} {'promoted':>9} {'compiling (ms)':>15}")
+    for name, source in programs:
+        exp = retarget(stringToExpression(source))
+        expected = Program(exp, EmptyEnvironment()).value_of_program().value
+
+        def tiered():
+            with tier_up(exp, THRESHOLD) as tiers:
+                assert Program(exp, EmptyEnvironment()).value_of_program().value == expected
+            return tiers
+
+        tree_ms, compiled_ms, tiered_ms = interleaved([lambda: Program(exp, EmptyEnvironment()).value_of_program(),
+                                                       lambda: compile_program(exp)(EmptyEnvironment()),
+                                                       tiered], REPEAT)
+        tiers = tiered()
+        print(f"{name:<15} {tree_ms:>10.2f} {compiled_ms:>14.2f} {tiered_ms:>12.2f} {len(tiers.promotions):>9} {tiers.compile_ns/1e6:>15.2f}")
@@ -0,0 +1,35 @@
+"""
+Benchmark for type inference: programs with a growing number of procedure calls, each of which introduces a fresh type
+variable that has to be unified. With a substitution that replays all its rules on every equation, the time per call
+grows with the size of the program; with a union-find substitution, it stays about the same.
+"""
+import sys
+import time
+
+from parser import stringToExpression
+from printer import type__repr__
+from inferred import *
+
+
+def callChain(calls: int) -> str:
+    """
+    A chain of procedures, each calling the one before, followed by deeply nested calls to the last one.
+    """
+    last = calls//2 - 1
+    procs = " ".join(f"let f{i} = proc (x: ?) (f{i-1} x) in" for i in range(1, last + 1))
+    nested = f"(f{last} " * (calls - last) + "1" + ")" * (calls - last)
+    return "let f0 = proc (x: ?) -(x, 1) in " + procs + " " + nested
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(100_000)
+
+    print(f"{'calls':>6} {'type_of (ms)':>13} {'per call (us)':>14}  type")
+    for calls in [250, 500, 1000, 2000, 4000]:
+        context = Context(typed=True)
+        exp = stringToExpression(callChain(calls), context)
+
+        start = time.perf_counter()
+        prog_type = type_of_program(exp, context=context)
+        elapsed = time.perf_counter() - start
+        print(f"{calls:>6} {1000*elapsed:>13.1f} {1e6*elapsed/calls:>14.1f}  {type__repr__(prog_type)}")
@@ -0,0 +1,50 @@
+"""
+Benchmark for the memory layout of values, environments, expressions and types: how much memory a parsed program and
+the store of a finished run take, and how fast the tree-walking interpreter and the type checker are.
+"""
+import sys
+import tracemalloc
+
+from parser import stringToExpression
+from benchmarks.engines import PROGRAMS, REPEAT
+from benchmarks.parsing import balancedDifference
+from benchmarks.suite import best
+from benchmarks.unification import callChain
+from inferred import *
+
+
+def retained(function) -> int:
+    """
+    Bytes still allocated after calling the function, as long as its result is kept.
+    """
+    tracemalloc.start()
+    result = function()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def runInContext(source: str) -> Context:
+    context = Context()
+    Program(stringToExpression(source, context), EmptyEnvironment(), context).value_of_program()
+    return context
+
+
+if __name__ == "__main__":
+    sys.setrecursionlimit(100_000)
+
+    print("Memory:")
+    source = balancedDifference(100_000)
+    print(f"\t{'AST of 100000 leaves':<32} {retained(lambda: stringToExpression(source)) / 2**20:>7.2f} MiB")
+    typed_source = callChain(4000)
+    print(f"\t{'typed AST of 4000 calls':<32} {retained(lambda: stringToExpression(typed_source)) / 2**20:>7.2f} MiB")
+    countdown = "letrec foo (x) = if zero?(x) then 1 else -(x, (foo -(x,1))) in (foo 5000)"
+    print(f"\t{'store after countdown(5000)':<32} {retained(lambda: runInContext(countdown)) / 2**20:>7.2f} MiB")
+
+    print("Time:")
+    for name, source in PROGRAMS.items():
+        exp = stringToExpression(source)
+        print(f"\t{name:<32} {best(lambda: exp.value_of(EmptyEnvironment()), REPEAT):>7.2f} ms")
+    typed_exp = stringToExpression(typed_source)
+    print(f"\t{'type_of, 4000 calls':<32} {best(lambda: type_of_program(typed_exp, context=Context()), 5):>7.2f} ms")
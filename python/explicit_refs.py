@@ -5,13 +5,16 @@ Author: Thomas Bauwens
 Date: 2023-01-06
 """
 from letrec import *
-from typing import List
+from typing import Callable, Iterable, List, Optional
+import letrec
+import time
 
 
 ##############################
 ### Extra expressed values ###
 ##############################
 class Reference(ExpVal):
+    __slots__ = ("value",)
 
     def __init__(self, address: int):
         self.value = address
@@ -21,6 +24,7 @@ class Reference(ExpVal):
 ### Extra expressions ###
 #########################
 class BeginExp(Expression):
+    __slots__ = ("exps",)
 
     def __init__(self, subexpressions: List[Expression]):
         self.exps = subexpressions
@@ -33,42 +37,79 @@ class BeginExp(Expression):
 
 
 class NewrefExp(Expression):
+    __slots__ = ("init_exp",)
 
     def __init__(self, init_exp: Expression):
         self.init_exp = init_exp
 
     def value_of(self, env: Environment) -> ExpVal:
-        return THE_STORE.store(THE_STORE.new(), self.init_exp.value_of(env))
+        store = the_store()
+        return store.store(store.new(), self.init_exp.value_of(env))
 
 
 class SetrefExp(Expression):
+    __slots__ = ("ref_exp", "val_exp")
 
     def __init__(self, ref_exp: Expression, val_exp: Expression):
         self.ref_exp = ref_exp
         self.val_exp = val_exp
 
     def value_of(self, env: Environment) -> ExpVal:
-        THE_STORE.store(Reference.cast(self.ref_exp.value_of(env)), self.val_exp.value_of(env))
+        the_store().store(Reference.cast(self.ref_exp.value_of(env)), self.val_exp.value_of(env))
         return IntVal(-1_000_001)
 
 
 class DerefExp(Expression):
+    __slots__ = ("ref_exp",)
 
     def __init__(self, ref_exp: Expression):
         self.ref_exp = ref_exp
 
     def value_of(self, env: Environment) -> ExpVal:
-        return THE_STORE.load(Reference.cast(self.ref_exp.value_of(env)))
+        return the_store().load(Reference.cast(self.ref_exp.value_of(env)))
 
 
 #################
 ### The Store ###
 #################
-class Store:
+FREED = IntVal(-1_000_005)  # Content of a cell that was reclaimed by the garbage collector.
+UNINITIALIZED = IntVal(-1_000_004)  # Content of a cell that was allocated but not stored into yet.
+
+
+class GarbageCollectionStats:
 
     def __init__(self):
+        self.collections = 0
+        self.cells_freed = 0
+        self.last_freed  = 0
+        self.total_pause = 0.0  # In seconds.
+        self.last_pause  = 0.0
+        self.max_pause   = 0.0
+
+    def __repr__(self):
+        return f"GarbageCollectionStats(collections={self.collections}, cells_freed={self.cells_freed}, " \
+               f"total_pause={1000*self.total_pause:.2f}ms, max_pause={1000*self.max_pause:.2f}ms)"
+
+
+class Store:
+    """
+    With a mark-and-sweep garbage collector. Cells that can't be reached from anything the evaluator still holds are
+    put on a free list, and new() reuses those before growing the store.
+
+    The store can't see the Python stack, so an evaluator that wants automatic collection has to register a function
+    in `roots` that returns everything it holds (the CEK machine does). Collection then happens in new() once
+    `gc_threshold` cells have been allocated since the last one. Without a threshold, or without registered roots,
+    the store only collects when collect() is called explicitly, with the roots as argument.
+    """
+
+    def __init__(self, gc_threshold: Optional[int]=None):
         self.cursor = 0
         self.values = []
+        self.free: List[int] = []
+        self.roots: List[Callable[[], Iterable]] = []
+        self.gc_threshold = gc_threshold
+        self.allocations = 0  # Since the last collection.
+        self.stats = GarbageCollectionStats()
 
     def load(self, address: Reference) -> ExpVal:
         return self.values[address.value]
@@ -82,11 +123,79 @@ class Store:
         return address
 
     def new(self) -> Reference:
-        pointer = self.cursor
-        self.values.append(IntVal(-1_000_004))
-        self.cursor += 1
+        if self.gc_threshold is not None and self.allocations >= self.gc_threshold and self.roots:
+            self.collect()
+        self.allocations += 1
+
+        if self.free:
+            pointer = self.free.pop()
+            self.values[pointer] = UNINITIALIZED
+        else:
+            pointer = self.cursor
+            self.values.append(UNINITIALIZED)
+            self.cursor += 1
         return Reference(pointer)
 
+    def collect(self, roots: Iterable=()) -> int:
+        """
+        Free all cells that can't be reached from the given roots or the registered ones. Returns how many were freed.
+        """
+        start = time.perf_counter()
+
+        all_roots = list(roots)
+        for provider in self.roots:
+            all_roots.extend(provider())
+        marked = self.mark(all_roots)
+        freed = marked.count(0) - len(self.free)
+
+        # Cells after the last live one are dropped rather than put on the free list, so the store can shrink again.
+        live = len(marked.rstrip(b"\x00"))
+        del self.values[live:]
+        self.cursor = live
+
+        self.free = [address for address in self.free if address < live]
+        for address in self.free:
+            marked[address] = 1
+        garbage = [address for address in range(live) if not marked[address]]
+        for address in garbage:
+            self.values[address] = FREED
+        self.free.extend(garbage)
+
+        self.allocations = 0
+        pause = time.perf_counter() - start
+        self.stats.collections += 1
+        self.stats.cells_freed += freed
+        self.stats.last_freed   = freed
+        self.stats.total_pause += pause
+        self.stats.last_pause   = pause
+        self.stats.max_pause    = max(self.stats.max_pause, pause)
+        return freed
+
+    def mark(self, roots: Iterable) -> bytearray:
+        """
+        Trace everything reachable from the roots: values, environments, continuations ... are followed through their
+        fields, and a Reference marks its cell and is followed into that cell's content.
+        Expressions are not followed: they are code, and never hold references.
+        """
+        marked = bytearray(self.cursor)
+        seen = set()
+        todo = list(roots)
+        while todo:
+            obj = todo.pop()
+            if obj is None or isinstance(obj, (int, str, float, Expression)) or id(obj) in seen:
+                continue
+            seen.add(id(obj))
+
+            if isinstance(obj, Reference):
+                if not marked[obj.value]:
+                    marked[obj.value] = 1
+                    todo.append(self.values[obj.value])
+            elif isinstance(obj, (list, tuple)):
+                todo.extend(obj)
+            else:
+                todo.extend(fields(obj))
+        return marked
+
     def __repr__(self):
         r = "["
         for i,v in enumerate(self.values):
@@ -95,4 +204,27 @@ class Store:
         return r
 
 
-THE_STORE = Store()
+def fields(obj) -> list:
+    """
+    The values of all attributes of an object, whether they live in its __dict__ or in its __slots__.
+    """
+    values = list(getattr(obj, "__dict__", dict()).values())
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get("__slots__", ()):
+            if hasattr(obj, name):
+                values.append(getattr(obj, name))
+    return values
+
+
+THE_STORE = Store()  # Used when no context is active.
+
+
+class Context(letrec.Context):
+
+    def __init__(self, store: Store=None):
+        self.store = store if store is not None else Store()
+
+
+def the_store() -> Store:
+    context = CURRENT_CONTEXT.get()
+    return context.store if isinstance(context, Context) else THE_STORE
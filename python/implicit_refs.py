@@ -21,16 +21,22 @@ DenVal = Reference
 #   ExtendEnvironment
 
 class EnvlessProcEnvironment(Environment):
+    """
+    The procedure is put in the store once, when the environment is made, rather than in a new cell for every lookup.
+    """
+    __slots__ = ("lookupvar", "envless_proc_var", "envless_proc_body", "tail", "ref")
 
     def __init__(self, procname: str, procvar: str, procbody: "Expression", tail: Environment):
         self.lookupvar = procname
         self.envless_proc_var  = procvar
         self.envless_proc_body = procbody
         self.tail = tail
+        store = the_store()
+        self.ref = store.store(store.new(), ProcVal(procvar, procbody, self))
 
     def lookup(self, var: str) -> DenVal:
         if self.lookupvar == var:
-            return THE_STORE.store(THE_STORE.new(), ProcVal(self.envless_proc_var, self.envless_proc_body, self))
+            return self.ref
         else:
             return self.tail.lookup(var)
 
@@ -46,15 +52,17 @@ class EnvlessProcEnvironment(Environment):
 #   IfExp
 
 class VarExp(Expression):
+    __slots__ = ("var",)
 
     def __init__(self, var: str):
         self.var = var
 
     def value_of(self, env: Environment) -> ExpVal:
-        return THE_STORE.load(env.lookup(self.var))
+        return the_store().load(env.lookup(self.var))
 
 
 class LetExp(Expression):
+    __slots__ = ("var", "val_exp", "body_exp")
 
     def __init__(self, var: str, val_exp: Expression, body_exp: Expression):
         self.var = var
@@ -62,12 +70,14 @@ class LetExp(Expression):
         self.body_exp = body_exp
 
     def value_of(self, env: Environment) -> ExpVal:
+        store = the_store()
         return self.body_exp.value_of(
-            ExtendEnvironment(self.var, THE_STORE.store(THE_STORE.new(), self.val_exp.value_of(env)), env)
+            ExtendEnvironment(self.var, store.store(store.new(), self.val_exp.value_of(env)), env)
         )
 
 
 class LetrecExp(Expression):
+    __slots__ = ("procname", "procvar", "procbody", "letbody")
 
     def __init__(self, procname: str, procvar: str, procbody: Expression, letbody: Expression):
         self.procname = procname
@@ -85,12 +95,18 @@ class LetrecExp(Expression):
 #   1. Does just redefining apply_procedure in this file redefine it in letrec.py's CallExp? Probably not.
 #   2. If I put this apply_procedure after CallExp's redefinition, is it still used in the redefinition, or does the imported function get precedent?
 def apply_procedure(proc: ProcVal, arg: ExpVal) -> ExpVal:
+    store = the_store()
+    ref = store.store(store.new(), arg)
+    apply = CURRENT_APPLY.get()
+    if apply is not None:  # Layers get the cell, like the body does.
+        return apply(proc, ref)
     return proc.body.value_of(
-        ExtendEnvironment(proc.var, THE_STORE.store(THE_STORE.new(), arg), proc.closed_env)
+        ExtendEnvironment(proc.var, ref, proc.closed_env)
     )
 
 
 class CallExp(Expression):
+    __slots__ = ("operator", "operand")
 
     def __init__(self, operator_exp: Expression, operand_exp: Expression):
         self.operator = operator_exp
@@ -104,13 +120,14 @@ class SetExp(Expression):
     """
     Unlike EXPLICIT-REFS, the argument isn't a pointer, but simply an identifier.
     """
+    __slots__ = ("var", "value_exp")
 
     def __init__(self, var: str, value_exp: Expression):
         self.var = var
         self.value_exp = value_exp
 
     def value_of(self, env: Environment) -> ExpVal:
-        THE_STORE.store(env.lookup(self.var), self.value_exp.value_of(env))
+        the_store().store(env.lookup(self.var), self.value_exp.value_of(env))
         return IntVal(-1_000_002)
 
 
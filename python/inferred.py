@@ -8,17 +8,20 @@ Author: Thomas Bauwens
 Date: 2023-01-25
 """
 from implicit_refs import *
+from typing import Dict
+import explicit_refs
 
 # PART 1: Unification
 
 # Types
 class Typish:
-    pass
+    __slots__ = ()
 
 class UnknownType(Typish):
-    pass
+    __slots__ = ()
 
 class Type(Typish, ABC):
+    __slots__ = ()
 
     @abstractmethod
     def _unify(self, other: "Type", substitution: "Substitution"):
@@ -55,13 +58,17 @@ class Type(Typish, ABC):
         which is solvable.
 
         You also need it as the first call to apply any existing substitutions, obviously.
+
+        Only the outermost constructor has to be known to pick the right case of _unify(), so the substitution is
+        applied shallowly: the parts of a ProcType are resolved when they are unified in turn.
         """
-        lhs = substitution.applyThisToType(self)
-        rhs = substitution.applyThisToType(other)
+        lhs = substitution.find(self)
+        rhs = substitution.find(other)
         lhs._unify(rhs, substitution)
 
 
 class TypeVariable(Type):
+    __slots__ = ("num",)
 
     def __init__(self, num: int):
         self.num = num
@@ -70,7 +77,7 @@ class TypeVariable(Type):
         if isinstance(other, TypeVariable):  # tv1 = tv2
             if self.num != other.num:
                 substitution.append(Rule(self, other))
-        elif other.contains(self):  # tv1 = T(tv1)
+        elif substitution.occurs(self, other):  # tv1 = T(tv1)
             raise TypeError("Circular error detected.")
         else:
             substitution.append(Rule(self, other))
@@ -86,6 +93,11 @@ class TypeVariable(Type):
 
 
 class BaseType(Type):
+    """
+    Base types have no parts, so every occurrence of one can be the same object: use INT_TYPE, BOOL_TYPE and
+    FOR_EFFECT_TYPE below instead of making new ones.
+    """
+    __slots__ = ("name",)
 
     def __init__(self, typename: str):
         self.name = typename
@@ -105,10 +117,12 @@ class BaseType(Type):
         return False
 
 class IntBaseType(BaseType):
+    __slots__ = ()
     def __init__(self):
         super().__init__("int")
 
 class BoolBaseType(BaseType):
+    __slots__ = ()
     def __init__(self):
         super().__init__("bool")
 
@@ -117,10 +131,15 @@ class ForEffectType(IntBaseType):
     Expressions that are "for effect" have a return value that shouldn't be used (e.g. SetRef and Set).
     This is chosen to be a NumVal, so the type is an int.
     """
-    pass
+    __slots__ = ()
+
+INT_TYPE  = IntBaseType()
+BOOL_TYPE = BoolBaseType()
+FOR_EFFECT_TYPE = ForEffectType()
 
 
 class ProcType(Type):
+    __slots__ = ("t1", "t2")
 
     def __init__(self, t1: Type, t2: Type):
         self.t1 = t1
@@ -133,6 +152,8 @@ class ProcType(Type):
         if isinstance(other, ProcType):
             self.t1.unify(other.t1, substitution)
             self.t2.unify(other.t2, substitution)
+        elif isinstance(other, TypeVariable):  # t1 -> t2 = tv1
+            other.unify(self, substitution)
         else:
             raise TypeError("Conflicting equation found.")
 
@@ -142,6 +163,7 @@ class ProcType(Type):
 
 # Substitution
 class Rule:
+    __slots__ = ("head", "body")
 
     def __init__(self, head: TypeVariable, body: Type):
         self.head = head
@@ -149,19 +171,71 @@ class Rule:
 
 
 class Substitution:
+    """
+    Union-find over type variables. A variable that has been solved points to the type it was unified with, which
+    can be another variable; following those pointers ends at the type the variable stands for. Every path that is
+    followed is compressed, so looking up the same variable again takes one step.
+
+    This means adding a rule doesn't rewrite the existing ones, and applying the substitution doesn't replay all rules:
+    both cost about as much as the types involved are big, rather than as many rules as have been found so far.
+    """
 
     def __init__(self):
-        self.rules = []
+        self.bindings: Dict[int, Type] = dict()
+        self.heads: List[TypeVariable] = []  # In the order they were solved.
+
+    @property
+    def rules(self) -> List[Rule]:
+        """
+        The solution for every type variable, with all other rules applied to it.
+        """
+        return [Rule(head, self.applyThisToType(head)) for head in self.heads]
+
+    def find(self, t: Type) -> Type:
+        """
+        Apply the substitution to the outermost level of the given type only: the result is either a variable that
+        hasn't been solved, or a type that isn't a variable.
+        """
+        path = []
+        while isinstance(t, TypeVariable):
+            bound = self.bindings.get(t.num)
+            if bound is None:
+                break
+            path.append(t.num)
+            t = bound
+
+        for num in path:
+            self.bindings[num] = t
+        return t
 
     def applyThisToType(self, old_type: Type) -> Type:
-        for rule in self.rules:
-            old_type = old_type.applyRuleToThis(rule)
-        return old_type
+        old_type = self.find(old_type)
+        if isinstance(old_type, ProcType):
+            return ProcType(self.applyThisToType(old_type.t1), self.applyThisToType(old_type.t2))
+        else:
+            return old_type
+
+    def occurs(self, tvar: TypeVariable, t: Type) -> bool:
+        """
+        Whether the given type contains the given type variable once the substitution is applied to it.
+        """
+        todo = [t]
+        while todo:
+            t = self.find(todo.pop())
+            if isinstance(t, TypeVariable):
+                if t.num == tvar.num:
+                    return True
+            elif isinstance(t, ProcType):
+                todo.append(t.t1)
+                todo.append(t.t2)
+        return False
 
     def append(self, new_rule: Rule):
-        for r in self.rules:
-            r.body = r.body.applyRuleToThis(new_rule)
-        self.rules.append(new_rule)
+        """
+        The head has to be a variable that hasn't been solved yet.
+        """
+        self.bindings[new_rule.head.num] = new_rule.body
+        self.heads.append(new_rule.head)
 
 
 # PART 2: type_of expressions (note: the entire Martelli-Montanari algorithm, i.e. unification, has already been implemented above!)
@@ -178,12 +252,30 @@ class TypePurifier:
         return TypeVariable(self.current_id)
 
 
-THE_PURIFIER = TypePurifier()
+THE_PURIFIER = TypePurifier()  # Used when no context is active.
+
+
+class Context(explicit_refs.Context):
+    """
+    Besides a store, also has its own numbering of type variables, and tells the parser whether programs are typed
+    (None to guess it from the program text).
+    """
+
+    def __init__(self, store: Store=None, purifier: TypePurifier=None, typed: Optional[bool]=None):
+        super().__init__(store)
+        self.purifier = purifier if purifier is not None else TypePurifier()
+        self.typed = typed
+
+
+def the_purifier() -> TypePurifier:
+    context = CURRENT_CONTEXT.get()
+    return context.purifier if isinstance(context, Context) else THE_PURIFIER
 
 ####################
 ### Environments ###
 ####################
 class TypedEnvironment:
+    __slots__ = ()
 
     @abstractmethod
     def lookup(self, var: str) -> Type:
@@ -199,6 +291,7 @@ class TypedEnvironment:
         pass
 
 class EmptyEnvironmentTyped(TypedEnvironment):
+    __slots__ = ()
 
     def lookup(self, var: str) -> Type:
         raise ValueError(f"Failed to find type for variable '{var}'.")
@@ -207,6 +300,7 @@ class EmptyEnvironmentTyped(TypedEnvironment):
         raise ValueError(f"Failed to find variable to replace '{var}'.")
 
 class ExtendEnvironmentTyped(TypedEnvironment):
+    __slots__ = ("var", "val", "tail")
 
     def __init__(self, var: str, val: Type, tail: TypedEnvironment):
         self.var = var
@@ -230,6 +324,7 @@ class ExtendEnvironmentTyped(TypedEnvironment):
 ### Expressions ###
 ###################
 class TypedExpression(Expression):
+    __slots__ = ()
 
     @abstractmethod
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
@@ -237,40 +332,45 @@ class TypedExpression(Expression):
 
 
 class ConstExpTyped(TypedExpression, ConstExp):
+    __slots__ = ()
 
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
-        return IntBaseType()
+        return INT_TYPE
 
 
 class VarExpTyped(TypedExpression, VarExp):
+    __slots__ = ()
 
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
         return env.lookup(self.var)
 
 
 class DiffExpTyped(TypedExpression, DiffExp):
+    __slots__ = ()
 
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
         type1: Type = self.exp1.type_of(env, sub)  # FIXME: Works at runtime, not statically.
-        type1.unify(IntBaseType(), sub)  # Type equation 1: t_e1 = int
+        type1.unify(INT_TYPE, sub)  # Type equation 1: t_e1 = int
         type2: Type = self.exp2.type_of(env, sub)
-        type2.unify(IntBaseType(), sub)  # Type equation 2: t_e2 = int
-        return IntBaseType()             # Type equation 3: t_res = int
+        type2.unify(INT_TYPE, sub)  # Type equation 2: t_e2 = int
+        return INT_TYPE             # Type equation 3: t_res = int
 
 
 class IsZeroExpTyped(TypedExpression, IsZeroExp):
+    __slots__ = ()
 
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
         type: Type = self.exp.type_of(env, sub)
-        type.unify(IntBaseType(), sub)  # Type equation 1: t_exp = int
-        return BoolBaseType()           # Type equation 2: t_res = bool
+        type.unify(INT_TYPE, sub)  # Type equation 1: t_exp = int
+        return BOOL_TYPE           # Type equation 2: t_res = bool
 
 
 class IfExpTyped(TypedExpression, IfExp):
+    __slots__ = ()
 
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
         type_cond: Type = self.cond_exp.type_of(env, sub)
-        type_cond.unify(BoolBaseType(), sub)  # Type equation 1: t_cond = bool
+        type_cond.unify(BOOL_TYPE, sub)  # Type equation 1: t_cond = bool
         type_res1: Type = self.true_exp.type_of(env, sub)
         type_res2: Type = self.false_exp.type_of(env, sub)
         type_res1.unify(type_res2, sub)         # Type equation 2: t_branch1 = t_branch2
@@ -278,6 +378,7 @@ class IfExpTyped(TypedExpression, IfExp):
 
 
 class LetExpTyped(TypedExpression, LetExp):
+    __slots__ = ()
 
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
         type_val: Type = self.val_exp.type_of(env, sub)
@@ -285,9 +386,10 @@ class LetExpTyped(TypedExpression, LetExp):
 
 
 class CallExpTyped(TypedExpression, CallExp):
+    __slots__ = ()
 
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
-        res_type: Type = THE_PURIFIER.toType(UnknownType())
+        res_type: Type = the_purifier().toType(UnknownType())
         proc_type: Type = self.operator.type_of(env, sub)
         arg_type: Type  = self.operand.type_of(env, sub)
         proc_type.unify(ProcType(arg_type, res_type), sub)  # Type equation 1: proc_type = arg_type -> res_type
@@ -295,15 +397,17 @@ class CallExpTyped(TypedExpression, CallExp):
 
 
 class SetExpTyped(TypedExpression, SetExp):
+    __slots__ = ()
 
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
         val_type: Type = self.value_exp.type_of(env, sub)
         env.replace(self.var, val_type)
-        return ForEffectType()
+        return FOR_EFFECT_TYPE
 
 
 # These last two expressions have a new constructor due to type annotations
 class LetrecExpTyped(TypedExpression, LetrecExp):
+    __slots__ = ("tr", "tv")
 
     def __init__(self, procname: str, procvar: str, procbody: Expression, letbody: Expression,
                  return_type: Typish, var_type: Typish):
@@ -312,8 +416,8 @@ class LetrecExpTyped(TypedExpression, LetrecExp):
         self.tv = var_type
 
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
-        arg_type = THE_PURIFIER.toType(self.tv)
-        ret_type = THE_PURIFIER.toType(self.tr)
+        arg_type = the_purifier().toType(self.tv)
+        ret_type = the_purifier().toType(self.tr)
         proc_type = ProcType(arg_type, ret_type)
         env_with_proc = ExtendEnvironmentTyped(self.procname, proc_type, env)
         # The proc body can look up both the recursive proc AND its variable.
@@ -324,6 +428,7 @@ class LetrecExpTyped(TypedExpression, LetrecExp):
 
 
 class ProcExpTyped(TypedExpression, ProcExp):
+    __slots__ = ("tv",)
 
     def __init__(self, var: str, body_exp: Expression,
                  var_type: Typish):
@@ -331,6 +436,19 @@ class ProcExpTyped(TypedExpression, ProcExp):
         self.tv = var_type
 
     def type_of(self, env: TypedEnvironment, sub: Substitution) -> Type:
-        arg_type = THE_PURIFIER.toType(self.tv)
+        arg_type = the_purifier().toType(self.tv)
         return_type: Type = self.body_exp.type_of(ExtendEnvironmentTyped(self.var, arg_type, env), sub)
         return ProcType(arg_type, return_type)  # There's no need for a unification because the only equation is the result equation. If self.tv is a type variable, then its substitution will be in sub if it was resolved in the body.
+
+
+def type_of_program(exp: TypedExpression, env: TypedEnvironment=None, sub: Substitution=None, context: Context=None) -> Type:
+    """
+    Infer the type of a whole program, with its type variables numbered by the given context. Give a substitution to
+    inspect the equations that were solved along the way.
+    """
+    if env is None:
+        env = EmptyEnvironmentTyped()
+    if sub is None:
+        sub = Substitution()
+    with activate(context):
+        return sub.applyThisToType(exp.type_of(env, sub))
@@ -15,13 +15,21 @@ Author: Thomas Bauwens
 Date: 2023-01-06 (took me less than an hour to write this up)
 """
 from abc import abstractmethod, ABC
-from typing import Self  # New in Python 3.11. Very useful! https://stackoverflow.com/questions/75036613/automatically-use-subclass-type-in-method-signature
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, Optional, Self  # New in Python 3.11. Very useful! https://stackoverflow.com/questions/75036613/automatically-use-subclass-type-in-method-signature
 
 
 #########################
 ### Expression Values ###
 #########################
 class ExpVal(ABC):
+    """
+    Values never change after they are made, so they can be shared. That is why there are only two BoolVals and one
+    IntVal for every small integer: get those with BoolVal.of and IntVal.of rather than the constructors.
+    """
+    __slots__ = ()
+
     @classmethod
     def cast(cls, val: "ExpVal") -> Self:
         """
@@ -37,18 +45,32 @@ class ExpVal(ABC):
             raise TypeError(f"Tried to cast {val.__class__.__name__} to {cls.__name__}!")
 
 class IntVal(ExpVal):
+    __slots__ = ("value",)
     def __init__(self, value: int):
         self.value = value
     def __repr__(self):
         return f"IntVal({self.value})"
+    @staticmethod
+    def of(value: int) -> "IntVal":
+        cached = SMALL_INTS.get(value)
+        return cached if cached is not None else IntVal(value)
 
 class BoolVal(ExpVal):
+    __slots__ = ("value",)
     def __init__(self, value: bool):
         self.value = value
     def __repr__(self):
         return f"BoolVal({self.value})"
+    @staticmethod
+    def of(value: bool) -> "BoolVal":
+        return TRUE if value else FALSE
+
+SMALL_INTS = {i: IntVal(i) for i in range(-128, 1024)}
+TRUE  = BoolVal(True)
+FALSE = BoolVal(False)
 
 class ProcVal(ExpVal):
+    __slots__ = ("var", "body", "closed_env")
     def __init__(self, var: str, body: "Expression", closed_env: "Environment"):
         self.var = var
         self.body = body
@@ -63,6 +85,7 @@ DenVal = ExpVal
 ### Environments ###
 ####################
 class Environment(ABC):
+    __slots__ = ()
 
     @abstractmethod
     def lookup(self, var: str) -> DenVal:
@@ -70,11 +93,14 @@ class Environment(ABC):
 
 
 class EmptyEnvironment(Environment):
+    __slots__ = ()
+
     def lookup(self, var: str) -> DenVal:
         raise ValueError(f"Failed to find {var} in environment.")
 
 
 class ExtendEnvironment(Environment):
+    __slots__ = ("var", "val", "tail")
 
     def __init__(self, var: str, val: DenVal, tail: Environment):
         self.var = var
@@ -93,20 +119,23 @@ class EnvlessProcEnvironment(Environment):
     A recursive function needs to have itself in its own scope (which is represented by a closure).
     You say: "Okay, so create a ProcVal and add it to the environment before closing."
     No! That ProcVal needs to have ITSELF in its closed environment in turn. To break the cycle, you have to store an
-    environmentless proc. Then, when you look it up, this class:
-        1. Constructs a ProcVal on the fly
-        2. Passes ITSELF -- the on-the-fly ProcVal creating environment -- to the ProcVal, instead of its tail.
+    environmentless proc. Then, once this environment exists, this class:
+        1. Constructs a ProcVal
+        2. Passes ITSELF -- the ProcVal holding environment -- to the ProcVal, instead of its tail.
+    Every lookup returns that same ProcVal, so it is built only once per evaluation of the letrec.
     """
+    __slots__ = ("lookupvar", "envless_proc_var", "envless_proc_body", "tail", "proc")
 
     def __init__(self, procname: str, procvar: str, procbody: "Expression", tail: Environment):
         self.lookupvar = procname
         self.envless_proc_var  = procvar
         self.envless_proc_body = procbody
         self.tail = tail
+        self.proc = ProcVal(procvar, procbody, self)
 
     def lookup(self, var: str) -> DenVal:
         if self.lookupvar == var:
-            return ProcVal(self.envless_proc_var, self.envless_proc_body, self)
+            return self.proc
         else:
             return self.tail.lookup(var)
 
@@ -115,6 +144,7 @@ class EnvlessProcEnvironment(Environment):
 ### Expressions ###
 ###################
 class Expression(ABC):
+    __slots__ = ()
 
     @abstractmethod
     def value_of(self, env: Environment) -> ExpVal:
@@ -122,15 +152,17 @@ class Expression(ABC):
 
 
 class ConstExp(Expression):
+    __slots__ = ("const",)
 
     def __init__(self, const: int):
         self.const = const
 
     def value_of(self, env: Environment) -> ExpVal:
-        return IntVal(self.const)
+        return IntVal.of(self.const)
 
 
 class VarExp(Expression):
+    __slots__ = ("var",)
 
     def __init__(self, var: str):
         self.var = var
@@ -140,6 +172,7 @@ class VarExp(Expression):
 
 
 class ProcExp(Expression):
+    __slots__ = ("var", "body_exp")
 
     def __init__(self, var: str, body_exp: Expression):
         self.var = var
@@ -150,28 +183,31 @@ class ProcExp(Expression):
 
 
 class DiffExp(Expression):
+    __slots__ = ("exp1", "exp2")
 
     def __init__(self, exp1: Expression, exp2: Expression):
         self.exp1 = exp1
         self.exp2 = exp2
 
     def value_of(self, env: Environment) -> ExpVal:
-        return IntVal(
+        return IntVal.of(
               IntVal.cast(self.exp1.value_of(env)).value
             - IntVal.cast(self.exp2.value_of(env)).value
         )
 
 
 class IsZeroExp(Expression):
+    __slots__ = ("exp",)
 
     def __init__(self, exp: Expression):
         self.exp = exp
 
     def value_of(self, env: Environment) -> ExpVal:
-        return BoolVal(self.exp.value_of(env) == 0)
+        return BoolVal.of(IntVal.cast(self.exp.value_of(env)).value == 0)
 
 
 class IfExp(Expression):
+    __slots__ = ("cond_exp", "true_exp", "false_exp")
 
     def __init__(self, cond_exp: Expression, true_exp: Expression, false_exp: Expression):
         self.cond_exp = cond_exp
@@ -186,6 +222,7 @@ class IfExp(Expression):
 
 
 class LetExp(Expression):
+    __slots__ = ("var", "val_exp", "body_exp")
 
     def __init__(self, var: str, val_exp: Expression, body_exp: Expression):
         self.var = var
@@ -199,6 +236,7 @@ class LetExp(Expression):
 
 
 class LetrecExp(Expression):
+    __slots__ = ("procname", "procvar", "procbody", "letbody")
 
     def __init__(self, procname: str, procvar: str, procbody: Expression, letbody: Expression):
         self.procname = procname
@@ -213,6 +251,7 @@ class LetrecExp(Expression):
 
 
 class CallExp(Expression):
+    __slots__ = ("operator", "operand")
 
     def __init__(self, operator_exp: Expression, operand_exp: Expression):
         self.operator = operator_exp
@@ -223,19 +262,100 @@ class CallExp(Expression):
 
 
 def apply_procedure(proc: ProcVal, arg: ExpVal) -> ExpVal:
+    apply = CURRENT_APPLY.get()
+    if apply is not None:  # Some layers are on (see layered below).
+        return apply(proc, arg)
     return proc.body.value_of(
         ExtendEnvironment(proc.var, arg, proc.closed_env)
     )
 
 
+################
+### Contexts ###
+################
+class Context:
+    """
+    The state a program needs to run besides its expression and environment. LETREC needs none, but the languages
+    that build on it do (a store, a supply of fresh type variables ...) and extend this class.
+
+    Programs that run in different contexts share nothing, so they can run at the same time (in different threads),
+    and all memory a run used is freed when its context is dropped. Code that needs the state asks for the current
+    context, which is set with `with activate(context):`.
+    """
+    pass
+
+
+CURRENT_CONTEXT: ContextVar[Optional[Context]] = ContextVar("CURRENT_CONTEXT", default=None)
+
+
+@contextmanager
+def activate(context: Optional[Context]) -> Iterator[Optional[Context]]:
+    """
+    Make the given context the current one (in this thread) for the duration of a with-block.
+    With None, the current context stays what it was.
+    """
+    if context is None:
+        yield CURRENT_CONTEXT.get()
+        return
+
+    token = CURRENT_CONTEXT.set(context)
+    try:
+        yield context
+    finally:
+        CURRENT_CONTEXT.reset(token)
+
+
+#############
+### Calls ###
+#############
+Apply = Callable[[ProcVal, DenVal], ExpVal]
+Layer = Callable[[Apply], Apply]
+
+
+def call(proc: ProcVal, arg: DenVal) -> ExpVal:
+    """
+    What apply_procedure does when there are no layers, once the argument is what the parameter denotes (in
+    IMPLICIT-REFS, a new cell): evaluate the body with the parameter bound to it.
+    """
+    return proc.body.value_of(ExtendEnvironment(proc.var, arg, proc.closed_env))
+
+
+CURRENT_APPLY: ContextVar[Optional[Apply]] = ContextVar("CURRENT_APPLY", default=None)
+
+
+@contextmanager
+def layered(layer: Layer) -> Iterator[Apply]:
+    """
+    Make every call that apply_procedure makes (in this thread) go through the given layer for the duration of a
+    with-block. The layer gets the way calls were applied until then, and returns the way they are applied from then
+    on, which usually does something around calling the former. Features that watch or change calls (profiling,
+    memoization, tiering ...) are layers, so they can be on at the same time: the one added last runs first.
+    """
+    apply = layer(CURRENT_APPLY.get() or call)
+    token = CURRENT_APPLY.set(apply)
+    try:
+        yield apply
+    finally:
+        CURRENT_APPLY.reset(token)
+
+
 class Program:
 
-    def __init__(self, exp: Expression, initenv: Environment):
+    def __init__(self, exp: Expression, initenv: Environment, context: Context=None):
         self.exp = exp
         self.initenv = initenv
+        self.context = context
 
-    def value_of_program(self) -> ExpVal:
-        return self.exp.value_of(self.initenv)
+    def value_of_program(self, engine: Callable[[Expression, Environment], ExpVal]=None) -> ExpVal:
+        """
+        By default, the program is run by the value_of methods above. Any other evaluator of expressions in an initial
+        environment (e.g. value_of_nameless, which first resolves all variables to lexical addresses) can be given.
+        """
+        with activate(self.context):
+            if engine is None:
+                return self.exp.value_of(self.initenv)
+            else:
+                return engine(self.exp, self.initenv)
 
 
 if __name__ == "__main__":